@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+__doc__ = """
+Inverted index over a corpus of MathDOM documents.
+
+The index stores posting lists of the identifiers, operators, constant
+names and number types that each document uses.  It is kept in an
+SQLite database, which can live in a file or in memory.  Documents can
+be added and removed at any time.
+
+Queries are built from features that are combined with '&' (AND) and
+'|' (OR):
+
+>>> from mathml.lmathdom import MathDOM
+>>> from mathml.corpus import CorpusIndex, identifier, operator, number
+>>> index = CorpusIndex()
+>>> index.add(1, MathDOM.fromString('a.b + sin(x)', 'infix_term'))
+>>> index.add(2, MathDOM.fromString('a.b * 1/3', 'infix_term'))
+>>> index.add(3, MathDOM.fromString('sin(x) / 2', 'infix_term'))
+>>> index.query(identifier('a.b') & operator('sin'))
+[1]
+>>> index.query(operator('sin') | operator('times'))
+[1, 2, 3]
+>>> index.query(identifier('a.b') & (number('integer') | operator('plus')))
+[1, 2]
+>>> index.remove(2)
+>>> index.query(identifier('a.b'))
+[1]
+"""
+
+__all__ = ('CorpusIndex', 'Feature', 'identifier', 'operator',
+           'constant', 'number', 'document_features')
+
+import sqlite3
+
+from mathml.lmathdom import MathDOM, MathIndex
+
+
+class Query(object):
+    "Base class of the index queries, combine them with '&' and '|'."
+    def __and__(self, other):
+        return AllQuery(self, other)
+
+    def __or__(self, other):
+        return AnyQuery(self, other)
+
+    def sql(self):
+        "Return an SQL query for the matching documents and its parameters."
+        raise NotImplementedError
+
+class Feature(Query):
+    """A feature of a document, kind is one of 'identifier',
+    'operator', 'constant' and 'number'."""
+    KINDS = ('identifier', 'operator', 'constant', 'number')
+
+    def __init__(self, kind, value):
+        if kind not in self.KINDS:
+            raise ValueError, "Unknown feature kind '%s'" % kind
+        self.kind  = kind
+        self.value = value
+
+    def __repr__(self):
+        return '%s(%r)' % (self.kind, self.value)
+
+    def sql(self):
+        return ('SELECT doc FROM postings WHERE feature = '
+                '(SELECT id FROM features WHERE kind = ? AND value = ?)',
+                [self.kind, self.value])
+
+class _CompoundQuery(Query):
+    OPERATOR = SYMBOL = None
+    def __init__(self, *queries):
+        self.queries = queries
+
+    def __repr__(self):
+        return '(%s)' % (' %s ' % self.SYMBOL).join(map(repr, self.queries))
+
+    def sql(self):
+        selects, parameters = [], []
+        for query in self.queries:
+            sql, query_parameters = query.sql()
+            selects.append('SELECT doc FROM (%s)' % sql)
+            parameters.extend(query_parameters)
+        return (' %s ' % self.OPERATOR).join(selects), parameters
+
+class AllQuery(_CompoundQuery):
+    "Documents that match all queries."
+    OPERATOR, SYMBOL = 'INTERSECT', '&'
+
+class AnyQuery(_CompoundQuery):
+    "Documents that match any of the queries."
+    OPERATOR, SYMBOL = 'UNION', '|'
+
+
+def identifier(name):
+    return Feature('identifier', name)
+
+def operator(name):
+    return Feature('operator', name)
+
+def constant(name):
+    return Feature('constant', name)
+
+def number(valuetype):
+    return Feature('number', valuetype)
+
+
+def document_features(doc):
+    """Return the set of (kind, value) features of a MathDOM or
+    element."""
+    if isinstance(doc, MathDOM):
+        index = doc.index()
+    else:
+        index = MathIndex(doc)
+    features = set()
+    for kind, values in (('identifier', index.identifiernames()),
+                         ('operator',   index.operatornames()),
+                         ('constant',   index.constantnames()),
+                         ('number',     index.numbertypes())):
+        features.update((kind, value) for value in values)
+    return features
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    doc PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS features (
+    id    INTEGER PRIMARY KEY,
+    kind  TEXT NOT NULL,
+    value TEXT NOT NULL,
+    UNIQUE (kind, value)
+);
+CREATE TABLE IF NOT EXISTS postings (
+    feature INTEGER NOT NULL,
+    doc     NOT NULL,
+    PRIMARY KEY (feature, doc)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_by_doc ON postings (doc);
+"""
+
+class CorpusIndex(object):
+    """Inverted index of the features of a document corpus, stored in
+    an SQLite database.  Document IDs can be integers or strings.
+
+    The default is an in-memory database, pass a file name to keep the
+    index on disk.
+    """
+    def __init__(self, path=':memory:'):
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(_SCHEMA)
+        self._feature_ids = {}
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute(
+            'SELECT count(*) FROM documents').fetchone()[0]
+
+    def __contains__(self, doc_id):
+        return self._connection.execute(
+            'SELECT 1 FROM documents WHERE doc = ?', (doc_id,)).fetchone() is not None
+
+    def _feature_id(self, feature):
+        feature_ids = self._feature_ids
+        try:
+            return feature_ids[feature]
+        except KeyError:
+            pass
+        execute = self._connection.execute
+        execute('INSERT OR IGNORE INTO features (kind, value) VALUES (?, ?)', feature)
+        feature_id = feature_ids[feature] = execute(
+            'SELECT id FROM features WHERE kind = ? AND value = ?', feature).fetchone()[0]
+        return feature_id
+
+    def _remove(self, doc_id):
+        execute = self._connection.execute
+        execute('DELETE FROM postings  WHERE doc = ?', (doc_id,))
+        execute('DELETE FROM documents WHERE doc = ?', (doc_id,))
+
+    def _add(self, doc_id, doc):
+        self._remove(doc_id)
+        self._connection.execute('INSERT INTO documents (doc) VALUES (?)', (doc_id,))
+        feature_id = self._feature_id
+        self._connection.executemany(
+            'INSERT INTO postings (feature, doc) VALUES (?, ?)',
+            [ (feature_id(feature), doc_id)
+              for feature in document_features(doc) ])
+
+    def _transaction(self, function, *args):
+        try:
+            with self._connection:
+                function(*args)
+        except:
+            # the IDs of new features were rolled back
+            self._feature_ids.clear()
+            raise
+
+    def add(self, doc_id, doc):
+        "Add or replace the features of a MathDOM or element."
+        self._transaction(self._add, doc_id, doc)
+
+    def add_many(self, docs):
+        "Add a sequence of (doc_id, doc) pairs in a single transaction."
+        def add_all():
+            for doc_id, doc in docs:
+                self._add(doc_id, doc)
+        self._transaction(add_all)
+
+    def remove(self, doc_id):
+        "Remove a document from the index."
+        self._transaction(self._remove, doc_id)
+
+    def features(self, doc_id):
+        "Return the set of (kind, value) features of an indexed document."
+        return set( self._connection.execute(
+                'SELECT kind, value FROM postings JOIN features ON id = feature '
+                'WHERE doc = ?', (doc_id,)) )
+
+    def query(self, query):
+        "Return the sorted IDs of the documents that match the query."
+        sql, parameters = query.sql()
+        return [ row[0] for row in self._connection.execute(
+                'SELECT doc FROM (%s) ORDER BY doc' % sql, parameters) ]
+
+    def count(self, query):
+        "Return the number of documents that match the query."
+        sql, parameters = query.sql()
+        return self._connection.execute(
+            'SELECT count(*) FROM (%s)' % sql, parameters).fetchone()[0]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,18 +1,37 @@
 __doc__ = """
 MathML numeric type implementations based on the Decimal type.
 
-Complex, Rational, ENotation
+Complex, Rational, ENotation, LiteralDecimal
 """
 
 from decimal import Decimal
 
 
+def number_str(value):
+    """The literal form of a number as unicode string.  Uses repr()
+    for floats, as str() rounds them in Python 2."""
+    if isinstance(value, float):
+        return unicode(repr(value))
+    return unicode(value)
+
+def complex_strs(value):
+    """The literal forms of the real and imaginary part of a Complex
+    or a plain complex number."""
+    try:
+        return (value.real_str, value.imag_str)
+    except AttributeError:
+        return (number_str(value.real), number_str(value.imag))
+
+
 class Complex(complex):
     """Data type for complex numbers.
 
     Examples are (1+5i), (0.1-2i), (-i), ...
     """
     TYPE_NAME = u'complex'
+    # the real and imaginary part as passed, replaced by their string
+    # form on first use
+    __slots__ = ('__real', '__imag')
 
     __ZERO = Decimal(0)
     def __new__(cls, real, imag=None):
@@ -29,7 +48,7 @@ class Complex(complex):
         else:
             instance = complex.__new__(cls, real, imag)
 
-        instance.__tuple = (instance.__real, instance.__imag) = (unicode(real), unicode(imag))
+        instance.__real, instance.__imag = real, imag
         return instance
 
     def __complex__(self):
@@ -37,33 +56,74 @@ class Complex(complex):
 
     def __iter__(self):
         "Fake iterator to support tuple conversion."
-        return iter(self.__tuple)
+        return iter((self.real_str, self.imag_str))
+
+    def __reduce__(self):
+        return (self.__class__, (self.real_str, self.imag_str))
 
     @property
     def real_str(self):
-        return self.__real
+        real = self.__real
+        if type(real) is not unicode:
+            real = self.__real = unicode(real)
+        return real
 
     @property
     def imag_str(self):
-        return self.__imag
+        imag = self.__imag
+        if type(imag) is not unicode:
+            imag = self.__imag = unicode(imag)
+        return imag
 
     @classmethod
     def __build_complex_str(cls, real, imag):
-        return "%s%s%sj" % (real, (float(imag) >= 0) and '+' or '', imag)
+        return "%s%s%sj" % (real, (imag[:1] not in '+-') and '+' or '', imag)
 
     def __repr__(self):
-        return "Complex(%s%s%sj)" % (self.__real, (self.imag >= 0) and '+' or '', self.__imag)
+        return "Complex(%s%s%sj)" % (self.real_str, (self.imag >= 0) and '+' or '', self.imag_str)
 
     def __str__(self):
-        return "(%s%s%sj)" % (self.__real, (self.imag >= 0) and '+' or '', self.__imag)
+        return "(%s%s%sj)" % (self.real_str, (self.imag >= 0) and '+' or '', self.imag_str)
+
+
+class _ImmutableDecimal(Decimal):
+    """Decimal subclass that copies as itself.  Decimal copies
+    subclasses through str(), which loses the extra state."""
+    __slots__ = ()
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
 
+class LiteralDecimal(_ImmutableDecimal):
+    """Decimal number that keeps its literal text, like '.50'."""
+    __slots__ = ('__text',)
 
-class Rational(Decimal):
+    def __new__(cls, text):
+        instance = Decimal.__new__(cls, text)
+        instance.__text = text
+        return instance
+
+    def __reduce__(self):
+        return (self.__class__, (self.__text,))
+
+    def __str__(self):
+        return str(self.__text)
+
+    def __unicode__(self):
+        return unicode(self.__text)
+
+
+class Rational(_ImmutableDecimal):
     """Data type for rational numbers.
 
     Examples are 1/20, 3/45, ...
     """
     TYPE_NAME = u'rational'
+    __slots__ = ('__num', '__denom')
 
     def __new__(cls, num, denom=None):
         if denom is None:
@@ -73,13 +133,16 @@ class Rational(Decimal):
                 denom = 1
         num, denom = int(num), int(denom)
         instance = Decimal.__new__(cls, Decimal(num) / denom)
-        instance.__num, instance.__denom = (num, denom)
-        instance.__tuple = (unicode(num), unicode(denom))
+        instance.__num, instance.__denom = num, denom
         return instance
 
     def __iter__(self):
         "Fake iterator to support tuple conversion."
-        return iter(self.__tuple)
+        return iter((self.num_str, self.denom_str))
+
+    # Decimal pickles and copies through str(), which loses the fraction
+    def __reduce__(self):
+        return (self.__class__, (self.__num, self.__denom))
 
     @property
     def num(self):
@@ -101,12 +164,13 @@ class Rational(Decimal):
         return "Rational(%s/%s)" % (self.num, self.denom)
 
 
-class ENotation(Decimal):
+class ENotation(_ImmutableDecimal):
     """Data type of numbers in E-Notation.
 
     An example is 1E20 for 1*10^20.
     """
     TYPE_NAME = u'e-notation'
+    __slots__ = ('__num', '__exponent')
 
     def __new__(cls, num, exponent=None):
         if exponent is None:
@@ -117,19 +181,24 @@ class ENotation(Decimal):
         else:
             exponent = int(exponent)
 
-        if exponent > 0:
-            value = Decimal(num) * (10 ** exponent)
+
+        if isinstance(num, basestring):
+            # a Decimal literal of the mantissa is cheaper than scaling
+            value = Decimal(u'%sE%d' % (num, exponent))
         else:
-            value = Decimal(num) / (10 ** abs(exponent))
+            value = Decimal(num).scaleb(exponent)
 
         instance = Decimal.__new__(cls, value)
         instance.__num, instance.__exponent = num, exponent
-        instance.__tuple = (unicode(num), unicode(exponent))
         return instance
 
     def __iter__(self):
         "Fake iterator to support tuple conversion."
-        return iter(self.__tuple)
+        return iter((self.num_str, self.exponent_str))
+
+    # Decimal pickles and copies through str(), which loses the exponent
+    def __reduce__(self):
+        return (self.__class__, (self.num_str, self.__exponent))
 
     @property
     def num(self):
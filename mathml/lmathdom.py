@@ -1,7 +1,8 @@
 #!/usr/bin/python
 
 __all__ = [ 'MathDOM', 'Apply', 'Constant', 'Identifier', 'Name',
-            'Qualifier', 'Element', 'SubElement', 'SiblingElement' ]
+            'Qualifier', 'Element', 'SubElement', 'SiblingElement',
+            'xsltify_many', 'XSLTProfile', 'StringParameter' ]
 
 __doc__ = """
 ElementTree/lxml based implementation of MathDOM.
@@ -26,8 +27,16 @@ u'a + 3 * ( 4 + 5 + 1 ) + 1'
 
 """
 
+import os
 import sys
 import io
+import threading
+import weakref
+from copy import copy, deepcopy
+from hashlib import sha1
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 import lxml.etree as _etree
 from lxml.etree import SubElement, ElementTree
@@ -35,9 +44,13 @@ from lxml.sax import ElementTreeContentHandler
 
 from mathml           import MATHML_NAMESPACE_URI, UNARY_FUNCTIONS
 from mathml.xmlterm   import SaxTerm, dom_to_tree, serialize_dom
-from mathml.datatypes import Decimal, Complex, Rational, ENotation
+from mathml.datatypes import Decimal, Complex, Rational, ENotation, \
+     number_str, complex_strs
+from mathml.validator import StructureValidator
+from mathml.presentation import to_presentation
+from mathml.termhash  import tree_digest
 
-from mathml.utils     import STYLESHEETS as UTILS_STYLESHEETS
+from mathml.utils     import STYLESHEETS as UTILS_STYLESHEETS, LazyDict
 from mathml.schema    import SCHEMAS
 
 TYPE_MAP = {
@@ -53,52 +66,317 @@ STYLESHEET_MAPPING = {
     'pMML2SVG'  : ('pmathml',  'svg')
     }
 
-STYLESHEET_TRANSFORMERS = {}
+# the stylesheets are only compiled when a transformer is first used
+STYLESHEET_TRANSFORMERS = LazyDict()
+# names of the stylesheets that each transformer runs
+STYLESHEET_CHAINS = {}
+
+def _xslt_chain_loader(xsl_names):
+    def load():
+        return [ UTILS_STYLESHEETS[xsl_name] for xsl_name in xsl_names ]
+    return load
 
 # prepare XSL stylesheets
 STYLESHEETS = {}
-from os import path
 for xsl_name, (input_type, output_type) in STYLESHEET_MAPPING.iteritems():
-    try:
-        STYLESHEETS[output_type] = (input_type, UTILS_STYLESHEETS[xsl_name])
-    except KeyError: # not available
-        pass
-    except Exception, e:
-        print "Error loading stylesheet %s:" % xsl_name, e
-        pass
+    if xsl_name in UTILS_STYLESHEETS:
+        STYLESHEETS[output_type] = (input_type, xsl_name)
 
-xslt = None
 l = len(STYLESHEETS) + 1
 while l > len(STYLESHEETS):
     l = len(STYLESHEETS)
-    for output_type, (input_type, xslt) in STYLESHEETS.items():
+    for output_type, (input_type, xsl_name) in STYLESHEETS.items():
         if input_type != 'mathml' and input_type not in STYLESHEETS:
             del STYLESHEETS[output_type]
 
-xslts = None
-for output_type, (input_type, xslt) in STYLESHEETS.items():
-    STYLESHEET_TRANSFORMERS[output_type] = xslts = []
-    input_type = None
+for target_type in STYLESHEETS:
+    xsl_names = []
+    output_type, input_type = target_type, None
     while input_type != 'mathml':
-        try:
-            input_type, xslt = STYLESHEETS[output_type]
-        except KeyError:
-            raise ValueError, "Unsupported output format %s, please install appropriate stylesheets" % output_type
-        xslts.insert(0, xslt)
+        input_type, xsl_name = STYLESHEETS[output_type]
+        xsl_names.insert(0, xsl_name)
         output_type = input_type
+    STYLESHEET_TRANSFORMERS.register_loader(
+        target_type, _xslt_chain_loader(xsl_names))
+    STYLESHEET_CHAINS[target_type] = tuple(xsl_names)
+
+del STYLESHEETS, l, xsl_names, xsl_name, input_type, output_type, target_type # clean up
+
+if 'pmathml' in STYLESHEET_TRANSFORMERS:
+    PMATHML_FORMAT = 'pmathml'
+elif 'pmathml2' in STYLESHEET_TRANSFORMERS:
+    PMATHML_FORMAT = 'pmathml2'
+else:
+    PMATHML_FORMAT = None
+
+# output formats that are written directly from the MathDOM, as
+# functions that take the document and the stylesheet parameters
+DOM_SERIALIZERS = {}
+
+if 'pmathml' in STYLESHEET_TRANSFORMERS:
+    def _serialize_pmathml_native(doc, **kwargs):
+        """Write the same Presentational MathML as the 'pmathml'
+        stylesheet, without running the XSLT for the Content MathML
+        subset supported by mathml.presentation."""
+        if not kwargs:
+            result = to_presentation(doc._etree)
+            if result is not None:
+                return result
+        return doc.serialize('pmathml', **kwargs)
+    DOM_SERIALIZERS['pmathml_native'] = _serialize_pmathml_native
+
+# an XSLT object must not be used by more than one thread at a time
+_thread_local = threading.local()
+
+def _thread_transformers(output_format):
+    """Return copies of the stylesheets for output_format that belong
+    to the current thread."""
+    try:
+        transformers = _thread_local.transformers
+    except AttributeError:
+        transformers = _thread_local.transformers = {}
+    try:
+        return transformers[output_format]
+    except KeyError:
+        xslts = transformers[output_format] = [
+            copy(xslt) for xslt in STYLESHEET_TRANSFORMERS[output_format] ]
+        return xslts
+
+# long-lived worker pools by thread count, so that the worker threads
+# keep their stylesheet copies between calls
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+def _thread_pool(threads):
+    "Return the shared ThreadPool with the given number of threads."
+    with _thread_pools_lock:
+        pool, pid = _thread_pools.get(threads, (None, None))
+        if pid != os.getpid(): # not inherited through fork()
+            pool = ThreadPool(threads)
+            _thread_pools[threads] = (pool, os.getpid())
+        return pool
+
+# RelaxNG schema for MathML validation, parsed on first use
+MML_RNG_NAME = 'mathml2'
+
+def _strict_validator():
+    if MML_RNG_NAME not in SCHEMAS:
+        raise ValueError, "MathML RelaxNG schema is not available"
+    return SCHEMAS[MML_RNG_NAME]
 
-del STYLESHEETS, l, xslt, xslts, xsl_name, input_type, output_type, path # clean up
 
-# ignore XML Schema for MathML validation (doesn't currently work because of libxml2)
-MML_SCHEMA = None
+_MATH_NS_DICT = {'math' : MATHML_NAMESPACE_URI}
+_NAMESPACE    = "{%s}" % MATHML_NAMESPACE_URI
 
-# try to read RelaxNG schema for MathML validation
-MML_RNG = SCHEMAS.get('mathml2')
+# cache of compiled XPath expressions, keyed by expression and namespaces
+_XPATH_CACHE = {}
+_XPATH_CACHE_SIZE = 100
+
+def _compiled_xpath(expression, namespaces=None):
+    """Return a compiled XPath object for expression.  The 'math'
+    prefix is always bound to the MathML namespace."""
+    if namespaces:
+        ns_key = tuple(sorted(namespaces.iteritems()))
+    else:
+        ns_key = None
+    key = (expression, ns_key)
+    try:
+        return _XPATH_CACHE[key]
+    except KeyError:
+        pass
+    if namespaces:
+        namespaces = namespaces.copy()
+        namespaces.update(_MATH_NS_DICT)
+    else:
+        namespaces = _MATH_NS_DICT
+    xpath = _etree.XPath(expression, namespaces=namespaces)
+    if len(_XPATH_CACHE) >= _XPATH_CACHE_SIZE:
+        _XPATH_CACHE.clear()
+    _XPATH_CACHE[key] = xpath
+    return xpath
+
+_ANCESTOR_XPATH   = _compiled_xpath('ancestor::math:*[1]')
+_IDENTIFIER_XPATH = _compiled_xpath('.//math:ci')
+_CONSTANT_XPATH   = _compiled_xpath(
+    './/math:true|.//math:false|.//math:exponentiale|.//math:imaginaryi|.//math:pi')
+_NUMBER_XPATH     = _compiled_xpath('.//math:cn')
+_APPLY_XPATH      = _compiled_xpath('.//math:apply')
+
+
+class StringParameter(unicode):
+    """String value of an XSLT parameter.  It is passed to the
+    stylesheets as XSLT.strparam(), but unlike strparam() values, which
+    lxml keeps opaque, it can be cached by its content."""
+    __slots__ = ()
+
+_STRPARAM_TYPE = type(_etree.XSLT.strparam(''))
+
+def _parameter_key(value):
+    "Key StringParameter values by their type and content."
+    if isinstance(value, StringParameter):
+        return (StringParameter, unicode(value))
+    return value
+
+def _xslt_parameters(parameters):
+    "Replace StringParameter values by XSLT.strparam() values."
+    for value in parameters.itervalues():
+        if isinstance(value, StringParameter):
+            break
+    else:
+        return parameters
+    strparam = _etree.XSLT.strparam
+    return dict( (name, isinstance(value, StringParameter) and strparam(value) or value)
+                 for name, value in parameters.iteritems() )
+
+class TransformCache(object):
+    """Bounded LRU cache for XSLT results.
+
+    The keys combine a digest of the canonical (C14N) input subtree,
+    the output format and the XSLT parameters.  Pass string parameters
+    as StringParameter, results for XSLT.strparam() values are not
+    cached.  The cache owns the result trees, users only get copies of
+    them.
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
 
+    @staticmethod
+    def build_key(element, output_format, parameters):
+        "Return the key for the arguments, or None if they are not cacheable."
+        for value in parameters.itervalues():
+            if isinstance(value, _STRPARAM_TYPE):
+                return None
+        digest = sha1(_etree.tostring(element, method='c14n')).digest()
+        return (digest, output_format,
+                tuple(sorted( (name, _parameter_key(value))
+                              for name, value in parameters.iteritems() )))
+
+    def get(self, key):
+        "Return the cached result tree for key or None."
+        with self._lock:
+            result = self._results.pop(key, None)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._results[key] = result
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            results = self._results
+            results.pop(key, None)
+            results[key] = result
+            while len(results) > self.maxsize:
+                results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.hits = self.misses = 0
+
+XSLT_CACHE = TransformCache()
+
+
+class XSLTProfile(object):
+    """Per-template call counts and times of profiled XSLT runs,
+    summed up over all runs that were added.
+
+    Templates are identified by (stylesheet, match, name, mode).
+    """
+    # unit of the libxslt profiling times
+    TICKS_PER_SECOND = 100000
+
+    def __init__(self):
+        self.runs = 0
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def add(self, stylesheet, templates):
+        """Add the statistics of a run of the named stylesheet, given
+        as a {(match, name, mode) : (calls, ticks)} dictionary."""
+        with self._lock:
+            self.runs += 1
+            all_templates = self._templates
+            for template, (calls, ticks) in templates.iteritems():
+                key = (stylesheet,) + template
+                counts = all_templates.get(key)
+                if counts is None:
+                    counts = all_templates[key] = [0, 0]
+                counts[0] += calls
+                counts[1] += ticks
+
+    def clear(self):
+        with self._lock:
+            self.runs = 0
+            self._templates.clear()
+
+    def templates(self):
+        """Return a list of (stylesheet, match, name, mode, calls,
+        seconds) tuples, most expensive template first."""
+        with self._lock:
+            items = self._templates.items()
+        ticks = float(self.TICKS_PER_SECOND)
+        items.sort(key=lambda (key, (calls, time)) : (-time, -calls, key))
+        return [ key + (calls, time / ticks)
+                 for key, (calls, time) in items ]
+
+    def report(self, limit=None):
+        "Format the most expensive templates as a text table."
+        lines = [ '%-12s %-48s %8s %10s %10s' % (
+                'stylesheet', 'template', 'calls', 'time [s]', 'avg [ms]') ]
+        for stylesheet, match, name, mode, calls, seconds in self.templates()[:limit]:
+            template = match or name
+            if mode:
+                template = '%s (mode %s)' % (template, mode)
+            lines.append('%-12s %-48s %8d %10.4f %10.4f' % (
+                    stylesheet, template, calls, seconds,
+                    calls and seconds * 1000 / calls))
+        return '\n'.join(lines)
+
+    __str__ = report
+
+XSLT_PROFILE = XSLTProfile()
+
+def _profiling_transformers(output_format):
+    """Return (name, xslt, totals) entries with private copies of the
+    stylesheets for output_format that are only used for profiled runs
+    in the current thread.  libxslt sums up the profile over all
+    profiled runs of a stylesheet, totals keeps the previous sums."""
+    try:
+        profilers = _thread_local.profilers
+    except AttributeError:
+        profilers = _thread_local.profilers = {}
+    try:
+        return profilers[output_format]
+    except KeyError:
+        entries = profilers[output_format] = [
+            (name, copy(xslt), {}) for name, xslt in zip(
+                STYLESHEET_CHAINS[output_format],
+                STYLESHEET_TRANSFORMERS[output_format]) ]
+        return entries
+
+def _profile_run(xslt, totals, tree, parameters):
+    """Run xslt with profiling, return the result and the statistics
+    of this run as a {(match, name, mode) : (calls, ticks)} dict."""
+    result = xslt.apply(tree, profile_run=True, **parameters)
+    templates = {}
+    for template in result.xslt_profile.getroot():
+        get = template.get
+        key = (get('match'), get('name'), get('mode'))
+        calls, ticks = int(get('calls')), int(get('time'))
+        old_calls, old_ticks = totals.get(key, (0, 0))
+        totals[key] = (calls, ticks)
+        if calls > old_calls:
+            templates[key] = (calls - old_calls, ticks - old_ticks)
+    return result, templates
 
-_MATH_NS_DICT = {'math' : MATHML_NAMESPACE_URI}
-_NAMESPACE    = "{%s}" % MATHML_NAMESPACE_URI
-_ANCESTOR_XPATH = _etree.XPath('ancestor::math:*[1]', namespaces=_MATH_NS_DICT)
 
 _parser = _etree.XMLParser(remove_blank_text=True)
 
@@ -110,24 +388,52 @@ def SiblingElement(_element, _tag, *args, **kwargs):
 
 Element = _parser.makeelement
 
+_CI_TAG    = _tag_name('ci')
+_CN_TAG    = _tag_name('cn')
+_APPLY_TAG = _tag_name('apply')
+_CONSTANT_TAGS = tuple(_tag_name(name) for name in
+                       ('true', 'false', 'exponentiale', 'imaginaryi', 'pi'))
+
+# modification counters of the trees, keyed by their root elements and
+# incremented by all tree modifications that go through the MathDOM API.
+# Plain lxml elements (like the root of an XHTML document that embeds
+# MathML) cannot be weakly referenced, their trees have no counter.
+_modification_counts = weakref.WeakKeyDictionary()
+
+def _root_element(element):
+    return element.getroottree().getroot()
+
+def _modification_count(element):
+    """Return the modification counter of the tree that contains
+    element, or None if the tree has no counter."""
+    try:
+        return _modification_counts.get(_root_element(element), 0)
+    except TypeError:
+        return None
+
+def _tree_modified(element, removed=()):
+    """Count a modification of the tree that contains element and drop
+    the cached values of the 'cn' elements in the removed subtrees."""
+    root = _root_element(element)
+    try:
+        _modification_counts[root] = _modification_counts.get(root, 0) + 1
+    except TypeError:
+        pass # no counter, see _modification_count()
+    for removed_element in removed:
+        for cn_element in removed_element.iter(_CN_TAG):
+            cache = getattr(cn_element, '_value_cache', None)
+            if cache is not None:
+                cache.invalidate(cn_element)
+
 
 class Qualifier(object):
     def __init__(self, name, default_node=None):
         self.name = _NAMESPACE + name
-        self.__xpath = '../math:' + name
+        self.__xpath = _compiled_xpath('../math:' + name)
         self.__default_node = default_node
 
     def __find_qualifier(self, node, default=None):
-        try:
-            _xpath_eval = node._xpath
-        except AttributeError:
-            _xpath_eval = None
-
-        if _xpath_eval:
-            qualifier_nodes = _xpath_eval(self.__xpath)
-        else:
-            qualifier_nodes = node.xpath(self.__xpath, _MATH_NS_DICT)
-
+        qualifier_nodes = self.__xpath(node)
         if qualifier_nodes:
             return qualifier_nodes[0]
         else:
@@ -144,12 +450,15 @@ class Qualifier(object):
         if qualifier_node is None:
             qualifier_node = SiblingElement(node, self.name)
 
+        removed = ()
         if isinstance(value, (str, unicode)):
+            removed = list(qualifier_node)
             qualifier_node.clear()
             qualifier_node.text = value
         else:
             qualifier_node.text = None
             qualifier_node.append(value)
+        _tree_modified(node, removed)
 
 
 class MathElement(_etree.ElementBase):
@@ -170,23 +479,10 @@ class MathElement(_etree.ElementBase):
         return self[0]
 
     def xpath(self, expression, other_namespaces=None):
-        if not other_namespaces or other_namespaces == _MATH_NS_DICT:
-            return self._xpath(expression)
-
-        evaluator = _etree.XPathElementEvaluator(
-            self, namespaces=other_namespaces)
-        evaluator.registerNamespace('math', MATHML_NAMESPACE_URI)
-        return super(MathElement, self).xpath(
-            expression, namespaces=other_namespaces)
+        return _compiled_xpath(expression, other_namespaces)(self)
 
     def _xpath(self, xpath):
-        try:
-            evaluate = self.__xpath_evaluator
-        except AttributeError:
-            evaluate = self.__xpath_evaluator = \
-                _etree.XPathElementEvaluator(
-                self, namespaces=_MATH_NS_DICT).evaluate
-        return evaluate(xpath)
+        return _compiled_xpath(xpath)(self)
 
     def mathtype(self):
         return self.localName
@@ -194,32 +490,54 @@ class MathElement(_etree.ElementBase):
     def has_type(self, name):
         return self.localName == name
 
-    def iteridentifiers(self):
-        return iter(self._xpath('.//math:ci'))
+    # The iter*() methods evaluate an XPath expression and iterate
+    # over the complete result list, so the tree can safely be
+    # modified while iterating.  Pass lazy=True to traverse the tree
+    # on the fly instead, which yields the first results immediately
+    # and does not build a list, but does not allow tree changes
+    # during the iteration.
 
-    def iteridentifiernames(self):
-        return (e.name() for e in self._xpath('.//math:ci'))
+    def iteridentifiers(self, lazy=False):
+        if lazy:
+            return self.iterdescendants(_CI_TAG)
+        return iter(_IDENTIFIER_XPATH(self))
 
-    def iterconstants(self):
-        return iter(self._xpath('.//math:true|.//math:false|.//math:exponentiale|.//math:imaginaryi|.//math:pi'))
+    def iteridentifiernames(self, lazy=False):
+        return (e.name() for e in self.iteridentifiers(lazy))
 
-    def iterconstantnames(self):
-        return (e.localName for e in self.iterconstants())
+    def iterconstants(self, lazy=False):
+        if lazy:
+            return self.iterdescendants(*_CONSTANT_TAGS)
+        return iter(_CONSTANT_XPATH(self))
 
-    def iternumbers(self):
-        return iter(self._xpath('.//math:cn'))
+    def iterconstantnames(self, lazy=False):
+        return (e.localName for e in self.iterconstants(lazy))
 
-    def iternumbervalues(self):
-        return (n.value() for n in self._xpath('.//math:cn'))
+    def iternumbers(self, lazy=False):
+        if lazy:
+            return self.iterdescendants(_CN_TAG)
+        return iter(_NUMBER_XPATH(self))
 
-    def iteroperators(self):
-        return (e[0] for e in self._xpath('.//math:apply') if len(e))
+    def iternumbervalues(self, lazy=False):
+        return (n.value() for n in self.iternumbers(lazy))
+
+    def iteroperators(self, lazy=False):
+        if lazy:
+            applies = self.iterdescendants(_APPLY_TAG)
+        else:
+            applies = _APPLY_XPATH(self)
+        return (e[0] for e in applies if len(e))
 
 
 class SerializableMathElement(MathElement):
     def to_tree(self):
         return dom_to_tree(self)
 
+    def digest(self, commutative=False):
+        """Return the canonical structural digest of this subtree, see
+        mathml.termhash.tree_digest()."""
+        return tree_digest(dom_to_tree(self), commutative)
+
     def serialize(self, *args, **kwargs):
         return serialize_dom(self, *args, **kwargs)
 
@@ -237,11 +555,46 @@ class SerializableMathElement(MathElement):
         to_pres = to_pmathml
 
     if STYLESHEET_TRANSFORMERS:
-        def xsltify(self, _output_format, **kwargs):
-            xslts = STYLESHEET_TRANSFORMERS[_output_format]
+        def xsltify(self, _output_format, _use_cache=True, _profile=None, **kwargs):
+            """Run the XSLT stylesheets that produce _output_format.
+            Results are looked up in XSLT_CACHE by content and returned
+            as a private copy, unless _use_cache is false.  Pass string
+            parameters as StringParameter values to keep them cacheable.
+
+            If _profile is an XSLTProfile (or True for XSLT_PROFILE),
+            the stylesheets are run with profiling and without the
+            cache, and the template statistics are added to the profile.
+            """
+            if _profile:
+                return self._xsltify(_output_format, kwargs, profile=_profile)
+            if not _use_cache:
+                return self._xsltify(_output_format, kwargs)
+            return self._cached_xsltify(_output_format, kwargs)
+
+        def _cached_xsltify(self, output_format, parameters, xslts=None):
+            key = XSLT_CACHE.build_key(self, output_format, parameters)
+            if key is None:
+                return self._xsltify(output_format, parameters, xslts)
+            result = XSLT_CACHE.get(key)
+            if result is None:
+                result = self._xsltify(output_format, parameters, xslts)
+                XSLT_CACHE.put(key, result)
+            return deepcopy(result)
+
+        def _xsltify(self, output_format, parameters, xslts=None, profile=None):
+            if xslts is None:
+                xslts = STYLESHEET_TRANSFORMERS[output_format]
+            parameters = _xslt_parameters(parameters)
             root = ElementTree(self)
-            for xslt in xslts:
-                root = xslt.apply(root, **kwargs)
+            if not profile:
+                for xslt in xslts:
+                    root = xslt.apply(root, **parameters)
+                return root
+            if profile is True:
+                profile = XSLT_PROFILE
+            for name, xslt, totals in _profiling_transformers(output_format):
+                root, templates = _profile_run(xslt, totals, root, parameters)
+                profile.add(name, templates)
             return root
 
 class math_math(SerializableMathElement):
@@ -250,6 +603,7 @@ class math_math(SerializableMathElement):
 class math_cn(SerializableMathElement):
     IMPLEMENTS = 'cn'
     VALID_TYPES = ("real", "integer", "rational")
+    _value_cache = None # set by ValueCache
     def __repr__(self):
         name = self.localName
         return u"<%s type='%s'>%r</%s>" % (name, self.get('type', 'real'), self.value(), name)
@@ -276,27 +630,34 @@ class math_cn(SerializableMathElement):
 
     def set_complex(self, value):
         "Set the complex value of this element"
-        try:
-            tuple_value = (value.real_str, value.imag_str)
-        except AttributeError:
-            tuple_value = (unicode(value.real), unicode(value.imag))
-        self._set_tuple_value('complex', tuple_value)
+        self._set_tuple_value('complex', complex_strs(value))
 
     def value(self):
         "Returns the numerical value with the correct type."
+        return self.typed_value()[1]
+
+    def typed_value(self):
+        "Returns the value type and the numerical value as a tuple."
         valuetype = self.valuetype()
         if valuetype == 'integer':
-            return int(self.text)
+            return (valuetype, int(self.text))
         elif valuetype == 'real':
-            return Decimal(self.text)
+            return (valuetype, Decimal(self.text))
 
         try:
             typeclass = TYPE_MAP[valuetype]
-            return typeclass(self.text, self[0].tail)
+            return (valuetype, typeclass(self.text, self[0].tail))
         except KeyError:
             raise NotImplementedError, "Invalid data type."
 
+    def _invalidate_value(self):
+        cache = self._value_cache
+        if cache is not None:
+            cache.invalidate(self)
+
     def _set_tuple_value(self, type_name, value_tuple):
+        _tree_modified(self)
+        self._invalidate_value()
         self.clear()
         self.text = unicode(value_tuple[0])
         sep = SubElement(self, _tag_name('sep'))
@@ -312,6 +673,9 @@ class math_cn(SerializableMathElement):
         elif isinstance(value, Rational):
             self.set_rational(value)
             return
+        elif isinstance(value, ENotation):
+            self._set_tuple_value('e-notation', (value.num_str, value.exponent_str))
+            return
         elif type_name is None:
             try:
                 type_name = value.TYPE_NAME
@@ -324,9 +688,11 @@ class math_cn(SerializableMathElement):
                     raise TypeError, "Invalid value type. Please specify type name."
         elif type_name not in self.VALID_TYPES:
             raise ValueError, "Unsupported type name."
+        _tree_modified(self)
+        self._invalidate_value()
         self.clear()
         self.set('type', type_name)
-        self.text = unicode(value)
+        self.text = number_str(value)
 
 
 class math_ci(SerializableMathElement):
@@ -357,7 +723,7 @@ class math_apply(SerializableMathElement):
         return self[0].localName
 
     def set_operator(self, new_operator):
-        operands = self[1:]
+        removed, operands = self[:1], self[1:]
         self.clear()
         if isinstance(new_operator, (str, unicode)):
             SubElement(self, _tag_name(new_operator))
@@ -367,6 +733,7 @@ class math_apply(SerializableMathElement):
             raise ValueError, "Operator value has invalid type, use strings or math elements."
         for operand in operands:
             self.append(operand)
+        _tree_modified(self, removed)
 
     def operands(self):
         return self[1:]
@@ -378,6 +745,7 @@ class math_apply(SerializableMathElement):
         if not len(self):
             raise TypeError, "You must supply an operator first."
         self.append(operand)
+        _tree_modified(self)
 
 
 class math_minus(MathElement):
@@ -403,6 +771,128 @@ class math_log(math_unary_function):
     # logbase setup later
 
 
+class ValueCache(object):
+    """Cache of the typed values of 'cn' elements, keyed by element.
+
+    The values are cached together with their value type.  The cached
+    elements remember their cache, so set_value(), set_complex() and
+    set_rational() drop their entry, as do the MathDOM API functions
+    that remove them from the tree.  Changing or removing 'cn' elements
+    through the plain ElementTree API requires calling invalidate() or
+    clear() on the cache.
+    """
+    def __init__(self):
+        self._values = {}
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def typed_value(self, cn_element):
+        """Return the (valuetype, value) pair of a 'cn' element,
+        computing it on first access."""
+        try:
+            typed_value = self._values[cn_element]
+        except KeyError:
+            self.misses += 1
+            typed_value = self._values[cn_element] = cn_element.typed_value()
+            cn_element._value_cache = self
+        else:
+            self.hits += 1
+        return typed_value
+
+    def value(self, cn_element):
+        "Return the value of a 'cn' element, computing it on first access."
+        return self.typed_value(cn_element)[1]
+
+    def invalidate(self, cn_element):
+        "Drop the cached value of a 'cn' element."
+        if self._values.pop(cn_element, None) is not None:
+            cn_element._value_cache = None
+
+    def clear(self):
+        "Drop all cached values and reset the statistics."
+        for cn_element in self._values:
+            cn_element._value_cache = None
+        self._values.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        "Return a tuple (hits, misses, cached values)."
+        return (self.hits, self.misses, len(self))
+
+
+class MathIndex(object):
+    """Index of the identifiers, constants, operators and numbers in a
+    tree.  Built in a single pass, lookups return lists of elements in
+    document order.  typed_value is an optional function that returns
+    the (valuetype, value) pair of a 'cn' element, like the
+    ValueCache.typed_value() method.
+
+    The index does not see modifications that bypass the MathDOM API
+    (like the plain ElementTree methods).  Use MathDOM.index(rebuild=True)
+    after changing the tree that way.
+    """
+    def __init__(self, root, typed_value=None):
+        self.root = root
+        self.modification_count = _modification_count(root)
+        self._identifiers = identifiers = {}
+        self._constants   = constants   = {}
+        self._applies     = applies     = {}
+        self._numbers     = numbers     = {}
+        for element in root.iter(_CI_TAG, _CN_TAG, _APPLY_TAG, *_CONSTANT_TAGS):
+            tag = element.tag
+            if tag == _CI_TAG:
+                identifiers.setdefault(element.name(), []).append(element)
+            elif tag == _CN_TAG:
+                if typed_value is None:
+                    valuetype = element.valuetype()
+                else:
+                    valuetype = typed_value(element)[0]
+                numbers.setdefault(valuetype, []).append(element)
+            elif tag == _APPLY_TAG:
+                if len(element):
+                    applies.setdefault(element[0].localName, []).append(element)
+            else:
+                constants.setdefault(element.localName, []).append(element)
+
+    def is_current(self):
+        """Check if the tree was modified since building the index.
+        Trees without a modification counter are always considered
+        modified."""
+        modification_count = self.modification_count
+        return modification_count is not None and \
+               modification_count == _modification_count(self.root)
+
+    def identifiers(self, name):
+        "Return the 'ci' elements with the given name."
+        return list(self._identifiers.get(name, ()))
+
+    def constants(self, name):
+        "Return the constant elements (like 'pi') with the given local name."
+        return list(self._constants.get(name, ()))
+
+    def applies(self, operator_name):
+        "Return the 'apply' elements for the given operator local name."
+        return list(self._applies.get(operator_name, ()))
+
+    def numbers(self, valuetype):
+        "Return the 'cn' elements of the given value type."
+        return list(self._numbers.get(valuetype, ()))
+
+    def identifiernames(self):
+        return self._identifiers.keys()
+
+    def operatornames(self):
+        return self._applies.keys()
+
+    def constantnames(self):
+        return self._constants.keys()
+
+    def numbertypes(self):
+        return self._numbers.keys()
+
+
 class MathDOM(object):
     def __init__(self, etree=None, file=None):
         self._parser = parser = _etree.XMLParser(remove_blank_text=True)
@@ -418,6 +908,13 @@ class MathDOM(object):
         else:
             assert file is None
         self._etree = etree
+        self._index = None
+        self._value_cache = ValueCache()
+
+    def __reduce__(self):
+        """Pickle support.  The document is stored as the plain bytes
+        of the lxml tree, which lxml writes and parses in C."""
+        return (_unpickle_mathdom, (_etree.tostring(self._etree),))
 
     @staticmethod
     def __build_input_file(source):
@@ -451,6 +948,11 @@ class MathDOM(object):
             sax_parser = SaxTerm.for_input_type(input_type)
             return cls.fromSax(input, sax_parser())
 
+    @classmethod
+    def fromTree(cls, tree):
+        "Build a MathDOM from an AST."
+        return cls(_tree_to_etree(tree))
+
     def toMathml(self, out=None, indent=False):
         """Convert this MathDOM into MathML and write it to file (or
         file-like object) out. Note that the indent parameter is
@@ -468,7 +970,7 @@ class MathDOM(object):
         #if indent: ??
         self._etree.write(out, encoding='UTF-8')
 
-    if 'pmathml' in STYLESHEET_TRANSFORMERS or 'pmathml2' in STYLESHEET_TRANSFORMERS:
+    if PMATHML_FORMAT:
         def to_pmathml(self, *args, **kwargs):
             """Returns an ElementTree containing a Presentational
             MathML representation of this document."""
@@ -476,28 +978,134 @@ class MathDOM(object):
             return root.to_pmathml(*args, **kwargs)
         to_pres = to_pmathml
 
+        @staticmethod
+        def to_pmathml_many(docs, threads=None):
+            """Convert a sequence of MathDOMs to Presentational MathML
+            in parallel threads.  Returns a list of (ElementTree,
+            exception) tuples in input order, see xsltify_many()."""
+            return xsltify_many(docs, PMATHML_FORMAT, threads)
+
     if STYLESHEET_TRANSFORMERS:
         def xsltify(self, _output_format, **kwargs):
             "Run an XSLT on the root node."
             root = self._etree.getroot()
             return root.xsltify(_output_format, **kwargs)
 
-    if MML_SCHEMA:
-        def validate(self):
-            "Validate the MathDOM against the MathML 2.0 XML Schema."
-            return MML_SCHEMA.validate(self._etree)
-    elif MML_RNG:
-        def validate(self):
-            "Validate the MathDOM against the MathML 2.0 RelaxNG schema."
-            return MML_RNG.validate(self._etree)
+    def validate(self, strict=False):
+        """Validate the MathDOM against the Content MathML subset that
+        MathDOM supports.  Pass strict=True to validate against the
+        MathML 2.0 RelaxNG schema instead."""
+        if strict:
+            return _strict_validator().validate(self._etree)
+        return StructureValidator().validate(self._etree)
+
+    @staticmethod
+    def validate_many(docs, strict=False):
+        """Validate a sequence of MathDOMs, either against the supported
+        Content MathML subset or (if strict) against the MathML 2.0
+        RelaxNG schema.  Returns a list of error logs, which are empty
+        for valid documents."""
+        if strict:
+            return _strict_validator().validate_many(
+                doc._etree for doc in docs)
+        validator = StructureValidator()
+        error_logs = []
+        for doc in docs:
+            validator.validate(doc._etree)
+            error_logs.append(validator.error_log)
+        return error_logs
+
+    @property
+    def value_cache(self):
+        "The ValueCache that stores the values of the 'cn' elements."
+        return self._value_cache
+
+    def iternumbervalues(self, lazy=False):
+        "Iterate over the (cached) values of all 'cn' elements."
+        value = self._value_cache.value
+        root = self._etree.getroot() # may be a plain element, e.g. XHTML
+        if lazy:
+            numbers = root.iterdescendants(_CN_TAG)
+        else:
+            numbers = _NUMBER_XPATH(root)
+        return (value(n) for n in numbers)
 
     def to_tree(self):
         "Build and return the AST representation."
-        return dom_to_tree(self._etree)
-
-    def serialize(self, output_format=None, converter=None, **kwargs):
-        """Serialize to 'mathml' (default), 'pmathml' or any other
-        supported term format."""
+        return dom_to_tree(self._etree, self._value_cache.typed_value)
+
+    def digest(self, commutative=False):
+        """Return the canonical structural digest of the document, see
+        mathml.termhash.tree_digest()."""
+        return tree_digest(self.to_tree(), commutative)
+
+    def _replace(self, elements, new_element):
+        "Replace a list of elements by new_element and copies of it."
+        for element in elements:
+            if new_element is None:
+                new_element = deepcopy(replacement)
+            replacement = new_element
+            new_element.tail = element.tail
+            parent = element.getparent()
+            if parent is None:
+                _tree_modified(element, (element,))
+                self._etree._setroot(new_element)
+            else:
+                parent.replace(element, new_element)
+                _tree_modified(parent, (element,))
+            new_element = None
+
+    def substitute(self, mapping):
+        """Replace the identifiers in the document by the values of a
+        {name : value} mapping.  Values can be names, numbers, elements,
+        MathDOMs or ASTs."""
+        index = self.index()
+        for name, value in mapping.iteritems():
+            identifiers = index.identifiers(name)
+            if identifiers:
+                self._replace(identifiers, _substitution_element(value))
+        _tree_modified(self._etree.getroot())
+
+    def substitute_many(self, mappings):
+        """Return a list of copies of the document, substituted by each
+        of a sequence of mappings, see substitute().  The identifiers
+        are only located once."""
+        root = self._etree.getroot()
+        index = self.index()
+        paths = dict( (name, [ _element_path(root, element)
+                               for element in index.identifiers(name) ])
+                      for name in index.identifiernames() )
+        docs = []
+        for mapping in mappings:
+            doc_root = deepcopy(root)
+            doc = MathDOM(ElementTree(doc_root))
+            for name, value in mapping.iteritems():
+                if name in paths:
+                    doc._replace([ _element_at(doc_root, path)
+                                   for path in paths[name] ],
+                                 _substitution_element(value))
+            docs.append(doc)
+        return docs
+
+    def index(self, rebuild=False):
+        """Return a MathIndex of the document for fast lookups of
+        identifiers, constants, operators and numbers.  The index is
+        built on first use and rebuilt after the tree was modified.
+        """
+        index = self._index
+        if rebuild or index is None or not index.is_current() or \
+               index.root is not self._etree.getroot():
+            index = self._index = MathIndex(self._etree.getroot(),
+                                            self._value_cache.typed_value)
+        return index
+
+    def serialize(self, output_format=None, converter=None, profile=None, **kwargs):
+        """Serialize to 'mathml' (default), 'pmathml', 'pmathml_native'
+        or any other supported term format.
+
+        For the XSLT based formats, pass profile=True (or an
+        XSLTProfile) to collect the template statistics of the run in
+        XSLT_PROFILE (or the given profile)."""
         if converter is None:
             if output_format is None:
                 output_format = 'mathml'
@@ -505,25 +1113,24 @@ class MathDOM(object):
                 out = io.BytesIO()
                 self.toMathml(out, False)
                 return out.getvalue()
+            elif output_format in DOM_SERIALIZERS:
+                return DOM_SERIALIZERS[output_format](self, **kwargs)
             elif output_format in STYLESHEET_TRANSFORMERS:
-                etree = self.xsltify(output_format, **kwargs)
+                etree = self.xsltify(output_format, _profile=profile, **kwargs)
                 out = io.BytesIO()
                 etree.write(out, encoding='UTF-8')
                 return out.getvalue()
-        return serialize_dom(self._etree, output_format, converter)
+        return serialize_dom(self._etree, output_format, converter,
+                             self._value_cache.typed_value)
 
     def xpath(self, expression, other_namespaces=None):
         """Evaluate an XPath expression against the MathDOM.  The
         'math' prefix will automatically be available for the MathML
         namespace.  If other namespaces are needed, the can be
-        specified as a {prefix : namespaceURI} dictionary.
+        specified as a {prefix : namespaceURI} dictionary.  Compiled
+        expressions are cached.
         """
-        if other_namespaces:
-            other_namespaces = other_namespaces.copy()
-            other_namespaces.update(_MATH_NS_DICT)
-        else:
-            other_namespaces = _MATH_NS_DICT
-        return self._etree.xpath(expression, namespaces=other_namespaces)
+        return _compiled_xpath(expression, other_namespaces)(self._etree)
 
     def xslt(self, stylesheet):
         "Run an XSLT stylesheet against the MathDOM."
@@ -546,6 +1153,7 @@ class MathDOM(object):
                 args = args[0]
             for child in args:
                 apply_tag.append(child)
+            _tree_modified(apply_tag)
         return apply_tag
 
     createFunction = createApply
@@ -579,6 +1187,7 @@ def Identifier(parent, name):
         parent = parent.getroot()
     ci_tag = SubElement(parent, '{%s}ci' % MATHML_NAMESPACE_URI)
     ci_tag.text = name
+    _tree_modified(parent)
     return ci_tag
 
 Name = Identifier
@@ -598,9 +1207,94 @@ def Apply(parent, name, *args):
             args = args[0]
         for child in args:
             apply_tag.append(child)
+    _tree_modified(parent)
     return apply_tag
 
 
+def _unpickle_mathdom(data):
+    return MathDOM(ElementTree(_etree.fromstring(data, _parser)))
+
+def _tree_to_etree(tree):
+    "Build an ElementTree from an AST."
+    content_handler = ElementTreeContentHandler(makeelement=Element)
+    SaxTerm(content_handler).tree_to_sax(tree)
+    return content_handler.etree
+
+def _substitution_element(value):
+    "Build a new element from a MathDOM.substitute() value."
+    if isinstance(value, MathDOM):
+        value = value.getroot()
+        if value.mathtype() == u'math':
+            value = value[0]
+    if isinstance(value, _etree._Element):
+        return deepcopy(value)
+    elif isinstance(value, (tuple, list)):
+        return _tree_to_etree(value).getroot()[0]
+    elif isinstance(value, basestring):
+        element = Element(_CI_TAG)
+        element.text = value
+    elif isinstance(value, bool):
+        element = Element(_tag_name(value and u'true' or u'false'))
+    else:
+        element = Element(_CN_TAG)
+        if isinstance(value, Decimal) and not hasattr(value, 'TYPE_NAME'):
+            element.set_value(value, 'real')
+        else:
+            element.set_value(value)
+    return element
+
+def _element_path(root, element):
+    "Return the child indices that lead from root to element."
+    path = []
+    while element is not root:
+        parent = element.getparent()
+        path.append(parent.index(element))
+        element = parent
+    path.reverse()
+    return path
+
+def _element_at(root, path):
+    element = root
+    for i in path:
+        element = element[i]
+    return element
+
+
+def xsltify_many(docs, _output_format, _threads=None, _use_cache=True,
+                 _profile=None, **kwargs):
+    """Run the XSLT stylesheets that produce _output_format over a
+    sequence of MathDOMs or elements, using _threads parallel threads
+    (default: one per CPU).  The threads are kept in a shared pool
+    between calls and each of them works with its own copies of the
+    stylesheets.  See SerializableMathElement.xsltify() for the
+    _use_cache and _profile options.
+
+    Returns a list of (result, exception) tuples in input order, where
+    either the result tree or the exception raised for the item is
+    None.
+    """
+    def xsltify(doc):
+        if isinstance(doc, MathDOM):
+            doc = doc.getroot()
+        xslts = _thread_transformers(_output_format)
+        try:
+            if _profile:
+                return (doc._xsltify(_output_format, kwargs, xslts, _profile), None)
+            elif _use_cache:
+                return (doc._cached_xsltify(_output_format, kwargs, xslts), None)
+            else:
+                return (doc._xsltify(_output_format, kwargs, xslts), None)
+        except Exception, e:
+            return (None, e)
+
+    docs = list(docs)
+    if _threads is None:
+        _threads = cpu_count()
+    if _threads <= 1 or len(docs) <= 1:
+        return map(xsltify, docs)
+    return _thread_pool(_threads).map(xsltify, docs)
+
+
 # serializer function for lxml.XSLT
 
 def xslt_serialize(_, nodes, output_type):
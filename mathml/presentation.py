@@ -0,0 +1,517 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+__doc__ = """
+Direct generator for Presentation MathML.
+
+This produces the same output as serializing the result of the
+mathmlc2p.xsl stylesheet, but only for the Content MathML subset that
+the term parsers generate: arithmetic, relations, logic, piecewise,
+intervals, lists and a few elementary functions.  It walks the content
+tree once and writes the serialized markup directly, which is much
+faster than running the XSLT.
+
+The output even reproduces the namespace declarations that libxslt
+adds.  Like the stylesheet, it keeps the entity references that the
+XSLT writes with disabled output escaping (like '&InvisibleTimes;').
+
+to_presentation() returns None for anything outside the subset, so
+that callers can fall back to the XSLT.
+
+>>> from mathml.lmathdom import MathDOM
+>>> from mathml.presentation import to_presentation
+>>> print to_presentation(MathDOM.fromString('a+3*b', 'infix_term'))
+<math xmlns="http://www.w3.org/1998/Math/MathML"><mrow><mi>a</mi><mo>+</mo><mrow><mn>3</mn><mo>&InvisibleTimes;</mo><mi>b</mi></mrow></mrow></math>
+>>> print to_presentation(MathDOM.fromString('sin(a)', 'infix_term'))
+None
+"""
+
+__all__ = ('to_presentation', 'presentation_fragment')
+
+from mathml import MATHML_NAMESPACE_URI
+
+
+_NAMESPACE = u'{%s}' % MATHML_NAMESPACE_URI
+
+_MATH_TAG      = _NAMESPACE + u'math'
+_CI_TAG        = _NAMESPACE + u'ci'
+_CN_TAG        = _NAMESPACE + u'cn'
+_APPLY_TAG     = _NAMESPACE + u'apply'
+_SEP_TAG       = _NAMESPACE + u'sep'
+_PIECE_TAG     = _NAMESPACE + u'piece'
+_OTHERWISE_TAG = _NAMESPACE + u'otherwise'
+_PLUS_TAG      = _NAMESPACE + u'plus'
+_MINUS_TAG     = _NAMESPACE + u'minus'
+_OR_TAG        = _NAMESPACE + u'or'
+_XOR_TAG       = _NAMESPACE + u'xor'
+
+# libxslt declares the 'm' prefix of the stylesheet on the literal
+# result elements that are direct children of an xsl:template, unless
+# it is already declared in the result tree
+_XMLNS_M = u' xmlns:m="%s"' % MATHML_NAMESPACE_URI
+
+_MATH_START = u'<math xmlns="%s">' % MATHML_NAMESPACE_URI
+
+_INVISIBLE_TIMES = u'<mo>&InvisibleTimes;</mo>'
+_IMAGINARY_I     = u'<mi>&ImaginaryI;</mi>'
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _escape(text):
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(
+        u'>', u'&gt;').replace(u'\r', u'&#13;')
+
+def _text(out, text):
+    if text:
+        out.append(_escape(text))
+
+def _first_text(element):
+    "The XPath value of 'text()': the first text node of the element."
+    if element.text is not None:
+        return element.text
+    for child in element:
+        if child.tail is not None:
+            return child.tail
+    return u''
+
+def _has_child(element, tag):
+    for child in element:
+        if child.tag == tag:
+            return True
+    return False
+
+def _is_negative_token(element):
+    return element.tag in (_CI_TAG, _CN_TAG) and u'-' in _first_text(element)
+
+def _start(out, tag, ns_declared, attributes=u''):
+    """Write a start tag and return its position.  The 'm' prefix gets
+    declared if ns_declared is false."""
+    out.append(u'<%s%s%s>' % (tag, attributes, not ns_declared and _XMLNS_M or u''))
+    return len(out) - 1
+
+def _end(out, start, tag):
+    "Write an end tag, or make the start tag empty if nothing follows it."
+    if len(out) == start + 1:
+        out[start] = out[start][:-1] + u'/>'
+    else:
+        out.append(u'</%s>' % tag)
+
+def _fenced(out, element, ns):
+    start = _start(out, u'mfenced', True, u' separators=""')
+    _emit(out, element, ns)
+    _end(out, start, u'mfenced')
+
+def _operands(element, count):
+    "Return the operands of an apply, which must be exactly count."
+    if len(element) != count + 1:
+        raise _Unsupported
+    return element[1:]
+
+
+# The emitters write the markup of an element to the out list.  The ns
+# argument tells if the 'm' prefix is already declared in the output.
+
+def _emit(out, element, ns):
+    tag = element.tag
+    if tag == _APPLY_TAG:
+        if not len(element):
+            raise _Unsupported
+        emitter = _OPERATORS.get(element[0].tag)
+    else:
+        emitter = _ELEMENTS.get(tag)
+    if emitter is None:
+        raise _Unsupported
+    emitter(out, element, ns)
+
+def _emit_ci(out, element, ns):
+    if len(element) or element.get('type') == u'vector':
+        raise _Unsupported
+    start = _start(out, u'mi', True)
+    _text(out, element.text)
+    _end(out, start, u'mi')
+
+def _emit_mn(out, text):
+    start = _start(out, u'mn', True)
+    _text(out, text)
+    _end(out, start, u'mn')
+
+def _emit_cn(out, element, ns):
+    if element.get('base') is not None:
+        raise _Unsupported
+    valuetype = element.get('type')
+    if valuetype in (u'complex', u'complex-cartesian', u'e-notation', u'rational'):
+        if len(element) != 1 or element[0].tag != _SEP_TAG or \
+               element.text is None or element[0].tail is None:
+            raise _Unsupported
+        first, second = element.text, element[0].tail
+        start = _start(out, u'mrow', True)
+        _emit_mn(out, first)
+        if valuetype == u'e-notation':
+            out.append(u'<mo>e</mo>')
+            _emit_mn(out, second)
+        elif valuetype == u'rational':
+            out.append(u'<mo>/</mo>')
+            _emit_mn(out, second)
+        elif u'-' in second:
+            out.append(u'<mo>-</mo>')
+            _emit_mn(out, second[1:])
+            out.append(_INVISIBLE_TIMES + _IMAGINARY_I)
+        else:
+            out.append(u'<mo>+</mo>')
+            _emit_mn(out, second)
+            out.append(_INVISIBLE_TIMES + _IMAGINARY_I)
+        _end(out, start, u'mrow')
+    elif valuetype == u'complex-polar' or len(element):
+        raise _Unsupported
+    else:
+        _emit_mn(out, element.text)
+
+def _constant(markup):
+    def emit(out, element, ns):
+        out.append(u'<mi%s>%s</mi>' % (not ns and _XMLNS_M or u'', markup))
+    return emit
+
+_CLOSURES = {
+    u'open-closed' : u' open="(" close="]"',
+    u'closed-open' : u' open="[" close=")"',
+    u'open'        : u' open="(" close=")"'
+    }
+
+def _emit_interval(out, element, ns):
+    if len(element) != 2:
+        raise _Unsupported
+    attributes = _CLOSURES.get(element.get('closure'), u' open="[" close="]"')
+    start = _start(out, u'mfenced', True, attributes)
+    _emit(out, element[0], ns)
+    _emit(out, element[1], ns)
+    _end(out, start, u'mfenced')
+
+def _emit_piecewise(out, element, ns):
+    pieces, otherwise = [], []
+    for child in element:
+        if child.tag == _PIECE_TAG and len(child) == 2:
+            pieces.append(child)
+        elif child.tag == _OTHERWISE_TAG:
+            otherwise.append(child)
+        else:
+            raise _Unsupported
+    start = _start(out, u'mrow', ns)
+    out.append(u'<mfenced open="{" close="">')
+    table = _start(out, u'mtable', True)
+    space = u'<mspace width="0.3em"/>'
+    for value, condition in pieces:
+        out.append(u'<mtr><mtd>')
+        _emit(out, value, True)
+        out.append(space + u'<m:mtext>if</m:mtext>' + space)
+        _emit(out, condition, True)
+        out.append(u'</mtd></mtr>')
+    if otherwise:
+        out.append(u'<mtr><mtd>')
+        for child in otherwise:
+            for value in child:
+                _emit(out, value, True)
+        out.append(space + u'<m:mtext>otherwise</m:mtext></mtd></mtr>')
+    _end(out, table, u'mtable')
+    out.append(u'</mfenced>')
+    _end(out, start, u'mrow')
+
+def _emit_list(out, element, ns):
+    start = _start(out, u'mrow', ns)
+    fence = _start(out, u'mfenced', True, u' open="[" close="]"')
+    for child in element:
+        _emit(out, child, True)
+    _end(out, fence, u'mfenced')
+    _end(out, start, u'mrow')
+
+
+# apply templates
+
+def _emit_plus(out, element, ns):
+    operands = element[1:]
+    if not operands:
+        out.append(u'<mo>+</mo>')
+        return
+    start = _start(out, u'mrow', True)
+    if len(operands) == 1:
+        out.append(u'<mo>+</mo>')
+        _emit(out, operands[0], ns)
+    else:
+        for i, operand in enumerate(operands):
+            if i:
+                out.append(u'<mo>+</mo>')
+            if _is_negative_token(operand) or (
+                operand.tag == _APPLY_TAG and _has_child(operand, _MINUS_TAG)):
+                _fenced(out, operand, ns)
+            else:
+                _emit(out, operand, ns)
+    _end(out, start, u'mrow')
+
+def _emit_minus(out, element, ns):
+    operands = element[1:]
+    if len(operands) not in (1,2):
+        raise _Unsupported
+    start = _start(out, u'mrow', ns)
+    if len(operands) == 2:
+        _emit(out, operands[0], True)
+    out.append(u'<mo>-</mo>')
+    operand = operands[-1]
+    if _is_negative_token(operand) or operand.tag == _APPLY_TAG:
+        _fenced(out, operand, True)
+    else:
+        _emit(out, operand, True)
+    _end(out, start, u'mrow')
+
+def _emit_times(out, element, ns):
+    operands = element[1:]
+    if not operands:
+        out.append(_INVISIBLE_TIMES)
+        return
+    start = _start(out, u'mrow', True)
+    if len(operands) == 1:
+        out.append(_INVISIBLE_TIMES)
+        if _is_negative_token(operands[0]):
+            _fenced(out, operands[0], ns)
+        else:
+            _emit(out, operands[0], ns)
+    else:
+        for i, operand in enumerate(operands):
+            if i:
+                out.append(_INVISIBLE_TIMES)
+            if _is_negative_token(operand) or _has_child(operand, _PLUS_TAG) \
+                   or _has_child(operand, _MINUS_TAG):
+                _fenced(out, operand, ns)
+            else:
+                _emit(out, operand, ns)
+    _end(out, start, u'mrow')
+
+def _emit_divide(out, element, ns):
+    if element.get('other') is not None:
+        raise _Unsupported
+    numerator, denominator = _operands(element, 2)
+    start = _start(out, u'mrow', ns)
+    out.append(u'<mfrac><mrow>')
+    _emit(out, numerator, True)
+    out.append(u'</mrow><mrow>')
+    _emit(out, denominator, True)
+    out.append(u'</mrow></mfrac>')
+    _end(out, start, u'mrow')
+
+def _emit_power(out, element, ns):
+    base, exponent = _operands(element, 2)
+    start = _start(out, u'msup', ns)
+    if base.tag == _APPLY_TAG:
+        _fenced(out, base, True)
+    else:
+        _emit(out, base, True)
+    _emit(out, exponent, True)
+    _end(out, start, u'msup')
+
+def _emit_rem(out, element, ns):
+    operands = _operands(element, 2)
+    start = _start(out, u'mrow', ns)
+    for i, operand in enumerate(operands):
+        if i:
+            out.append(u'<mo>mod</mo>')
+        if operand.tag == _APPLY_TAG:
+            _fenced(out, operand, True)
+        else:
+            _emit(out, operand, True)
+    _end(out, start, u'mrow')
+
+def _extremum(name):
+    def emit(out, element, ns):
+        start = _start(out, u'mrow', ns)
+        out.append(u'<mo>%s</mo><mrow><mo>{</mo>' % name)
+        fence = _start(out, u'mfenced', True, u' open="" close=""')
+        for operand in element[1:]:
+            _emit(out, operand, True)
+        _end(out, fence, u'mfenced')
+        out.append(u'<mo>}</mo></mrow>')
+        _end(out, start, u'mrow')
+    return emit
+
+def _emit_and(out, element, ns):
+    operands = element[1:]
+    start = _start(out, u'mrow', ns)
+    if len(operands) < 2:
+        out.append(u'<mo>&And;</mo>')
+        for operand in operands:
+            _emit(out, operand, True)
+    else:
+        for i, operand in enumerate(operands):
+            if i:
+                out.append(u'<mo>&And;</mo>')
+            if _has_child(operand, _OR_TAG) or _has_child(operand, _XOR_TAG):
+                _fenced(out, operand, True)
+            else:
+                _emit(out, operand, True)
+    _end(out, start, u'mrow')
+
+def _emit_not(out, element, ns):
+    operand, = _operands(element, 1)
+    start = _start(out, u'mrow', ns)
+    out.append(u'<mo>&Not;</mo>')
+    if operand.tag == _APPLY_TAG:
+        _fenced(out, operand, True)
+    else:
+        _emit(out, operand, True)
+    _end(out, start, u'mrow')
+
+def _emit_ln(out, element, ns):
+    operand, = _operands(element, 1)
+    start = _start(out, u'mrow', ns)
+    out.append(u'<mi>ln</mi><mo>&ApplyFunction;</mo>')
+    if operand.tag == _APPLY_TAG or _is_negative_token(operand):
+        _fenced(out, operand, True)
+    else:
+        _emit(out, operand, True)
+    _end(out, start, u'mrow')
+
+def _emit_exp(out, element, ns):
+    operand, = _operands(element, 1)
+    start = _start(out, u'msup', ns)
+    out.append(u'<mi>&ee;</mi>')
+    _emit(out, operand, True)
+    _end(out, start, u'msup')
+
+def _emit_abs(out, element, ns):
+    operand, = _operands(element, 1)
+    start = _start(out, u'mrow', ns)
+    out.append(u'<mo>|</mo>')
+    _emit(out, operand, True)
+    out.append(u'<mo>|</mo>')
+    _end(out, start, u'mrow')
+
+def _nary(operator):
+    "Operators that are written between their operands in an mrow."
+    operator = u'<mo>%s</mo>' % operator
+    def emit(out, element, ns):
+        start = _start(out, u'mrow', ns)
+        operands = element[1:]
+        if len(operands) < 2:
+            out.append(operator)
+        for i, operand in enumerate(operands):
+            if i:
+                out.append(operator)
+            _emit(out, operand, True)
+        _end(out, start, u'mrow')
+    return emit
+
+def _nary_relation(operator):
+    "Relations that are implemented as named templates."
+    operator = u'<mo>%s</mo>' % operator
+    def emit(out, element, ns):
+        operands = element[1:]
+        if not operands:
+            out.append(operator)
+            return
+        start = _start(out, u'mrow', True)
+        if len(operands) == 1:
+            out.append(operator)
+        for i, operand in enumerate(operands):
+            if i:
+                out.append(operator)
+            _emit(out, operand, ns)
+        _end(out, start, u'mrow')
+    return emit
+
+def _binary(operator):
+    "Binary operators that are written between their operands."
+    operator = u'<mo>%s</mo>' % operator
+    def emit(out, element, ns):
+        left, right = _operands(element, 2)
+        start = _start(out, u'mrow', ns)
+        _emit(out, left, True)
+        out.append(operator)
+        _emit(out, right, True)
+        _end(out, start, u'mrow')
+    return emit
+
+
+_ELEMENTS = {
+    _CI_TAG                     : _emit_ci,
+    _CN_TAG                     : _emit_cn,
+    _NAMESPACE + u'interval'    : _emit_interval,
+    _NAMESPACE + u'piecewise'   : _emit_piecewise,
+    _NAMESPACE + u'list'        : _emit_list
+    }
+for name, markup in ((u'true', u'true'), (u'false', u'false'),
+                     (u'pi', u'&pi;'), (u'exponentiale', u'&ee;'),
+                     (u'imaginaryi', u'&ImaginaryI;'), (u'notanumber', u'NaN'),
+                     (u'emptyset', u'&empty;'), (u'eulergamma', u'&gamma;'),
+                     (u'infinity', u'&infin;')):
+    _ELEMENTS[_NAMESPACE + name] = _constant(markup)
+
+_OPERATORS = {
+    u'plus'     : _emit_plus,
+    u'minus'    : _emit_minus,
+    u'times'    : _emit_times,
+    u'divide'   : _emit_divide,
+    u'power'    : _emit_power,
+    u'rem'      : _emit_rem,
+    u'max'      : _extremum(u'max'),
+    u'min'      : _extremum(u'min'),
+    u'and'      : _emit_and,
+    u'or'       : _nary(u'&Or;'),
+    u'xor'      : _nary(u'xor'),
+    u'not'      : _emit_not,
+    u'abs'      : _emit_abs,
+    u'exp'      : _emit_exp,
+    u'ln'       : _emit_ln,
+    u'eq'       : _nary_relation(u'='),
+    u'gt'       : _nary_relation(u'&gt;'),
+    u'lt'       : _nary_relation(u'&lt;'),
+    u'geq'      : _nary_relation(u'&GreaterEqual;'),
+    u'leq'      : _nary_relation(u'&LessEqual;'),
+    u'neq'      : _binary(u'&NotEqual;'),
+    u'in'       : _binary(u'&isin;'),
+    u'notin'    : _binary(u'&notin;'),
+    u'factorof' : _binary(u'|')
+    }
+_OPERATORS = dict((_NAMESPACE + name, emitter)
+                  for name, emitter in _OPERATORS.iteritems())
+del name, markup
+
+
+def to_presentation(tree):
+    """Convert a MathDOM, ElementTree or 'math' element to serialized
+    Presentation MathML (a UTF-8 encoded byte string).  Returns None if
+    the tree uses anything that is not supported."""
+    try:
+        root = tree.getroot()
+    except AttributeError:
+        root = tree
+    if root.tag != _MATH_TAG:
+        return None
+    out = [_MATH_START]
+    try:
+        _text(out, root.text)
+        for child in root:
+            _emit(out, child, False)
+            _text(out, child.tail)
+    except _Unsupported:
+        return None
+    if len(out) == 1:
+        out[0] = out[0][:-1] + u'/>'
+    else:
+        out.append(u'</math>')
+    return u''.join(out).encode('UTF-8')
+
+def presentation_fragment(element, ns=True):
+    """Return the Presentation MathML of a single content element as
+    a unicode string, as it appears inside of to_presentation() output.
+    Pass ns=False for elements directly below the 'math' root.  Returns
+    None if the element is not supported."""
+    out = []
+    try:
+        _emit(out, element, ns)
+    except _Unsupported:
+        return None
+    return u''.join(out)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
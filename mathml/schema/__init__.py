@@ -1,7 +1,10 @@
 import os, re
+from io import BytesIO
 from os import path
 from lxml.etree import tostring, parse, RelaxNG, XMLSchema, XSLT, ElementTree, XML
 
+from mathml.utils import LazyDict
+
 __all__ = ['SCHEMAS']
 
 __RE_SCHEMA_FILE = re.compile('.*\.(rng|xsd)(\.gz)?$', re.I)
@@ -11,6 +14,9 @@ schema_files = [ filename for filename in os.listdir(schema_dir)
                  if __RE_SCHEMA_FILE.match(filename) ]
 
 
+# compiled RelaxNG validators, keyed by schema tree and start symbol
+_RELAXNG_CACHE = {}
+
 class RelocatableRelaxNG(object):
     _relocate_xslt = XSLT(XML('''\
     <xsl:stylesheet version="1.0"
@@ -36,31 +42,50 @@ class RelocatableRelaxNG(object):
         self._tree  = tree
         self._start = start
 
-    def validate(self, xml_tree):
+    def relaxng(self):
+        """Return the compiled RelaxNG validator for the current start
+        symbol.  Validators are shared by all copies of the schema."""
+        key = (self._tree, self._start)
+        try:
+            return _RELAXNG_CACHE[key]
+        except KeyError:
+            pass
         if self._start is None:
             rng_tree = self._tree
         else:
             rng_tree = self._relocate_xslt(self._tree,
                                            newref="'%s'" % self._start)
             # ugly hack to get around namespace (?) issues
-            rng_tree = parse(StringIO(str(rng_tree)))
-        rng = RelaxNG(rng_tree)
-        self.validate = rng.validate # replace the object method by the real thing
-        return rng.validate(xml_tree)
+            rng_tree = parse(BytesIO(str(rng_tree)))
+        rng = _RELAXNG_CACHE[key] = RelaxNG(rng_tree)
+        return rng
+
+    def validate(self, xml_tree):
+        return self.relaxng().validate(xml_tree)
+
+    def validate_many(self, xml_trees):
+        """Validate a sequence of trees against the same validator.
+        Returns a list of error logs, which are empty for valid trees.
+        """
+        rng = self.relaxng()
+        validate = rng.validate
+        error_logs = []
+        for xml_tree in xml_trees:
+            validate(xml_tree)
+            error_logs.append(rng.error_log)
+        return error_logs
 
     def copy(self, start=None):
         return self.__class__(self._tree, start)
 
     def relocate(self, start):
         self._start = start
-        try: del self.validate
-        except AttributeError: pass
 
 
-class SchemaDict(dict):
+class SchemaDict(LazyDict):
+    "Dictionary of the bundled schemas, parsed on first access."
     def __init__(self):
-        dict.__init__(self)
-        self.BROKEN = {}
+        LazyDict.__init__(self)
         for filename in schema_files:
             file_path = path.join(schema_dir, filename)
             name, ext = path.splitext(filename)
@@ -68,13 +93,16 @@ class SchemaDict(dict):
             while ext == '.gz':
                 name, ext = path.splitext(name)
                 ext = ext.lower()
-            try:
-                tree = parse(file_path)
-                if 'xsd' in ext:
-                    self[name] = XMLSchema(tree)
-                else:
-                    self[name] = RelocatableRelaxNG(tree)
-            except Exception, e:
-                self.BROKEN[name] = e
+            self.register_loader(name, self._loader(file_path, ext))
+
+    @staticmethod
+    def _loader(file_path, ext):
+        def load():
+            tree = parse(file_path)
+            if 'xsd' in ext:
+                return XMLSchema(tree)
+            else:
+                return RelocatableRelaxNG(tree)
+        return load
 
 SCHEMAS = SchemaDict()
@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+__doc__ = """
+Compact binary encoding of term ASTs.
+
+The encoding writes the AST in prefix order.  Operators from the
+vocabulary in mathml/__init__.py are single byte tag codes, followed by
+the number of operands.  Integers are zigzag varints.  Decimal,
+ENotation, Rational and Complex values are stored exactly, including
+their written form (like '1.50').  Repeated names are written as
+references to their first occurrence.
+
+The encoding is meant for exchanging ASTs, where decoding is faster
+than parsing MathML and building the AST from it.  For MathDOM
+documents, lxml's C serializer and parser are faster than any detour
+through the AST, so use MathML for them.
+
+>>> from mathml.termparser import term_parsers
+>>> from mathml.termbinary import tree_to_binary, tree_from_binary
+>>> tree = term_parsers['infix_term'].parse('a*x^2 + 1.50*a - 1/3 + 1E-3*(2-5i)')
+>>> data = tree_to_binary(tree)
+>>> len(data)
+44
+>>> tree_from_binary(data) == tree
+True
+
+tree_from_binary() reads from any buffer (like a memoryview of a
+larger message) without copying it.
+
+>>> tree_from_binary(memoryview(data)) == tree
+True
+"""
+
+__all__ = ('tree_to_binary', 'tree_from_binary', 'BinaryFormatError',
+           'MAGIC', 'OPERATORS')
+
+from mathml           import FUNCTIONS, RELATIONS
+from mathml.datatypes import Decimal, Complex, Rational, ENotation, \
+     number_str, complex_strs
+
+MAGIC = 'MB\x01'
+
+# AST spellings of the operators, the position is the tag code
+OPERATORS = []
+for _operator in (u'+ - * / % ^ | = <> != > >= <= < case list '
+                  u'interval:closed interval:open '
+                  u'interval:closed-open interval:open-closed ' +
+                  FUNCTIONS + RELATIONS).split():
+    if _operator not in OPERATORS:
+        OPERATORS.append(_operator)
+OPERATORS = tuple(OPERATORS)
+del _operator
+
+(_NAME, _NAME_REF, _INTEGER, _REAL, _ENOTATION, _RATIONAL, _COMPLEX,
+ _TRUE, _FALSE, _STRING, _OPERATOR) = range(11)
+_FIRST_OPERATOR_CODE = 16
+
+_OPERATOR_CODES = dict( (operator, code)
+                        for code, operator in enumerate(OPERATORS, _FIRST_OPERATOR_CODE) )
+_CODE_OPERATORS = dict( (code, operator)
+                        for operator, code in _OPERATOR_CODES.iteritems() )
+
+
+class BinaryFormatError(ValueError):
+    "Raised for invalid binary data."
+
+
+# encoding
+
+_VARINTS = [ chr(i) for i in xrange(128) ]
+
+def _write_varint(out, value):
+    if value < 128:
+        out.append(_VARINTS[value])
+        return
+    data = []
+    while value >= 128:
+        data.append(chr(value & 127 | 128))
+        value >>= 7
+    data.append(chr(value))
+    out.append(''.join(data))
+
+def _write_signed(out, value):
+    if value >= 0:
+        _write_varint(out, value << 1)
+    else:
+        _write_varint(out, (-value << 1) - 1)
+
+def _write_text(out, text):
+    if isinstance(text, unicode):
+        text = text.encode('UTF-8')
+    _write_varint(out, len(text))
+    out.append(text)
+
+def _write_decimal(out, text):
+    "Write a decimal number, keeping its written form."
+    text = unicode(text)
+    value = Decimal(text)
+    if value.is_finite() and unicode(value) == text:
+        sign, digits, exponent = value.as_tuple()
+        coefficient = int(''.join(map(str, digits)))
+        _write_varint(out, coefficient << 2 | sign << 1)
+        _write_signed(out, exponent)
+    else:
+        text = text.encode('UTF-8')
+        _write_varint(out, len(text) << 2 | 1)
+        out.append(text)
+
+def _write_tree(out, tree, names):
+    operator = tree[0]
+    if operator == u'name':
+        name = tree[1]
+        try:
+            index = names[name]
+        except KeyError:
+            names[name] = len(names)
+            out.append(_VARINTS[_NAME])
+            _write_text(out, name)
+        else:
+            out.append(_VARINTS[_NAME_REF])
+            _write_varint(out, index)
+    elif operator[:6] == u'const:':
+        value = tree[1]
+        if operator == u'const:integer':
+            out.append(_VARINTS[_INTEGER])
+            _write_signed(out, value)
+        elif operator == u'const:real':
+            out.append(_VARINTS[_REAL])
+            _write_decimal(out, number_str(value))
+        elif operator == u'const:enotation':
+            out.append(_VARINTS[_ENOTATION])
+            _write_decimal(out, value.num_str)
+            _write_signed(out, value.exponent)
+        elif operator == u'const:rational':
+            out.append(_VARINTS[_RATIONAL])
+            _write_signed(out, value.num)
+            _write_signed(out, value.denom)
+        elif operator == u'const:complex':
+            out.append(_VARINTS[_COMPLEX])
+            real_str, imag_str = complex_strs(value)
+            _write_decimal(out, real_str)
+            _write_decimal(out, imag_str)
+        elif operator == u'const:bool':
+            out.append(_VARINTS[value and _TRUE or _FALSE])
+        elif operator == u'const:string':
+            out.append(_VARINTS[_STRING])
+            _write_text(out, value)
+        else:
+            raise ValueError, "Unsupported AST leaf node '%s'" % operator
+    else:
+        code = _OPERATOR_CODES.get(operator)
+        if code is None:
+            out.append(_VARINTS[_OPERATOR])
+            _write_text(out, operator)
+        else:
+            _write_varint(out, code)
+        _write_varint(out, len(tree) - 1)
+        for operand in tree[1:]:
+            _write_tree(out, operand, names)
+
+def tree_to_binary(tree):
+    "Encode an AST as a byte string."
+    out = [MAGIC]
+    _write_tree(out, tree, {})
+    return ''.join(out)
+
+
+# decoding
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos  = 0
+        self.names = []
+
+    def byte(self):
+        pos = self.pos
+        try:
+            byte = ord(self.data[pos])
+        except IndexError:
+            raise BinaryFormatError, "Unexpected end of data"
+        self.pos = pos + 1
+        return byte
+
+    def varint(self):
+        byte = self.byte()
+        if byte < 128:
+            return byte
+        value, shift = byte & 127, 7
+        while True:
+            byte = self.byte()
+            value |= (byte & 127) << shift
+            if byte < 128:
+                return value
+            shift += 7
+
+    def signed(self):
+        value = self.varint()
+        if value & 1:
+            return -(value >> 1) - 1
+        return value >> 1
+
+    def raw(self, length):
+        start = self.pos
+        end = self.pos = start + length
+        if end > len(self.data):
+            raise BinaryFormatError, "Unexpected end of data"
+        return self.data[start:end].tobytes()
+
+    def text(self):
+        return self.raw(self.varint()).decode('UTF-8')
+
+    def decimal(self):
+        head = self.varint()
+        if head & 1:
+            return Decimal(self.raw(head >> 2).decode('UTF-8'))
+        exponent = self.signed()
+        return Decimal(u'%s%dE%d' % (head & 2 and u'-' or u'', head >> 2, exponent))
+
+    def decimal_text(self):
+        "Read the written form of a decimal number."
+        head = self.varint()
+        if head & 1:
+            return self.raw(head >> 2).decode('UTF-8')
+        exponent = self.signed()
+        return unicode(Decimal(u'%s%dE%d' % (head & 2 and u'-' or u'', head >> 2, exponent)))
+
+    def tree(self):
+        code = self.byte()
+        if code == _NAME:
+            name = self.text()
+            self.names.append(name)
+            return (u'name', name)
+        elif code == _NAME_REF:
+            try:
+                return (u'name', self.names[self.varint()])
+            except IndexError:
+                raise BinaryFormatError, "Invalid name reference"
+        elif code == _INTEGER:
+            return (u'const:integer', self.signed())
+        elif code == _REAL:
+            return (u'const:real', self.decimal())
+        elif code == _ENOTATION:
+            num = self.decimal_text()
+            return (u'const:enotation', ENotation(num, self.signed()))
+        elif code == _RATIONAL:
+            num = self.signed()
+            return (u'const:rational', Rational(num, self.signed()))
+        elif code == _COMPLEX:
+            real = self.decimal_text()
+            return (u'const:complex', Complex(real, self.decimal_text()))
+        elif code == _TRUE:
+            return (u'const:bool', True)
+        elif code == _FALSE:
+            return (u'const:bool', False)
+        elif code == _STRING:
+            return (u'const:string', self.text())
+        elif code == _OPERATOR:
+            operator = self.text()
+        else:
+            try:
+                operator = _CODE_OPERATORS[code]
+            except KeyError:
+                raise BinaryFormatError, "Invalid tag code %d" % code
+        tree = self.tree
+        return (operator,) + tuple( tree() for i in xrange(self.varint()) )
+
+def tree_from_binary(data):
+    """Decode an AST from a byte string or any other buffer, like a
+    memoryview."""
+    reader = _Reader(data)
+    if reader.raw(len(MAGIC)) != MAGIC:
+        raise BinaryFormatError, "Not a binary encoded term"
+    tree = reader.tree()
+    if reader.pos != len(reader.data):
+        raise BinaryFormatError, "Trailing data after the term"
+    return tree
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -18,7 +18,8 @@ except ImportError:
 
 from itertools import *
 
-from mathml.termparser import (ConverterRegistry,
+from mathml.datatypes  import number_str, complex_strs
+from mathml.termparser import (ConverterRegistry, LiteralList,
                                TERM_OPERATOR_ORDER, BOOL_CMP_OPERATORS)
 
 class TermBuilder(object):
@@ -30,6 +31,12 @@ class TermBuilder(object):
 
     _OPERATOR_MAP = {}
 
+    # Builders that set this to True convert the integers and reals of
+    # a LiteralList directly with unicode() and number_str() instead of
+    # dispatching each value to its const handler.  Subclasses that
+    # change how these numbers are written must set it back to False.
+    DIRECT_LITERAL_LISTS = False
+
     def __init__(self):
         self.__dispatcher = self._register_handlers({})
         self.__map_operator = self._OPERATOR_MAP.get
@@ -64,6 +71,13 @@ class TermBuilder(object):
         return [ ' '.join(operand)
                  for operand in imap(self._recursive_build, children, repeat(status)) ]
 
+    def _build_literal_list(self, tree, status):
+        "Build the items of a LiteralList."
+        build = self._recursive_build
+        const_type = tree.const_type
+        return [ ' '.join(build((const_type, value), status))
+                 for value in tree.values ]
+
     def _handle(self, operator, operands, status):
         "Unknown operators (including functions) end up here."
         raise NotImplementedError, "_handle(%s)" % operator
@@ -75,7 +89,10 @@ class TermBuilder(object):
     def _recursive_build(self, tree, status):
         dispatcher = self.__dispatcher
         operator = tree[0]
-        operands = self._build_children(operator, tree[1:], status)
+        if type(tree) is LiteralList:
+            operands = self._build_literal_list(tree, status)
+        else:
+            operands = self._build_children(operator, tree[1:], status)
 
         dispatch_name = operator.replace(u':', u'_') # const:*, list:*
 
@@ -115,7 +132,8 @@ class LiteralTermBuilder(TermBuilder):
 
     def _handle_const_complex(self, operator, operands, status):
         value = operands[0]
-        return [ u'(%s%s%si)' % (value.real_str, (value.imag >= 0) and '+' or '', value.imag_str) ]
+        real_str, imag_str = complex_strs(value)
+        return [ u'(%s%s%si)' % (real_str, (value.imag >= 0) and '+' or '', imag_str) ]
 
     def _handle_const_rational(self, operator, operands, status):
         value = operands[0]
@@ -125,7 +143,15 @@ class LiteralTermBuilder(TermBuilder):
         return [ unicode(operands[0]) ]
 
     def _handle_const(self, operator, operands, status):
-        return [ unicode(str(operands[0]).lower(), 'ascii') ]
+        return [ number_str(operands[0]).lower() ]
+
+    def _build_literal_list(self, tree, status):
+        "Convert the values directly if the builder opts in."
+        if not self.DIRECT_LITERAL_LISTS:
+            return super(LiteralTermBuilder, self)._build_literal_list(tree, status)
+        if tree.const_type == u'const:integer':
+            return map(unicode, tree.values)
+        return [ number_str(value).lower() for value in tree.values ]
 
     def _handle_list(self, operator, operands, status):
         assert operator == u'list'
@@ -138,6 +164,7 @@ class LiteralTermBuilder(TermBuilder):
 
 class InfixTermBuilder(LiteralTermBuilder):
     "TermBuilder that converts the parse tree into a literal infix term."
+    DIRECT_LITERAL_LISTS = True
     MAX_AFFIN = len(TermBuilder.OPERATOR_ORDER)+1
     __operator_order = TermBuilder.OPERATOR_ORDER.index
     def _init_build_status(self):
@@ -189,6 +216,7 @@ class InfixTermBuilder(LiteralTermBuilder):
 
 class PostfixTermBuilder(LiteralTermBuilder):
     "TermBuilder that converts the parse tree into a literal postfix term."
+    DIRECT_LITERAL_LISTS = True
     def _handle_case(self, operator, operands, _):
         assert operator == 'case'
         if len(operands) > 2:
@@ -205,6 +233,7 @@ class PostfixTermBuilder(LiteralTermBuilder):
 
 class PrefixTermBuilder(LiteralTermBuilder):
     "TermBuilder that converts the parse tree into a literal prefix term."
+    DIRECT_LITERAL_LISTS = True
     def _handle_case(self, operator, operands, _):
         assert operator == 'case'
         if len(operands) > 2:
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+__doc__ = """
+Semantic fingerprints of terms by randomized modular evaluation.
+
+A TermFingerprinter evaluates a term at a fixed set of pseudo-random
+points, using exact arithmetic modulo the prime PRIME.  Each variable
+is replaced by pseudo-random numbers that are derived from its name, so
+equivalent terms like '2*(a+b)' and '2*a+2*b' get the same fingerprint,
+while different terms only collide with negligible probability.
+
+Addition, subtraction, multiplication, division and integer powers are
+evaluated.  All other operators are opaque functions: their results
+are pseudo-random numbers derived from the operator and the values of
+their operands.  'sin(a+b)' and 'sin(b+a)' are therefore the same, but
+'sin(a)+sin(b)' and 'sin(a+b)' are not.  The operands of symmetric
+functions like max() or 'and' are unordered.  The imaginary unit is
+treated as a variable of its own, unrelated to the name 'i'.
+
+>>> from mathml.termparser import term_parsers
+>>> from mathml.termfingerprint import fingerprint, bucket_terms
+>>> parse = term_parsers['infix_term'].parse
+>>> fingerprint(parse('2*(a+b)')) == fingerprint(parse('2*a+2*b'))
+True
+>>> fingerprint(parse('(a+b)^2/4')) == fingerprint(parse('0.25*a*a + a*b/2 + 0.25*b^2'))
+True
+>>> fingerprint(parse('max(a,b) - 1')) == fingerprint(parse('-1 + max(b,a)'))
+True
+>>> fingerprint(parse('2*(a+b)')) == fingerprint(parse('2*a+b'))
+False
+
+bucket_terms() groups a corpus of (id, term) pairs by fingerprint:
+
+>>> terms = [ (1, parse('a*(b+c)')), (2, parse('a*b+c')), (3, parse('c*a+a*b')) ]
+>>> sorted( bucket_terms(terms).values() )
+[[1, 3], [2]]
+"""
+
+__all__ = ('TermFingerprinter', 'fingerprint', 'fingerprint_many',
+           'bucket_terms', 'near_duplicates', 'PRIME', 'MAX_POINTS')
+
+from hashlib import sha512
+from struct  import Struct
+from decimal import Decimal
+from itertools import imap
+from collections import OrderedDict
+
+from mathml import NARY_ARITHMETIC_FUNCTIONS, NARY_STATISTICAL_FUNCTIONS, \
+     NARY_LOGICAL_FUNCTIONS, BINARY_RELATIONS
+from mathml.datatypes import number_str, complex_strs
+
+PRIME = 2**61 - 1
+
+MAX_POINTS = sha512().digest_size // 8
+
+_INVERSE_TEN = pow(10, PRIME-2, PRIME)
+
+_HASH_STRUCT = Struct('>%dQ' % MAX_POINTS)
+
+# opaque functions that do not depend on the order of their operands
+_SYMMETRIC_OPERATORS = frozenset(
+    (NARY_ARITHMETIC_FUNCTIONS + NARY_STATISTICAL_FUNCTIONS +
+     NARY_LOGICAL_FUNCTIONS + BINARY_RELATIONS).split() +
+    [u'=', u'<>', u'!=']
+    ) - frozenset([u'plus', u'times', u'factorof'])
+
+_OPERATOR_ALIASES = {
+    u'!=' : u'<>',
+    u'neq': u'<>',
+    u'eq' : u'=',
+    }
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('UTF-8')
+    return value
+
+def _inverse(value):
+    return pow(value, PRIME-2, PRIME)
+
+def _inverse_all(values):
+    "Invert non-zero residues with a single modular exponentiation."
+    products = [1]
+    for value in values:
+        products.append(products[-1] * value % PRIME)
+    inverse = _inverse(products[-1])
+    inverses = []
+    for i in xrange(len(values)-1, -1, -1):
+        inverses.append(inverse * products[i] % PRIME)
+        inverse = inverse * values[i] % PRIME
+    inverses.reverse()
+    return inverses
+
+def _decimal(value, scale=0):
+    "Residue of a finite Decimal times 10^scale, or None."
+    value = Decimal(value)
+    if not value.is_finite():
+        return None
+    sign, digits, exponent = value.as_tuple()
+    residue = int(''.join(map(str, digits)) or '0')
+    if sign:
+        residue = -residue
+    exponent += scale
+    if exponent >= 0:
+        return residue * pow(10, exponent, PRIME) % PRIME
+    else:
+        return residue * pow(_INVERSE_TEN, -exponent, PRIME) % PRIME
+
+
+class TermFingerprinter(object):
+    """Evaluates ASTs at 'points' pseudo-random points (up to
+    MAX_POINTS).  Different seeds select different points.
+
+    Instances keep an LRU cache of the values of up to cache_size
+    names, so reuse them for a corpus.
+    """
+    def __init__(self, points=4, seed='', cache_size=10000):
+        if not 0 < points <= MAX_POINTS:
+            raise ValueError, "points must be between 1 and %d" % MAX_POINTS
+        self.points = points
+        self.seed   = _text(seed)
+        self.cache_size = cache_size
+        self._struct = Struct('>%dQ' % points)
+        self._name_values = OrderedDict()
+        self._imaginary_unit = self._random(u'const:complex', u'i')
+        self._evaluators = {
+            u'+' : self._plus,
+            u'-' : self._minus,
+            u'*' : self._times,
+            u'/' : self._divide,
+            u'^' : self._power,
+            }
+
+    def _hash(self, data):
+        "Pseudo-random values derived from a string."
+        values = _HASH_STRUCT.unpack(sha512(self.seed + '\0' + data).digest())
+        return tuple( value % PRIME for value in values[:self.points] )
+
+    def _random(self, kind, value):
+        "Pseudo-random values of a name or literal."
+        return self._hash('%s\0%s' % (_text(kind), _text(value)))
+
+    def _name(self, name):
+        "Cached pseudo-random values of a name."
+        name_values = self._name_values
+        values = name_values.pop(name, None)
+        if values is None:
+            values = self._random(u'name', name)
+            if len(name_values) >= self.cache_size:
+                name_values.popitem(last=False)
+        name_values[name] = values
+        return values
+
+    def _constant(self, residue):
+        if residue is None:
+            return None
+        return (residue,) * self.points
+
+    def _leaf(self, operator, value):
+        if operator == u'name':
+            return self._name(value)
+        elif operator == u'const:integer':
+            values = self._constant(int(value) % PRIME)
+        elif operator == u'const:real':
+            values = self._constant(_decimal(number_str(value)))
+        elif operator == u'const:enotation':
+            values = self._constant(_decimal(value.num_str, value.exponent))
+        elif operator == u'const:rational':
+            if value.denom % PRIME == 0:
+                values = None
+            else:
+                values = self._constant(
+                    value.num * _inverse(value.denom % PRIME) % PRIME)
+        elif operator == u'const:complex':
+            real, imag = map(_decimal, complex_strs(value))
+            if real is None or imag is None:
+                values = None
+            else:
+                # the imaginary unit has a random value of its own that
+                # neither names nor complex literals (like '(3+2j)') share
+                values = tuple( (real + imag * i) % PRIME
+                                for i in self._imaginary_unit )
+        elif operator in (u'const:bool', u'const:string'):
+            values = None
+        else:
+            raise ValueError, "Unsupported AST leaf node '%s'" % operator
+        if values is None:
+            return self._random(operator, unicode(value))
+        return values
+
+    def _opaque(self, operator, operands):
+        operator = _OPERATOR_ALIASES.get(operator, operator)
+        if operator in _SYMMETRIC_OPERATORS:
+            operands = sorted(operands)
+        pack = self._struct.pack
+        return self._hash('%s\0%s' % (
+            _text(operator), ''.join( pack(*values) for values in operands )))
+
+    def _plus(self, operands, tree):
+        return tuple( sum(column) % PRIME for column in zip(*operands) )
+
+    def _minus(self, operands, tree):
+        if len(operands) == 1:
+            return tuple( -value % PRIME for value in operands[0] )
+        return tuple( (column[0] - sum(column[1:])) % PRIME
+                      for column in zip(*operands) )
+
+    def _times(self, operands, tree):
+        values = operands[0]
+        for other in operands[1:]:
+            values = [ value * other_value % PRIME
+                       for value, other_value in zip(values, other) ]
+        return tuple(values)
+
+    def _divide(self, operands, tree):
+        divisor = self._times(operands[1:], tree)
+        if 0 in divisor:
+            return None
+        return tuple( value * inverse % PRIME
+                      for value, inverse in zip(operands[0], _inverse_all(divisor)) )
+
+    def _power(self, operands, tree):
+        if len(tree) != 3 or tree[2][0] != u'const:integer':
+            return None
+        exponent = int(tree[2][1])
+        base = operands[0]
+        if exponent < 0:
+            if 0 in base:
+                return None
+            base = _inverse_all(base)
+            exponent = -exponent
+        return tuple( pow(value, exponent, PRIME) for value in base )
+
+    def evaluate(self, tree):
+        """Return the tuple of residues of an AST at the evaluation
+        points."""
+        operator = tree[0]
+        if operator == u'name' or operator[:6] == u'const:':
+            return self._leaf(operator, tree[1])
+        operands = [ self.evaluate(operand) for operand in tree[1:] ]
+        evaluator = self._evaluators.get(operator)
+        if evaluator is not None:
+            values = evaluator(operands, tree)
+            if values is not None:
+                return values
+        return self._opaque(operator, operands)
+
+    def fingerprint(self, term):
+        """Return the fingerprint of an AST, MathDOM or element as a
+        byte string of 8 bytes per point."""
+        try:
+            tree = term.to_tree()
+        except AttributeError:
+            tree = term
+        return self._struct.pack(*self.evaluate(tree))
+
+
+_DEFAULT_FINGERPRINTER = TermFingerprinter()
+
+def fingerprint(term):
+    "Return the fingerprint of an AST, MathDOM or element."
+    return _DEFAULT_FINGERPRINTER.fingerprint(term)
+
+def fingerprint_many(terms, fingerprinter=None):
+    "Iterate over the fingerprints of a sequence of terms."
+    if fingerprinter is None:
+        fingerprinter = TermFingerprinter()
+    return imap(fingerprinter.fingerprint, terms)
+
+def bucket_terms(items, fingerprinter=None):
+    """Group an iterable of (id, term) pairs by fingerprint.  Returns a
+    dict that maps fingerprints to the lists of IDs."""
+    if fingerprinter is None:
+        fingerprinter = TermFingerprinter()
+    fingerprint = fingerprinter.fingerprint
+    buckets = {}
+    for term_id, term in items:
+        key = fingerprint(term)
+        try:
+            buckets[key].append(term_id)
+        except KeyError:
+            buckets[key] = [term_id]
+    return buckets
+
+def near_duplicates(items, fingerprinter=None):
+    """Return the lists of IDs of equivalent terms in an iterable of
+    (id, term) pairs, leaving out terms without duplicates."""
+    return [ ids for ids in bucket_terms(items, fingerprinter).itervalues()
+             if len(ids) > 1 ]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+__doc__ = """
+Canonical structural hashing of term ASTs.
+
+tree_digest() computes a binary SHA-1 digest of an AST bottom-up, from
+the operator and the digests of its operands.  It does not depend on
+how the term was written or parsed, so the same term gives the same
+digest whether it was parsed from infix notation or read from MathML.
+Numbers are hashed by their normalized values, so '1.50' and '1.5' are
+the same real number.  The digests are stable across processes and
+Python versions.
+
+With commutative=True, the operands of the commutative operators
+(COMMUTATIVE_OPERATORS) are sorted, so that 'a+b' and 'b+a' share a
+digest.
+
+>>> from mathml.termparser import term_parsers
+>>> from mathml.termhash import tree_digest
+>>> parse = term_parsers['infix_term'].parse
+>>> tree_digest(parse('a+b')) == tree_digest(parse('(a)+(b)'))
+True
+>>> tree_digest(parse('a+b*1.50')) == tree_digest(parse('b*1.5+a'))
+False
+>>> tree_digest(parse('a+b*1.50'), True) == tree_digest(parse('b*1.5+a'), True)
+True
+>>> len(tree_digest(parse('a+b')))
+20
+"""
+
+__all__ = ('tree_digest', 'COMMUTATIVE_OPERATORS', 'DIGEST_SIZE')
+
+from hashlib import sha1
+from struct  import pack
+from decimal import Decimal
+
+from mathml.datatypes import number_str, complex_strs
+
+COMMUTATIVE_OPERATORS = frozenset([u'+', u'*', u'and', u'or', u'='])
+
+DIGEST_SIZE = sha1().digest_size
+
+
+def _decimal(value, scale=0):
+    """Canonical string of a decimal number (times 10^scale), exact
+    and independent of the decimal context."""
+    value = Decimal(value)
+    if not value.is_finite():
+        return str(value)
+    sign, digits, exponent = value.as_tuple()
+    digits = ''.join(map(str, digits)).lstrip('0')
+    if not digits:
+        return '0'
+    stripped = digits.rstrip('0')
+    exponent += scale + len(digits) - len(stripped)
+    return '%s%sE%d' % (sign and '-' or '', stripped, exponent)
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+def _rational(value):
+    num, denom = value.num, value.denom
+    if denom < 0:
+        num, denom = -num, -denom
+    divisor = _gcd(abs(num), denom) or 1
+    return '%d/%d' % (num // divisor, denom // divisor)
+
+def _complex(value):
+    return '%s,%s' % tuple(map(_decimal, complex_strs(value)))
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('UTF-8')
+    return value
+
+_LEAF_ENCODERS = {
+    u'name'            : _text,
+    u'const:string'    : _text,
+    u'const:integer'   : lambda value : str(int(value)),
+    u'const:real'      : lambda value : _decimal(number_str(value)),
+    u'const:enotation' : lambda value : _decimal(value.num_str, value.exponent),
+    u'const:rational'  : _rational,
+    u'const:complex'   : _complex,
+    u'const:bool'      : lambda value : value and '1' or '0'
+    }
+
+
+def _leaf_digest(operator, value):
+    encode = _LEAF_ENCODERS.get(operator)
+    if encode is None:
+        raise ValueError, "Unsupported AST leaf node '%s'" % operator
+    operator = _text(operator)
+    value = encode(value)
+    return sha1('L%s%s%s' % (pack('>H', len(operator)), operator, value)).digest()
+
+def _node_digest(tree, commutative):
+    operator = tree[0]
+    if operator == u'name' or operator[:6] == u'const:':
+        return _leaf_digest(operator, tree[1])
+    digests = [ _node_digest(operand, commutative) for operand in tree[1:] ]
+    if commutative and operator in COMMUTATIVE_OPERATORS:
+        digests.sort()
+    operator = _text(operator)
+    return sha1('N%s%s%s' % (pack('>H', len(operator)), operator,
+                             ''.join(digests))).digest()
+
+def tree_digest(tree, commutative=False):
+    """Return the binary digest (DIGEST_SIZE bytes) of an AST.  Pass
+    commutative=True to ignore the order of the operands of the
+    COMMUTATIVE_OPERATORS."""
+    return _node_digest(tree, commutative)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -45,10 +45,14 @@ try:
 except ImportError:
     pass
 
+import os
+import re
+from array import array
 from itertools import *
+from multiprocessing import Pool, cpu_count
 from pyparsing import *
 
-from datatypes import Decimal, Complex, Rational, ENotation
+from datatypes import Decimal, Complex, Rational, ENotation, LiteralDecimal
 
 
 # The recognised operators (each one surrounded by spaces!)
@@ -75,16 +79,50 @@ class cached(object):
         return return_result
 
 
+def _decimal_complex(real, imag):
+    return Complex(Decimal(real), Decimal(imag))
+
+def _literal_complex(real, imag):
+    # the sign of the imaginary part is written by the builders
+    if imag[:1] == '+':
+        imag = imag[1:]
+    return Complex(real, imag)
+
+def _float_complex(real, imag):
+    return complex(float(real), float(imag))
+
 class TermTokenizer(object):
     """Defines identifiers, attributes and basic data types:
     string, int, float, bool.
+
+    The numeric mode selects the values of real and complex literals:
+    'decimal' (default) parses them into Decimal and Complex values,
+    'lazy' keeps the literal text of reals (like '.50') and builds
+    complex values straight from their text, without Decimal parts,
+    'float' uses the native float and complex types.  The
+    parsers take the mode as argument, register them to use it:
+
+    term_parsers['infix_term'] = InfixTermParser('lazy').p_arithmetic_exp()
     """
+    NUMERIC_MODES = {
+        'decimal' : (Decimal,        _decimal_complex),
+        'lazy'    : (LiteralDecimal, _literal_complex),
+        'float'   : (float,          _float_complex)
+        }
+
+    def __init__(self, numeric_mode='decimal'):
+        try:
+            self._real, self._complex = self.NUMERIC_MODES[numeric_mode]
+        except KeyError:
+            raise ValueError, "Unknown numeric mode '%s'" % numeric_mode
+        self.numeric_mode = numeric_mode
+
     def _parse_attribute(self, s,p,t):
         return [ ('name',           self._filter_name( t[0] )) ]
     def _parse_int(self, s,p,t):
         return [ ('const:integer',  int(t[0])) ]
     def _parse_float(self, s,p,t):
-        return [ ('const:real',     Decimal(t[0])) ]
+        return [ ('const:real',     self._real(t[0])) ]
     def _parse_bool(self, s,p,t):
         return [ ('const:bool',     t[0].lower() == 'true') ]
     def _parse_string(self, s,p,t):
@@ -93,9 +131,9 @@ class TermTokenizer(object):
         return [ ('const:enotation', ENotation(t[0], t[1])) ]
     def _parse_complex(self, s,p,t):
         if len(t) == 1:
-            value = Complex(0, Decimal(t[0]))
+            value = self._complex(u'0', t[0])
         else:
-            value = Complex(Decimal(t[0]), Decimal(t[1]))
+            value = self._complex(t[0], t[1])
         return [ ('const:complex', value) ]
 
     _CONSTANT_MAP = {}
@@ -183,12 +221,13 @@ class TermTokenizer(object):
 
 
 class ArithmeticParserBase(object):
-    def __init__(self):
+    def __init__(self, numeric_mode='decimal'):
         super(ArithmeticParserBase, self).__init__()
+        self.numeric_mode = numeric_mode
         self.tokenizer = self.build_tokenizer()
 
     def build_tokenizer(self):
-        return TermTokenizer()
+        return TermTokenizer(self.numeric_mode)
 
     def _build_expression_tree(self, match, pos, tokens):
         #print "B", repr(tokens)
@@ -236,6 +275,20 @@ class TermParserBase(ArithmeticParserBase):
 
 class InfixTermParser(TermParserBase):
     p_bool_expression = Forward()
+    _mode_bool_expressions = {}
+
+    def _case_bool_expression(self):
+        "The boolean expression grammar for CASE in our numeric mode."
+        mode = self.numeric_mode
+        if mode == 'decimal':
+            return self.p_bool_expression
+        try:
+            return self._mode_bool_expressions[mode]
+        except KeyError:
+            pass
+        p_bool_expression = self._mode_bool_expressions[mode] = Forward()
+        p_bool_expression <<= InfixBoolExpressionParser(mode).p_bool_exp()
+        return p_bool_expression
 
     # arithmetic = a+b*c-(3*4)...
     def p_operator_term(self, operator, p_exp):
@@ -266,7 +319,7 @@ class InfixTermParser(TermParserBase):
         p_num        = self.tokenizer.p_num()
         p_identifier = self.tokenizer.p_identifier()
         p_function   = self.p_function(p_arithmetic_exp)
-        p_case       = self.p_case(p_arithmetic_exp, self.p_bool_expression)
+        p_case       = self.p_case(p_arithmetic_exp, self._case_bool_expression())
 
         # numeric values = attribute | number | expression
         _p_num_atom <<= p_case | ( Suppress('(') + p_arithmetic_exp + Suppress(')') ) | p_num | p_function | p_identifier
@@ -325,8 +378,9 @@ class InfixTermParser(TermParserBase):
 class BoolParserBase(object):
     CMP_OPERATORS = BOOL_CMP_OPERATORS
 
-    def __init__(self):
+    def __init__(self, numeric_mode='decimal'):
         super(BoolParserBase, self).__init__()
+        self.numeric_mode = numeric_mode
         self.term_parser = self.build_term_parser()
         self.tokenizer   = self.build_tokenizer()
         self._build_expression_tree = self.term_parser._build_expression_tree
@@ -377,7 +431,7 @@ class InfixBoolExpressionParser(BoolParserBase):
     # exp = a op b
     def build_term_parser(self):
         "Default: InfixTermParser()"
-        return InfixTermParser()
+        return InfixTermParser(self.numeric_mode)
 
     @cached
     def p_bool_cmp(self):
@@ -469,6 +523,186 @@ class ListParser(object):
         return p_list
 
 
+class LiteralList(tuple):
+    """AST node of a list of number literals of one type, like
+    'const:integer'.  It is the tuple ('list', (const_type, value),
+    ...) and additionally keeps the const_type and the values in a
+    single array or list, which converters can use to skip the
+    per-item tuples.
+    """
+    def __new__(cls, const_type, values):
+        self = tuple.__new__(cls, chain((u'list',),
+                                        ( (const_type, value) for value in values )))
+        self.const_type = const_type
+        self.values = values
+        return self
+
+    def __reduce__(self):
+        return (self.__class__, (self.const_type, self.values))
+
+
+# characters that cannot appear in integer or real lists, and signs
+# followed by spaces, which the grammar reads as operators
+_NOT_INT_LIST  = re.compile(r'[^\d\s,+-]|[-+]\s')
+_NOT_REAL_LIST = re.compile(r'[^\d\s,.+-]|[-+]\s')
+
+class LiteralListParser(object):
+    """Parser for term lists with a fast path for lists that only
+    contain integers or only reals.  These are scanned with a regular
+    expression and returned as LiteralList, with the integers in an
+    array('l') and the reals in an array('d') in 'float' mode or as
+    exact Decimal values otherwise.  Other lists are parsed by the
+    pyparsing list grammar p_list.
+    """
+    def __init__(self, p_list, numeric_mode='decimal'):
+        self.numeric_mode = numeric_mode
+        self._real = TermTokenizer.NUMERIC_MODES[numeric_mode][0]
+        self._parse = build_parser(p_list).parse
+
+    def scan(self, term):
+        "Return a LiteralList for literal-only lists, or None."
+        if not _NOT_INT_LIST.search(term):
+            try:
+                try:
+                    values = array('l', imap(int, term.split(',')))
+                except OverflowError:
+                    values = map(int, term.split(','))
+            except ValueError:
+                return None
+            return LiteralList(u'const:integer', values)
+        elif not _NOT_REAL_LIST.search(term):
+            values = term.split(',')
+            if term.count('.') != len(values):
+                return None
+            try:
+                floats = array('d', imap(float, values))
+            except ValueError:
+                return None
+            if self.numeric_mode == 'float':
+                values = floats
+            else:
+                real = self._real
+                values = [ real(value.strip()) for value in values ]
+            return LiteralList(u'const:real', values)
+        return None
+
+    def parse(self, term):
+        tree = self.scan(term)
+        if tree is None:
+            tree = self._parse(term)
+        return tree
+
+
+_LIST_TOKENS = re.compile(r"""[,()\[\]]|'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|"""
+                          r"""(?<![\w.])(?:case|end)(?![\w.])""", re.I)
+
+def split_list_term(term):
+    """Split a list term at the commas outside of parentheses,
+    brackets, strings and CASE ... END.  Returns a list of (offset,
+    item) pairs, or None if the nesting is unbalanced."""
+    items = []
+    depth = start = 0
+    for match in _LIST_TOKENS.finditer(term):
+        token = match.group()
+        if token == ',':
+            if depth == 0:
+                items.append( (start, term[start:match.start()]) )
+                start = match.end()
+        elif token in '([':
+            depth += 1
+        elif token in ')]':
+            depth -= 1
+        elif token[0] in '\'"':
+            continue
+        elif token.lower() == 'case':
+            depth += 1
+        else:
+            depth -= 1
+        if depth < 0:
+            return None
+    if depth:
+        return None
+    items.append( (start, term[start:]) )
+    return items
+
+def _parse_list_items(args):
+    "Parse a chunk of list items.  Returns the trees and the first error."
+    input_type, items = args
+    parse = term_parsers[input_type].parse
+    trees = []
+    for offset, item in items:
+        try:
+            trees.append(parse(item))
+        except ParseException, e:
+            return trees, (offset + e.loc, e.msg)
+    return trees, None
+
+class ParallelListParser(object):
+    """Parser for huge term lists.  Splits the term at the top-level
+    commas and parses the items with the parser registered for
+    item_input_type, using a pool of 'processes' worker processes
+    (default: one per CPU).  The worker processes look up the item
+    parser in their own term_parsers registry.
+
+    The pool is started on first use and kept for later calls until
+    close() is called.  Its workers do not see parsers that are
+    registered after it was started.  Alternatively, pass a
+    multiprocessing pool, which is used instead and left to its owner.
+
+    Parse errors report their position in the complete term.
+    """
+    CHUNKS_PER_PROCESS = 4
+
+    def __init__(self, item_input_type, processes=None, pool=None):
+        self.item_input_type = item_input_type
+        self.processes = processes
+        self.pool = pool
+        self._own_pool = self._own_pool_pid = None
+
+    def close(self):
+        "Stop the worker processes of the pool started by the parser."
+        pool = self._own_pool
+        if pool is not None:
+            self._own_pool = self._own_pool_pid = None
+            pool.close()
+            pool.join()
+
+    def _worker_pool(self, processes):
+        if self.pool is not None:
+            return self.pool
+        if self._own_pool_pid != os.getpid(): # not inherited through fork()
+            self._own_pool = Pool(processes)
+            self._own_pool_pid = os.getpid()
+        return self._own_pool
+
+    def _parse_chunks(self, chunks, processes):
+        if (self.pool is None and processes <= 1) or len(chunks) <= 1:
+            return map(_parse_list_items, chunks)
+        return self._worker_pool(processes).map(_parse_list_items, chunks)
+
+    def parse(self, term):
+        items = split_list_term(term)
+        if items is None:
+            raise ParseException(term, len(term), "Unbalanced nesting in list")
+
+        processes = self.processes
+        if processes is None:
+            processes = cpu_count()
+        chunk_count = max(1, processes) * self.CHUNKS_PER_PROCESS
+        chunk_size = -(-len(items) // chunk_count)
+        input_type = self.item_input_type
+        chunks = [ (input_type, items[i:i+chunk_size])
+                   for i in xrange(0, len(items), chunk_size) ]
+
+        tree = ['list']
+        for trees, error in self._parse_chunks(chunks, processes):
+            if error is not None:
+                loc, msg = error
+                raise ParseException(term, loc, msg)
+            tree.extend(trees)
+        return tuple(tree)
+
+
 def build_parser(parser):
     parser = parser + StringEnd()
     parser.streamline()
@@ -528,6 +762,8 @@ class TermParsing(ConverterRegistry):
             converter = build_parser(converter)
         super(TermParsing, self).register_converter(converter_type, converter)
 
+    __setitem__ = register_converter
+
     def parse(self, term, input_type):
         "Convert a parse tree into a term of the given input type."
         converter = self._converters[input_type]
@@ -539,7 +775,7 @@ term_parsers = TermParsing()
 parser = InfixTermParser().p_arithmetic_exp()
 term_parsers.register_converter('infix_bool',      InfixBoolExpressionParser().p_bool_exp())
 term_parsers.register_converter('infix_term',      parser)
-term_parsers.register_converter('infix_term_list', ListParser(parser).p_list())
+term_parsers.register_converter('infix_term_list', LiteralListParser(ListParser(parser).p_list()))
 del parser
 
 try:
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+__doc__ = """
+Substitution of names in term ASTs.
+
+substitute_tree() replaces 'name' leaves of an AST by other names,
+constants or subtrees in a single traversal.  Unchanged subtrees are
+shared with the input tree, not copied.  Mapping values can be ASTs,
+strings (new names) or numbers (bool, int, long, float, Decimal and
+the mathml.datatypes).
+
+>>> from mathml.termparser import term_parsers
+>>> from mathml.termbuilder import tree_converters
+>>> from mathml.termsubst import substitute_tree, TreeSubstitution
+>>> parse = term_parsers['infix_term'].parse
+>>> infix = tree_converters['infix'].build
+>>> tree = parse('a*x^2 + b*x + c')
+>>> infix( substitute_tree(tree, {'x' : parse('y+1'), 'a' : 2, 'c' : 'd'}) )
+u'2 * ( y + 1 ) ^ 2 + b * ( y + 1 ) + d'
+
+TreeSubstitution locates the names once and then instantiates the
+tree for many mappings:
+
+>>> substitution = TreeSubstitution(tree, ['a', 'b', 'c'])
+>>> [ infix(t) for t in substitution.substitute_many(
+...       [{'a' : 1, 'b' : 2, 'c' : 3}, {'a' : 0.5, 'b' : -1, 'c' : 0}]) ]
+[u'1 * x ^ 2 + 2 * x + 3', u'0.5 * x ^ 2 + -1 * x + 0']
+"""
+
+__all__ = ('substitute_tree', 'value_tree', 'TreeSubstitution')
+
+from mathml.datatypes import Decimal
+
+
+def value_tree(value):
+    """Convert a substitution value into an AST: tuples and lists are
+    returned as they are, strings become names and numbers become
+    constants."""
+    if isinstance(value, (tuple, list)):
+        return value
+    elif isinstance(value, basestring):
+        return (u'name', value)
+    elif isinstance(value, bool):
+        return (u'const:bool', value)
+    elif isinstance(value, (int, long)):
+        return (u'const:integer', value)
+    elif isinstance(value, float):
+        return (u'const:real', Decimal(repr(value)))
+    try:
+        type_name = value.TYPE_NAME
+    except AttributeError:
+        if isinstance(value, Decimal):
+            return (u'const:real', value)
+        raise TypeError, "Unsupported substitution value type '%s'" % type(value).__name__
+    return (u'const:%s' % type_name.replace('-', ''), value)
+
+
+def _compile(tree, names):
+    """Return a function that builds the substituted tree from a
+    mapping of value trees, or None if tree contains none of the names."""
+    operator = tree[0]
+    if operator == u'name':
+        name = tree[1]
+        if names is not None and name not in names:
+            return None
+        def build(mapping):
+            return mapping.get(name, tree)
+        return build
+    elif operator[:6] == u'const:':
+        return None
+
+    builders = [ (child, _compile(child, names)) for child in tree[1:] ]
+    if not any(builder for child, builder in builders):
+        return None
+    node_type = type(tree)
+    def build(mapping):
+        node = [operator]
+        for child, builder in builders:
+            if builder is None:
+                node.append(child)
+            else:
+                node.append(builder(mapping))
+        return node_type(node)
+    return build
+
+def _value_trees(mapping):
+    return dict( (name, value_tree(value))
+                 for name, value in mapping.iteritems() )
+
+
+class TreeSubstitution(object):
+    """Precompiled substitution of the names in an AST.  Only the names
+    in 'names' are substituted, or all names if it is None.
+    """
+    def __init__(self, tree, names=None):
+        self.tree = tree
+        if names is not None:
+            names = frozenset(names)
+        self._build = _compile(tree, names)
+
+    def substitute(self, mapping):
+        "Return a new AST with the names replaced by the mapping values."
+        if self._build is None:
+            return self.tree
+        return self._build(_value_trees(mapping))
+
+    def substitute_many(self, mappings):
+        "Return a list of ASTs, one for each mapping in a sequence."
+        return map(self.substitute, mappings)
+
+
+def substitute_tree(tree, mapping):
+    "Return a new AST with names replaced by the mapping values."
+    return TreeSubstitution(tree, mapping).substitute(mapping)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
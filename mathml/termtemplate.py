@@ -0,0 +1,194 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+__doc__ = """
+Precompiled term templates.
+
+A TermTemplate parses a term with placeholder names once and prepares
+its MathML, Presentation MathML and literal term output ('infix',
+'python' and 'sql') as skeletons with slots for the placeholders.
+Serializing an instance only renders the bound values and splices them
+into the slots, without running the term parser, SaxTerm or XSLT.
+
+The output is exactly the same as substituting the values into a
+MathDOM of the term and serializing it:
+
+>>> from mathml.termtemplate import TermTemplate
+>>> template = TermTemplate('a*x^2 + b', ['a', 'b'])
+>>> template.serialize({'a' : 3, 'b' : -1}, 'infix')
+u'3 * x ^ 2 + -1'
+>>> print template.serialize({'a' : 3, 'b' : -1})
+<math xmlns="http://www.w3.org/1998/Math/MathML"><apply><plus/><apply><times/><cn type="integer">3</cn><apply><power/><ci>x</ci><cn type="integer">2</cn></apply></apply><cn type="integer">-1</cn></apply></math>
+>>> doc = template.to_dom({'a' : 3, 'b' : -1})
+>>> template.serialize({'a' : 3, 'b' : -1}, 'pmathml') == doc.serialize('pmathml')
+True
+
+Placeholders take names, numbers and booleans.  Other values (like
+subtrees) and unbound placeholders fall back to the substitution.
+"""
+
+__all__ = ('TermTemplate',)
+
+import re
+from itertools import izip
+
+import mathml.utils.pyterm, mathml.utils.sqlterm # register the converters
+
+from mathml.lmathdom     import MathDOM, _substitution_element
+from mathml.xmlterm      import dom_to_tree
+from mathml.termbuilder  import tree_converters
+from mathml.presentation import to_presentation, presentation_fragment
+
+
+def _escape(text):
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(
+        u'>', u'&gt;').replace(u'\r', u'&#13;')
+
+def _mathml_markup(element):
+    "Serialize a leaf element like lxml does inside of a MathML document."
+    name = element.localName
+    attributes = u''.join( u' %s="%s"' % (key, _escape(value).replace(u'"', u'&quot;'))
+                           for key, value in element.items() )
+    content = [ _escape(element.text or u'') ]
+    for child in element:
+        content.append(u'<%s/>' % child.localName)
+        content.append(_escape(child.tail or u''))
+    content = u''.join(content)
+    if content:
+        return u'<%s%s>%s</%s>' % (name, attributes, content, name)
+    return u'<%s%s/>' % (name, attributes)
+
+def _is_leaf(element):
+    mathtype = element.mathtype()
+    if mathtype in (u'ci', u'cn'):
+        return True
+    return not len(element) and mathtype not in (
+        u'apply', u'list', u'interval', u'piecewise')
+
+def _presentation_shape(element):
+    """The context dependent part of the Presentation MathML of a leaf:
+    the tag of constants and the sign of tokens."""
+    if element.mathtype() in (u'ci', u'cn'):
+        return u'-' in (element.text or u'')
+    return element.tag
+
+
+class _Skeleton(object):
+    "Serialized output, split at the placeholder slots."
+    def __init__(self, text, slot_pattern):
+        parts = slot_pattern.split(text)
+        self.literals = parts[0::2]
+        self.slots    = map(int, parts[1::2])
+
+    def fill(self, values):
+        literals = self.literals
+        out = [ literals[0] ]
+        for slot, literal in izip(self.slots, literals[1:]):
+            out.append(values[slot])
+            out.append(literal)
+        return u''.join(out)
+
+
+class TermTemplate(object):
+    """A term with placeholder names, parsed from input_type (default
+    'infix_term').  The placeholders are names in the term.
+    """
+    LITERAL_FORMATS = ('infix', 'python', 'sql')
+
+    def __init__(self, term, placeholders, input_type='infix_term'):
+        self.placeholders = tuple(placeholders)
+        self._doc = MathDOM.fromString(term, input_type)
+        names = self._doc.index().identifiernames()
+        self._slot_names = [ name for name in self.placeholders if name in names ]
+
+        prefix = u'__slot'
+        while prefix in term:
+            prefix += u'_'
+        self._markers = [ u'%s%dZ' % (prefix, i)
+                          for i in xrange(len(self._slot_names)) ]
+        slot = re.escape(prefix) + ur'(\d+)Z'
+        self._slot_patterns = {
+            'mathml'  : re.compile(u'<ci>%s</ci>' % slot),
+            'pmathml' : re.compile(u'<mi>%s-?</mi>' % slot),
+            'literal' : re.compile(slot)
+            }
+
+        marked = self._marked = self._doc.substitute_many(
+            [ dict(zip(self._slot_names, self._markers)) ])[0]
+        self._skeletons = {
+            'mathml' : _Skeleton(marked.serialize().decode('UTF-8'),
+                                 self._slot_patterns['mathml'])
+            }
+        tree = marked.to_tree()
+        for output_format in self.LITERAL_FORMATS:
+            try:
+                text = tree_converters[output_format].build(tree)
+            except NotImplementedError:
+                continue
+            self._skeletons[output_format] = _Skeleton(
+                text, self._slot_patterns['literal'])
+        # Presentation MathML depends on the signs of the values
+        self._pmathml_skeletons = {}
+
+    def to_dom(self, bindings):
+        "Return a new MathDOM with the placeholders substituted."
+        return self._doc.substitute_many([bindings])[0]
+
+    def _pmathml_skeleton(self, elements):
+        shapes = tuple(map(_presentation_shape, elements))
+        try:
+            return self._pmathml_skeletons[shapes]
+        except KeyError:
+            pass
+        mapping = {}
+        for marker, shape, element in izip(self._markers, shapes, elements):
+            if shape is True:
+                mapping[marker] = marker + u'-'
+            elif shape is False:
+                mapping[marker] = marker
+            else:
+                mapping[marker] = element
+        doc = self._marked.substitute_many([mapping])[0]
+        pmathml = to_presentation(doc)
+        if pmathml is not None:
+            pmathml = _Skeleton(pmathml.decode('UTF-8'),
+                                self._slot_patterns['pmathml'])
+        skeleton = self._pmathml_skeletons[shapes] = pmathml
+        return skeleton
+
+    def serialize(self, bindings, output_format='mathml'):
+        """Serialize the template with the placeholders bound to the
+        values of the bindings dict.  Supports 'mathml' (default),
+        'pmathml', 'infix', 'python' and 'sql', or falls back to
+        to_dom(bindings).serialize(output_format)."""
+        if output_format == 'pmathml_native':
+            output_format = 'pmathml'
+        skeleton = self._skeletons.get(output_format)
+        if skeleton is None and output_format != 'pmathml':
+            return self.to_dom(bindings).serialize(output_format)
+
+        elements = []
+        for name in self._slot_names:
+            if name not in bindings:
+                return self.to_dom(bindings).serialize(output_format)
+            element = _substitution_element(bindings[name])
+            if not _is_leaf(element):
+                return self.to_dom(bindings).serialize(output_format)
+            elements.append(element)
+
+        if output_format == 'mathml':
+            return skeleton.fill(map(_mathml_markup, elements)).encode('UTF-8')
+        elif output_format == 'pmathml':
+            skeleton = self._pmathml_skeleton(elements)
+            values = map(presentation_fragment, elements)
+            if skeleton is None or None in values:
+                return self.to_dom(bindings).serialize(output_format)
+            return skeleton.fill(values).encode('UTF-8')
+        else:
+            build = tree_converters[output_format].build
+            return skeleton.fill([ build(dom_to_tree(element))
+                                   for element in elements ])
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
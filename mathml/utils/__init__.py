@@ -1,22 +1,85 @@
 import os
 from os import path
+from UserDict import DictMixin
 from lxml.etree import parse, XSLT
 
-__all__ = ['STYLESHEETS']
+__all__ = ['STYLESHEETS', 'LazyDict']
 
 xslt_dir = path.dirname(__file__)
 xslt_files = [ filename for filename in os.listdir(xslt_dir)
                if filename.endswith('.xsl') or filename.endswith('.xslt') ]
 
-class StylesheetDict(dict):
+
+class LazyDict(DictMixin):
+    """Dictionary that builds its values on first access.
+
+    Values are registered as loader functions.  If a loader fails, the
+    name is removed from the dictionary and the exception is stored in
+    the BROKEN dictionary.
+    """
+    def __init__(self):
+        self._loaders = {}
+        self._values  = {}
+        self.BROKEN   = {}
+
+    def register_loader(self, name, loader):
+        "Register a function that builds the value for name."
+        self._values.pop(name, None)
+        self._loaders[name] = loader
+
+    def is_loaded(self, name):
+        return name in self._values
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+        loader = self._loaders[name]
+        try:
+            value = loader()
+        except Exception, e:
+            del self._loaders[name]
+            self.BROKEN[name] = e
+            raise KeyError, name
+        self._values[name] = value
+        return value
+
+    def __setitem__(self, name, value):
+        self._loaders[name] = None
+        self._values[name]  = value
+
+    def __delitem__(self, name):
+        del self._loaders[name]
+        self._values.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self._loaders
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self._loaders)
+
+    def __len__(self):
+        return len(self._loaders)
+
+    def keys(self):
+        return self._loaders.keys()
+
+
+class StylesheetDict(LazyDict):
+    "Dictionary of the bundled XSLT stylesheets, compiled on first access."
     def __init__(self):
-        dict.__init__(self)
-        self.BROKEN = {}
+        LazyDict.__init__(self)
         for filename in xslt_files:
             name = path.splitext(filename)[0]
-            try:
-                self[name] = XSLT(parse(path.join(xslt_dir, filename)))
-            except Exception, e:
-                self.BROKEN[name] = e
+            self.register_loader(name, self._loader(path.join(xslt_dir, filename)))
+
+    @staticmethod
+    def _loader(file_path):
+        def load():
+            return XSLT(parse(file_path))
+        return load
 
 STYLESHEETS = StylesheetDict()
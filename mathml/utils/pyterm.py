@@ -1,13 +1,21 @@
+from mathml.datatypes   import complex_strs
 from mathml.termbuilder import tree_converters, InfixTermBuilder
 from mathml.termparser  import (term_parsers, cached, TermTokenizer,
                                 InfixTermParser, InfixBoolExpressionParser, ListParser,
+                                LiteralListParser,
                                 CaselessKeyword)
 
-__all__ = [ 'PyTermBuilder', 'PyTermParser', 'PyBoolExpressionParser', 'ParseException' ]
+__all__ = [ 'PyTermBuilder', 'PyTermParser', 'PyBoolExpressionParser', 'PyAstTermParser',
+            'ParseException' ]
 
 # BUILDER
 
 class PyTermBuilder(InfixTermBuilder):
+    """Builds Python expressions.  Interval membership becomes a test
+    on xrange(), or a chained comparison (like 'a <= x < b') if
+    interval_comparisons is true.  The comparisons take constant time
+    and do not truncate non-integer bounds.
+    """
     _INTERVAL_NOTATION = {
         u'closed'      : u'xrange(int(%s),   int(%s)+1)'.replace(u' ', u''),
         u'closed-open' : u'xrange(int(%s),   int(%s)  )'.replace(u' ', u''),
@@ -15,6 +23,13 @@ class PyTermBuilder(InfixTermBuilder):
         u'open'        : u'xrange(int(%s)+1, int(%s)  )'.replace(u' ', u'')
         }
 
+    _INTERVAL_COMPARISONS = {
+        u'closed'      : (u'<=', u'<='),
+        u'closed-open' : (u'<=', u'<' ),
+        u'open-closed' : (u'<',  u'<='),
+        u'open'        : (u'<',  u'<' )
+        }
+
     _OPERATOR_MAP = {
         '^'       : '**',
         '='       : '==',
@@ -46,17 +61,44 @@ class PyTermBuilder(InfixTermBuilder):
         u'false' : u'False'
         }
 
+    _BOOL_AFFIN = InfixTermBuilder.OPERATOR_ORDER.index('and')
+
+    def __init__(self, interval_comparisons=False):
+        super(PyTermBuilder, self).__init__()
+        self.interval_comparisons = interval_comparisons
+
+    def _recursive_build(self, tree, affin_status):
+        if self.interval_comparisons and tree[0] in (u'in', u'notin') \
+               and len(tree) == 3 and tree[2][0][:9] == u'interval:':
+            return self._build_interval_comparison(tree, affin_status)
+        return super(PyTermBuilder, self)._recursive_build(tree, affin_status)
+
+    def _build_interval_comparison(self, tree, affin_status):
+        operator, value, interval = tree
+        lower, upper = self._INTERVAL_COMPARISONS[ interval[0][9:] ]
+        affin = self._find_affin(u'in', affin_status)
+        build = self._recursive_build
+        result = [ u' '.join(build(interval[1], affin)), lower,
+                   u' '.join(build(value, affin)), upper,
+                   u' '.join(build(interval[2], affin)) ]
+        if operator == u'notin':
+            result = [ u'not', u'(' ] + result + [ u')' ]
+        if affin[1] < self._BOOL_AFFIN:
+            # keep the chain apart from surrounding comparisons
+            result = [ u'(' ] + result + [ u')' ]
+        return result
+
     def _handle_const_bool(self, operator, operands, affin):
         return [ operands[0] and 'True' or 'False' ]
 
     def _handle_const_complex(self, operator, operands, affin):
         value = operands[0]
+        real_str, imag_str = complex_strs(value)
         if value.imag == 0:
-            return value.real_str
-        real_str = value.real_str
+            return [ real_str ]
         if real_str == "0":
             real_str = ''
-        return [ u'(%s%s%sj)' % (real_str, (value.imag >= 0) and '+' or '', value.imag_str) ]
+        return [ u'(%s%s%sj)' % (real_str, (value.imag >= 0) and '+' or '', imag_str) ]
 
     def _handle_case(self, operator, operands, affin_status):
         assert operator == 'case'
@@ -72,6 +114,8 @@ class PyTermBuilder(InfixTermBuilder):
 
 
 tree_converters.register_converter('python',   PyTermBuilder())
+tree_converters.register_converter('python_interval_comparisons',
+                                   PyTermBuilder(interval_comparisons=True))
 
 # PARSER
 
@@ -94,7 +138,7 @@ class PyTermParser(InfixTermParser):
     OPERATOR_ORDER = InfixTermParser.OPERATOR_ORDER.replace(' ^ ', ' ** ')
 
     def build_tokenizer(self):
-        return PyTermTokenizer()
+        return PyTermTokenizer(self.numeric_mode)
 
     @cached
     def _zero(self):
@@ -119,6 +163,9 @@ class PyTermParser(InfixTermParser):
             start, stop = t
         return [ (u'interval:closed-open', start, stop) ]
 
+    def _case_bool_expression(self):
+        return None
+
     def p_case(self, *args):
         return NoMatch()
 
@@ -131,7 +178,7 @@ class PyTermParser(InfixTermParser):
 
 class PyBoolExpressionParser(InfixBoolExpressionParser):
     def build_term_parser(self):
-        return PyTermParser()
+        return PyTermParser(self.numeric_mode)
 
     @cached
     def p_cmp_in(self):
@@ -144,5 +191,248 @@ class PyBoolExpressionParser(InfixBoolExpressionParser):
 py_term = PyTermParser().p_arithmetic_exp()
 term_parsers.register_converter('python_bool',      PyBoolExpressionParser().p_bool_exp())
 term_parsers.register_converter('python_term',      py_term)
-term_parsers.register_converter('python_term_list', ListParser(py_term).p_list())
+term_parsers.register_converter('python_term_list', LiteralListParser(ListParser(py_term).p_list()))
 del py_term
+
+
+# AST PARSER
+
+import ast, re
+
+_PY_NUMBER = re.compile(r'([-+]?)\s*((?:\d+\.?\d*|\.\d+)([eE][-+]?\d+)?)[jJlL]?')
+
+_BINARY_OPERATORS = {
+    ast.Add  : u'+',
+    ast.Sub  : u'-',
+    ast.Mult : u'*',
+    ast.Div  : u'/',
+    ast.Mod  : u'%',
+    ast.Pow  : u'^'
+    }
+
+_COMPARE_OPERATORS = {
+    ast.Eq    : u'=',
+    ast.NotEq : u'!=',
+    ast.Lt    : u'<',
+    ast.LtE   : u'<=',
+    ast.Gt    : u'>',
+    ast.GtE   : u'>=',
+    ast.In    : u'in',
+    ast.NotIn : u'notin'
+    }
+
+def _term_position(term, source, offset):
+    """Convert a byte offset in the UTF-8 source of term into a
+    character offset for unicode terms."""
+    if isinstance(term, unicode):
+        return len(source[:offset].decode('UTF-8', 'ignore'))
+    return offset
+
+_FUNCTION_NAMES = dict( (py_name, name)
+                        for name, py_name in PyTermBuilder._OPERATOR_MAP.iteritems()
+                        if py_name.startswith('math.') )
+
+class PyAstTermParser(object):
+    """Parser for Python terms (boolean=False) or boolean expressions
+    (boolean=True) that uses Python's own parser through the ast
+    module.  It produces the same ASTs as PyTermParser and
+    PyBoolExpressionParser, with the operator nesting of Python.
+    Chained comparisons become 'and' terms, 'x in range(a, b)' an
+    interval membership and 'x if c else y' a case term.
+
+    Unsupported syntax raises a ParseException at its position.  The
+    parsers are registered as 'python_ast_term' and 'python_ast_bool',
+    register them as 'python_term' and 'python_bool' to use them by
+    default.
+    """
+    def __init__(self, boolean=False, numeric_mode='decimal'):
+        self.boolean = boolean
+        self.tokenizer = PyTermTokenizer(numeric_mode)
+
+    def parse(self, term):
+        if isinstance(term, unicode):
+            source = term.encode('UTF-8')
+        else:
+            source = term
+        stripped = source.lstrip()
+        indent = len(source) - len(stripped)
+        line_offsets = [0]
+        for line in stripped.splitlines(True):
+            line_offsets.append(line_offsets[-1] + len(line))
+
+        try:
+            node = ast.parse(stripped, mode='eval').body
+        except SyntaxError, e:
+            line = min(max(1, e.lineno or 1), len(line_offsets)) - 1
+            offset = line_offsets[line] + max(0, (e.offset or 1) - 1)
+            raise ParseException(
+                term, indent + _term_position(term, stripped, offset), e.msg)
+        return _PyAstConverter(self.tokenizer, term, stripped, indent,
+                               line_offsets).convert(node, self.boolean)
+
+
+class _PyAstConverter(object):
+    "Converts the ast nodes of one term."
+    def __init__(self, tokenizer, term, source, indent, line_offsets):
+        self.tokenizer = tokenizer
+        self.term   = term
+        self.source = source
+        self.indent = indent
+        self.line_offsets = line_offsets
+
+    def position(self, node):
+        "The offset of a node in the source."
+        return self.line_offsets[node.lineno - 1] + node.col_offset
+
+    def error(self, node, message):
+        position = _term_position(self.term, self.source, self.position(node))
+        return ParseException(self.term, position + self.indent, message)
+
+    def convert(self, node, boolean):
+        if boolean:
+            return self.boolean(node)
+        return self.arithmetic(node)
+
+    def boolean(self, node):
+        node_type = type(node)
+        if node_type is ast.BoolOp:
+            operator = type(node.op) is ast.And and u'and' or u'or'
+            return (operator,) + tuple(map(self.boolean, node.values))
+        elif node_type is ast.UnaryOp and type(node.op) is ast.Not:
+            return (u'not', self.boolean(node.operand))
+        elif node_type is ast.Compare:
+            return self.compare(node)
+        elif node_type in (ast.Name, ast.Attribute):
+            return self.name(node)
+        raise self.error(node, "Expected a boolean expression")
+
+    def compare(self, node):
+        operands = [node.left] + node.comparators
+        terms = []
+        for i, op in enumerate(node.ops):
+            operator = _COMPARE_OPERATORS.get(type(op))
+            if operator is None:
+                raise self.error(node, "Unsupported comparison '%s'" % type(op).__name__)
+            left = self.comparable(operands[i])
+            if operator in (u'in', u'notin'):
+                right = self.interval(operands[i+1])
+            else:
+                right = self.comparable(operands[i+1])
+            terms.append( (operator, left, right) )
+        if len(terms) == 1:
+            return terms[0]
+        return (u'and',) + tuple(terms)
+
+    def comparable(self, node):
+        if type(node) is ast.Str:
+            value = node.s
+            if isinstance(self.term, unicode) and isinstance(value, str):
+                value = value.decode('UTF-8')
+            return ('const:string', value)
+        return self.arithmetic(node)
+
+    def interval(self, node):
+        if type(node) is ast.Call and type(node.func) is ast.Name and \
+               node.func.id in ('range', 'xrange') and 0 < len(node.args) < 3 and \
+               not (node.keywords or node.starargs or node.kwargs):
+            args = map(self.arithmetic, node.args)
+            if len(args) == 1:
+                args.insert(0, self.tokenizer._parse_int(None, None, ["0"])[0])
+            return (u'interval:closed-open',) + tuple(args)
+        raise self.error(node, "Expected range() or xrange()")
+
+    def arithmetic(self, node):
+        node_type = type(node)
+        if node_type is ast.Num:
+            return self.number(node)
+        elif node_type is ast.BinOp:
+            return self.binary(node)
+        elif node_type is ast.UnaryOp:
+            op_type = type(node.op)
+            if op_type is ast.USub:
+                return (u'-', self.arithmetic(node.operand))
+            elif op_type is ast.UAdd:
+                return self.arithmetic(node.operand)
+        elif node_type in (ast.Name, ast.Attribute):
+            return self.name(node)
+        elif node_type is ast.Call:
+            return self.call(node)
+        elif node_type is ast.IfExp:
+            return (u'case', self.boolean(node.test),
+                    self.arithmetic(node.body), self.arithmetic(node.orelse))
+        raise self.error(node, "Unsupported Python syntax '%s'" % node_type.__name__)
+
+    def binary(self, node):
+        operator = _BINARY_OPERATORS.get(type(node.op))
+        if operator is None:
+            raise self.error(node, "Unsupported operator '%s'" % type(node.op).__name__)
+        left, right = node.left, node.right
+        if operator in u'+-' and type(left) is ast.Num and type(right) is ast.Num \
+               and type(right.n) is complex and type(left.n) is not complex:
+            value = self.complex_number(left, operator, right)
+            if value is not None:
+                return value
+        if operator != u'^' and type(left) is ast.BinOp and type(left.op) is type(node.op):
+            # left associative chain
+            return self.binary(left) + (self.arithmetic(right),)
+        return (operator, self.arithmetic(left), self.arithmetic(right))
+
+    def name(self, node):
+        parts = []
+        while type(node) is ast.Attribute:
+            parts.append(node.attr)
+            node = node.value
+        if type(node) is not ast.Name:
+            raise self.error(node, "Unsupported attribute access")
+        parts.append(node.id)
+        name = '.'.join(reversed(parts))
+        if name in ('True', 'False'):
+            return self.tokenizer._parse_bool(None, None, [name])[0]
+        return self.tokenizer._parse_attribute(None, None, [name])[0]
+
+    def call(self, node):
+        if node.keywords or node.starargs or node.kwargs or not node.args:
+            raise self.error(node, "Unsupported function call")
+        function = self.name(node.func)
+        if function[0] != 'name':
+            raise self.error(node, "Unsupported function call")
+        name = function[1]
+        name = _FUNCTION_NAMES.get(name, name)
+        if '.' in name:
+            raise self.error(node, "Unknown function '%s'" % name)
+        return (name,) + tuple(map(self.arithmetic, node.args))
+
+    def literal(self, node):
+        "Match the written form of a number literal in the source."
+        match = _PY_NUMBER.match(self.source, self.position(node))
+        if match is None:
+            raise self.error(node, "Unsupported number literal")
+        return match
+
+    def number(self, node):
+        value = node.n
+        if type(value) in (int, long):
+            return self.tokenizer._parse_int(None, None, [str(value)])[0]
+        match = self.literal(node)
+        sign, text, exponent = match.groups()
+        if type(value) is complex:
+            return self.tokenizer._parse_complex(None, None, [sign + text])[0]
+        elif exponent:
+            return self.tokenizer._parse_enotation(
+                None, None, [sign + text[:-len(exponent)], exponent[1:]])[0]
+        return self.tokenizer._parse_float(None, None, [sign + text])[0]
+
+    def complex_number(self, left, operator, right):
+        """Combine 'real+imag j' into a complex constant, if written
+        without spaces like PyTermParser expects it."""
+        real, imag = self.literal(left), self.literal(right)
+        if real.group(3) or imag.group(3) or imag.group(1) or \
+               self.source[real.end():imag.start()] != operator:
+            return None
+        real_text = real.group(1) + real.group(2)
+        return self.tokenizer._parse_complex(
+            None, None, [real_text, (operator == u'-' and '-' or '') + imag.group(2)])[0]
+
+
+term_parsers.register_converter('python_ast_term',  PyAstTermParser())
+term_parsers.register_converter('python_ast_bool',  PyAstTermParser(boolean=True))
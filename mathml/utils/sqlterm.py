@@ -1,9 +1,15 @@
+import re, threading
+from collections import OrderedDict
+
+from mathml.datatypes   import Decimal, number_str
 from mathml.termbuilder import tree_converters, InfixTermBuilder
 
-__all__ = [ 'SqlTermBuilder' ]
+__all__ = [ 'SqlTermBuilder', 'StatementCache' ]
 
 # BUILDER
 
+_PARAMETER = re.compile(u'\0(\\d+)\0')
+
 class SqlTermBuilder(InfixTermBuilder):
     _NAME_MAP = {
         u'e'     : u'exp(1.0)',
@@ -21,5 +27,96 @@ class SqlTermBuilder(InfixTermBuilder):
     def _handle_interval(self, operator, operands, affin):
         raise NotImplementedError, "Intervals cannot be converted to SQL."
 
+    def build_parameterized(self, tree, columns=None, exact=False):
+        """Build the SQL with '?' placeholders for the constants and
+        return it together with the list of their values.  Terms that
+        only differ in their constants result in the same SQL.
+
+        The optional columns dict maps names to the column names that
+        replace them in the SQL.  Numbers are passed as int and float,
+        which all DB-API drivers accept.  Pass exact=True to get the
+        real numbers as Decimal, for drivers that can bind them."""
+        values = []
+        sql = self.build( self._parameterize(tree, values, columns or {}, exact) )
+        parts = _PARAMETER.split(sql)
+        return (u'?'.join(parts[0::2]),
+                [ values[int(index)] for index in parts[1::2] ])
+
+    def _parameter_value(self, operator, value, exact):
+        if operator == u'const:real':
+            if isinstance(value, float):
+                return value
+            value = number_str(value)
+        elif operator == u'const:enotation':
+            value = unicode(value)
+        elif operator == u'const:integer':
+            return int(value)
+        else:
+            return value
+        if exact:
+            return Decimal(value)
+        return float(value)
+
+    def _parameterize(self, tree, values, columns, exact):
+        "Replace the constants by marker names that become placeholders."
+        operator = tree[0]
+        if operator == u'name':
+            column = columns.get(tree[1])
+            if column is None:
+                return tree
+            return (u'name', column)
+        elif operator == u'const:rational':
+            value = tree[1]
+            return self._parameterize(
+                (u'/', (u'const:integer', value.num), (u'const:integer', value.denom)),
+                values, columns, exact)
+        elif operator == u'const:complex':
+            return tree
+        elif operator[:6] == u'const:':
+            values.append( self._parameter_value(operator, tree[1], exact) )
+            return (u'name', u'\0%d\0' % (len(values)-1))
+        parameterize = self._parameterize
+        return (operator,) + tuple( parameterize(child, values, columns, exact)
+                                    for child in tree[1:] )
+
 
 tree_converters.register_converter('sql', SqlTermBuilder())
+
+
+# STATEMENT CACHE
+
+class StatementCache(object):
+    """Bounded LRU cache of prepared statements, keyed by the
+    parameterized SQL.  prepare(sql) creates the statement for SQL that
+    is not in the cache, like a prepared cursor of a DB-API driver or a
+    function that executes the SQL with a list of parameters.
+    """
+    def __init__(self, prepare, maxsize=100):
+        self.prepare = prepare
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._statements = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._statements)
+
+    def get(self, sql):
+        "Return the cached statement for sql, prepare it on a miss."
+        with self._lock:
+            statements = self._statements
+            statement = statements.pop(sql, None)
+            if statement is None:
+                self.misses += 1
+                statement = self.prepare(sql)
+            else:
+                self.hits += 1
+            statements[sql] = statement
+            while len(statements) > self.maxsize:
+                statements.popitem(last=False)
+            return statement
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+            self.hits = self.misses = 0
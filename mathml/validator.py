@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+__doc__ = """
+Fast structural validator for the subset of Content MathML that
+MathDOM understands.
+
+This checks the element structure, the arity of the operators known
+from the mathml package and the type and content of 'cn' elements in a
+single pass over the tree.  It is much faster than validating against
+the full MathML 2.0 RelaxNG schema, but it rejects valid MathML that
+MathDOM cannot handle, like qualifiers, function composition or
+presentation markup.
+
+>>> from mathml.lmathdom import MathDOM
+>>> from mathml.validator import StructureValidator
+>>> validator = StructureValidator()
+>>> validator.validate(MathDOM.fromString('a+3*(4+5i)', 'infix_term'))
+True
+>>> doc = MathDOM.fromString('a+3*sin(4, b)', 'infix_term')
+>>> validator.validate(doc)
+False
+>>> validator.error_log
+[(u'/math/apply/apply/apply', u'sin takes 1 operand, got 2')]
+"""
+
+__all__ = ('StructureValidator',)
+
+import re
+
+from mathml         import (MATHML_NAMESPACE_URI, UNARY_FUNCTIONS,
+                            BINARY_ARITHMETIC_FUNCTIONS, BINARY_SET_CONTAINMENT,
+                            NARY_FUNCTIONS, BINARY_RELATIONS, NARY_RELATIONS)
+from mathml.xmlterm import _ELEMENT_CONSTANT_MAP
+
+
+_NAMESPACE = u'{%s}' % MATHML_NAMESPACE_URI
+
+_MATH_TAG      = _NAMESPACE + u'math'
+_SEP_TAG       = _NAMESPACE + u'sep'
+_PIECE_TAG     = _NAMESPACE + u'piece'
+_OTHERWISE_TAG = _NAMESPACE + u'otherwise'
+
+_INTEGER = re.compile(r'\s*[+-]?\d+\s*$').match
+_REAL    = re.compile(r'\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$').match
+
+# cn types with their content checks: (text, tail of 'sep') or (text,)
+_CN_TYPES = {
+    None          : (_REAL,),
+    u'integer'    : (_INTEGER,),
+    u'real'       : (_REAL,),
+    u'rational'   : (_INTEGER, _INTEGER),
+    u'complex'    : (_REAL,    _REAL),
+    u'e-notation' : (_REAL,    _INTEGER)
+    }
+
+_CLOSURES = frozenset([u'closed', u'open', u'closed-open', u'open-closed'])
+
+_CONSTANTS = frozenset(_ELEMENT_CONSTANT_MAP.itervalues())
+
+def _build_arities():
+    """Map operator tags to their (min, max) operand count, max None
+    means n-ary."""
+    arities = {}
+    def add(names, min_count, max_count):
+        for name in names.split():
+            tag = _NAMESPACE + name
+            old_min, old_max = arities.get(tag, (min_count, max_count))
+            if old_max is not None and max_count is not None:
+                max_count = max(old_max, max_count)
+            else:
+                max_count = None
+            arities[tag] = (min(old_min, min_count), max_count)
+    add(UNARY_FUNCTIONS,  1, 1)
+    # log(b, x) is written with the base as first operand
+    add(u'log',           1, 2)
+    add(BINARY_SET_CONTAINMENT, 2, 2)
+    # the term parsers merge chains like 'a/b/c' into one apply
+    add(BINARY_ARITHMETIC_FUNCTIONS, 2, None)
+    add(NARY_FUNCTIONS,   1, None)
+    add(BINARY_RELATIONS, 2, 2)
+    add(NARY_RELATIONS,   2, None)
+    return arities
+
+_ARITIES = _build_arities()
+del _build_arities
+
+
+def _local_name(tag):
+    if isinstance(tag, basestring):
+        return tag.split(u'}', 1)[-1]
+    else:
+        return u'node()'
+
+def _plural(count):
+    return count != 1 and 's' or ''
+
+def _element_path(element):
+    "Build an XPath-like path from the local names of the ancestors."
+    steps = []
+    while element is not None:
+        parent = element.getparent()
+        tag = element.tag
+        name = _local_name(tag)
+        if parent is not None:
+            position = sum(1 for sibling in element.itersiblings(tag, preceding=True))
+            if position or next(element.itersiblings(tag), None) is not None:
+                name = u'%s[%d]' % (name, position + 1)
+        steps.append(name)
+        element = parent
+    steps.reverse()
+    return u'/' + u'/'.join(steps)
+
+
+# The checkers append (element, message) tuples to the errors list.
+
+def _check(element, errors):
+    checker = _CHECKERS.get(element.tag)
+    if checker is None:
+        errors.append( (element, u'unsupported element %s' % _local_name(element.tag)) )
+    else:
+        checker(element, errors)
+
+def _check_constant(element, errors):
+    if len(element) or element.text:
+        errors.append( (element, u'%s must be empty' % _local_name(element.tag)) )
+
+def _check_ci(element, errors):
+    text = element.text
+    if len(element):
+        errors.append( (element, u'ci must not have children') )
+    elif not text or not text.strip():
+        errors.append( (element, u'ci must contain a name') )
+
+def _check_cn(element, errors):
+    valuetype = element.get('type')
+    try:
+        matchers = _CN_TYPES[valuetype]
+    except KeyError:
+        errors.append( (element, u'unsupported cn type %s' % valuetype) )
+        return
+    if len(matchers) == 1:
+        text = element.text
+        if len(element):
+            errors.append( (element, u'cn of type %s must not have children' % (
+                        valuetype or u'real')) )
+        elif not text or not matchers[0](text):
+            errors.append( (element, u'invalid %s value %r' % (valuetype or u'real', text)) )
+        return
+    valuetype = valuetype or u'real'
+
+    if len(element) != 1 or element[0].tag != _SEP_TAG:
+        errors.append( (element, u'cn of type %s needs exactly one sep child' % valuetype) )
+        return
+    sep = element[0]
+    if len(sep) or sep.text:
+        errors.append( (sep, u'sep must be empty') )
+    for value, matcher in zip((element.text, sep.tail), matchers):
+        if not value or not matcher(value):
+            errors.append( (element, u'invalid %s value %r' % (valuetype, value)) )
+            break
+
+def _check_apply(element, errors):
+    children = iter(element)
+    for operator in children:
+        break
+    else:
+        errors.append( (element, u'apply needs an operator') )
+        return
+    tag = operator.tag
+    try:
+        min_count, max_count = _ARITIES[tag]
+    except KeyError:
+        errors.append( (operator, u'unsupported operator %s' % _local_name(tag)) )
+        return
+    if operator.text is not None or len(operator):
+        errors.append( (operator, u'operator %s must be empty' % _local_name(tag)) )
+
+    count = len(element) - 1
+    if count < min_count or (max_count is not None and count > max_count):
+        if max_count == min_count:
+            expected = u'%d operand%s' % (min_count, _plural(min_count))
+        elif count < min_count:
+            expected = u'at least %d operand%s' % (min_count, _plural(min_count))
+        else:
+            expected = u'at most %d operand%s' % (max_count, _plural(max_count))
+        errors.append( (element, u'%s takes %s, got %d' % (
+                    _local_name(tag), expected, count)) )
+
+    get_checker = _CHECKERS.get
+    for operand in children:
+        checker = get_checker(operand.tag)
+        if checker is None:
+            _check(operand, errors)
+        else:
+            checker(operand, errors)
+
+def _check_piecewise(element, errors):
+    last = len(element) - 1
+    if last < 0:
+        errors.append( (element, u'piecewise needs at least one piece') )
+        return
+    for i, child in enumerate(element):
+        tag = child.tag
+        if tag == _PIECE_TAG:
+            if len(child) != 2:
+                errors.append( (child, u'piece needs exactly 2 children, got %d' % len(child)) )
+        elif tag == _OTHERWISE_TAG and i == last:
+            if len(child) != 1:
+                errors.append( (child, u'otherwise needs exactly 1 child, got %d' % len(child)) )
+        else:
+            errors.append( (child, u'unexpected element in piecewise') )
+            continue
+        for grandchild in child:
+            _check(grandchild, errors)
+
+def _check_list(element, errors):
+    for child in element:
+        _check(child, errors)
+
+def _check_interval(element, errors):
+    closure = element.get('closure')
+    if closure is not None and closure not in _CLOSURES:
+        errors.append( (element, u'unsupported interval closure %s' % closure) )
+    if len(element) != 2:
+        errors.append( (element, u'interval needs exactly 2 children, got %d' % len(element)) )
+    for child in element:
+        _check(child, errors)
+
+_CHECKERS = dict((_NAMESPACE + name, _check_constant) for name in _CONSTANTS)
+_CHECKERS.update([
+    (_NAMESPACE + u'ci',        _check_ci),
+    (_NAMESPACE + u'cn',        _check_cn),
+    (_NAMESPACE + u'apply',     _check_apply),
+    (_NAMESPACE + u'piecewise', _check_piecewise),
+    (_NAMESPACE + u'list',      _check_list),
+    (_NAMESPACE + u'interval',  _check_interval)
+    ])
+
+
+class StructureValidator(object):
+    """Validator for the Content MathML subset that MathDOM supports.
+
+    Like the lxml validators, validate() returns True or False and
+    leaves the errors in the error_log attribute, as a list of (path,
+    message) tuples.
+    """
+    def __init__(self):
+        self.error_log = []
+
+    def __call__(self, tree):
+        return self.validate(tree)
+
+    def validate(self, tree):
+        "Validate a MathDOM, ElementTree or element."
+        errors = []
+        try:
+            root = tree.getroot()
+        except AttributeError:
+            root = tree
+        if root.tag == _MATH_TAG:
+            if len(root) != 1:
+                errors.append( (root, u'math needs exactly 1 child, got %d' % len(root)) )
+            else:
+                _check(root[0], errors)
+        else:
+            _check(root, errors)
+        self.error_log = [ (_element_path(element), message)
+                           for element, message in errors ]
+        return not errors
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
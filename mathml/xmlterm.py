@@ -78,7 +78,8 @@ from xml.sax.xmlreader import XMLReader, AttributesNSImpl
 from xml.sax.handler import feature_namespaces
 
 from mathml             import MATHML_NAMESPACE_URI
-from mathml.termparser  import term_parsers
+from mathml.datatypes   import number_str, complex_strs
+from mathml.termparser  import term_parsers, LiteralList
 from mathml.termbuilder import tree_converters
 
 
@@ -86,7 +87,7 @@ def mkstr(value):
     if isinstance(value, (str, unicode)):
         return value
     else:
-        return unicode(str(value), 'ascii')
+        return number_str(value)
 
 
 _ELEMENT_CONSTANT_MAP = {
@@ -119,11 +120,13 @@ _FUNCTION_MAP = {
 
 # OUTPUT:
 
-def serialize_dom(doc_or_element, output_format=None, converter=None):
+def serialize_dom(doc_or_element, output_format=None, converter=None,
+                  typed_value=None):
     """Serialize a MathDOM document into a term.
 
     You can specify either a converter or an output format. If neither
-    of the two is given, it defaults to the 'infix' converter.
+    of the two is given, it defaults to the 'infix' converter.  See
+    dom_to_tree() for the typed_value argument.
     """
     if output_format is None:
         output_format = 'infix'
@@ -131,12 +134,17 @@ def serialize_dom(doc_or_element, output_format=None, converter=None):
         converter = tree_converters.fortype(output_format)
         if converter is None:
             raise ValueError, "Unsupported output format '%s'" % output_format
-    tree = dom_to_tree(doc_or_element)
+    tree = dom_to_tree(doc_or_element, typed_value)
     return converter.build(tree)
 
 
-def dom_to_tree(doc_or_element):
-    "Convert a MathDOM document or element into its AST representation."
+def dom_to_tree(doc_or_element, typed_value=None):
+    """Convert a MathDOM document or element into its AST representation.
+
+    typed_value is an optional function that returns the (valuetype,
+    value) pair of a 'cn' element, e.g. from a value cache.  The default
+    is to call its valuetype() and value() methods.
+    """
     map_operator = dict((v,n) for (n,v) in _FUNCTION_MAP.iteritems()).get
     map_constant = dict((v,n) for (n,v) in _ELEMENT_CONSTANT_MAP.iteritems()).get
     def _recursive_piecewise(piecewise):
@@ -180,7 +188,11 @@ def dom_to_tree(doc_or_element):
         elif mtype == u'ci':
             return [ u'name', element.name() ]
         elif mtype == u'cn':
-            return [ u'const:%s' % element.valuetype().replace('-', ''), element.value() ]
+            if typed_value is None:
+                valuetype, value = element.valuetype(), element.value()
+            else:
+                valuetype, value = typed_value(element)
+            return [ u'const:%s' % valuetype.replace('-', ''), value ]
         elif mtype == u'apply':
             operator = element.operator()
             if operator.childNodes:
@@ -336,10 +348,13 @@ class SaxTerm(XMLReader):
             self._send_function(operator, tree)
 
     def _send_bin_constant(self, typename, value):
-        try:
-            parts = tuple(value)
-        except:
-            raise NotImplementedError, "Only MathDOM types are constant pairs."
+        if type(value) is complex:
+            parts = complex_strs(value)
+        else:
+            try:
+                parts = tuple(value)
+            except:
+                raise NotImplementedError, "Only MathDOM types are constant pairs."
 
         parts = map(mkstr, parts)
 
@@ -370,13 +385,24 @@ class SaxTerm(XMLReader):
         el_close(u'piecewise')
 
     def _send_list(self, tree, list_type, attributes):
-        tree_to_sax = self._recursive_tree_to_sax
-
         self._open_tag(list_type, attributes)
-        for elem in islice(tree, 1, None):
-            tree_to_sax(elem)
+        if type(tree) is LiteralList:
+            self._send_literals(tree)
+        else:
+            tree_to_sax = self._recursive_tree_to_sax
+            for elem in islice(tree, 1, None):
+                tree_to_sax(elem)
         self._close_tag(list_type)
 
+    def _send_literals(self, tree):
+        parser = self.parser
+        tag = (MATHML_NAMESPACE_URI, u'cn')
+        attributes = self._attributes(type=tree.const_type[6:])
+        for value in tree.values:
+            parser.startElementNS(tag, u'cn', attributes)
+            parser.characters(mkstr(value))
+            parser.endElementNS(tag, u'cn')
+
     def _send_function(self, fname, tree):
         self._open_tag(u'apply', self.NO_ATTR)
         self._write_element(fname)
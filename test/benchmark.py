@@ -0,0 +1,474 @@
+__doc__ = """
+Benchmarks for the lxml based MathDOM implementation.
+
+Usage: python benchmark.py [benchmark_name ...]
+
+Runs all benchmarks if no names are given.  Memory measurements are
+taken in forked child processes, so they only work on Unix systems.
+"""
+
+import sys
+sys.path.insert(0, '..')
+
+import os, time, resource, marshal, subprocess
+from multiprocessing import cpu_count
+
+from mathml import MATHML_NAMESPACE_URI
+
+
+BENCHMARKS = []
+
+def benchmark(function):
+    "Decorator that registers a benchmark function."
+    BENCHMARKS.append(function)
+    return function
+
+
+def _tag(name):
+    return '{%s}%s' % (MATHML_NAMESPACE_URI, name)
+
+def _timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+def _in_child(function, *args):
+    """Run function in a forked child process and return its result
+    together with the peak memory (in KB) that the child used on top
+    of the parent."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = function(*args)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, marshal.dumps((result, peak_rss - base_rss)))
+        os._exit(0)
+    os.close(write_fd)
+    data = []
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return marshal.loads(''.join(data))
+
+def _report(name, *columns):
+    print "  %-32s" % name + ''.join("%16s" % (c,) for c in columns)
+
+
+# documents
+
+def build_large_document(node_count=1000000):
+    """Build a MathDOM with about node_count elements: a sum of
+    products of identifiers and numbers."""
+    from mathml.lmathdom import MathDOM, Apply, Identifier, Constant
+    doc = MathDOM()
+    plus = Apply(doc, 'plus')
+    for i in xrange(node_count // 5):
+        times = Apply(plus, 'times')
+        Identifier(times, 'x%d' % (i % 100))
+        Constant(times, i, 'integer')
+    return doc
+
+
+# benchmarks
+
+@benchmark
+def lazy_iterators():
+    "Time to first result and peak memory of the MathElement iterators."
+    doc = build_large_document()
+    root = doc.getroot()
+
+    def first(lazy):
+        return _timed(lambda : root.iternumbers(lazy).next())[0]
+
+    def exhaust(lazy):
+        return _timed(lambda : sum(1 for _ in root.iternumbers(lazy)))[0]
+
+    _report('iternumbers()', 'first [s]', 'all [s]', 'peak [KB]')
+    for lazy in (False, True):
+        first_time = first(lazy)
+        all_time, peak = _in_child(exhaust, lazy)
+        _report('lazy=%s' % lazy, '%.5f' % first_time, '%.3f' % all_time, peak)
+
+
+_IMPORT_TIMER = """
+import sys, time
+sys.path.insert(0, '..')
+start = time.time()
+from mathml.lmathdom import MathDOM
+imported = time.time()
+doc = MathDOM.fromString('a+3*(4+b)', 'infix_term')
+start_pmathml = time.time()
+doc.to_pmathml()
+pmathml = time.time()
+doc.validate()
+validated = time.time()
+print imported - start, pmathml - start_pmathml, validated - pmathml
+"""
+
+@benchmark
+def import_time():
+    "Import time of mathml.lmathdom and cost of the first XSLT and RelaxNG use."
+    runs = 5
+    timings = []
+    for i in xrange(runs):
+        output = subprocess.Popen([sys.executable, '-c', _IMPORT_TIMER],
+                                  stdout=subprocess.PIPE).communicate()[0]
+        timings.append(map(float, output.split()))
+    _report('', 'import [s]', 'to_pmathml [s]', 'validate [s]')
+    _report('best of %d' % runs, *[ '%.4f' % min(column)
+                                    for column in zip(*timings) ])
+
+
+@benchmark
+def validation():
+    "Structure validation compared to RelaxNG validation."
+    from mathml.lmathdom import MathDOM
+    terms = ['a+3*(4.5+b)^2-1', 'case a > 1 then 2 else 1/3 end',
+             'sin(x*pi)/(1+5i) - 1E5*max(a,b,c)']
+    small_docs = [ MathDOM.fromString(term, 'infix_term')
+                   for term in terms ] * 1000
+    large_docs = [ build_large_document(100000) ]
+
+    _report('', 'small [s]', 'large [s]')
+    for strict in (False, True):
+        MathDOM.validate_many(small_docs[:1], strict) # compile schema
+        timings = [ '%.4f' % _timed(MathDOM.validate_many, docs, strict)[0]
+                    for docs in (small_docs, large_docs) ]
+        _report(strict and 'RelaxNG' or 'StructureValidator', *timings)
+
+
+@benchmark
+def pmathml_threads():
+    "Throughput of the uncached XSLT conversion with different thread counts."
+    from mathml.lmathdom import MathDOM, xsltify_many, PMATHML_FORMAT
+    docs = [ MathDOM.fromString('sin(x*%d)/(1+a^%d) - max(b,c)' % (i, i),
+                                'infix_term')
+             for i in xrange(2000) ]
+    _report('threads (%d CPUs)' % cpu_count(), 'time [s]', 'docs/s')
+    for threads in (1, 2, 4, 8):
+        xsltify_many(docs[:threads*4], PMATHML_FORMAT, threads, False) # start the pool
+        t = _timed(xsltify_many, docs, PMATHML_FORMAT, threads, False)[0]
+        _report(threads, '%.3f' % t, '%d' % (len(docs) / t))
+
+
+@benchmark
+def pmathml_thread_batches():
+    "Throughput of many small uncached XSLT batches with different thread counts."
+    from mathml.lmathdom import MathDOM, xsltify_many, PMATHML_FORMAT
+    docs = [ MathDOM.fromString('sin(x*%d)/(1+a^%d) - max(b,c)' % (i, i),
+                                'infix_term')
+             for i in xrange(2000) ]
+    batches = [ docs[i:i+50] for i in xrange(0, len(docs), 50) ]
+    def run(threads):
+        for batch in batches:
+            xsltify_many(batch, PMATHML_FORMAT, threads, False)
+    _report('threads (%d CPUs)' % cpu_count(), 'time [s]', 'docs/s')
+    for threads in (1, 2, 4, 8):
+        run(threads) # start the pool and copy the stylesheets
+        t = _timed(run, threads)[0]
+        _report(threads, '%.3f' % t, '%d' % (len(docs) / t))
+
+
+@benchmark
+def pmathml_native():
+    "Throughput of the native Presentational MathML output compared to the XSLT."
+    from mathml.lmathdom import MathDOM, XSLT_CACHE
+    docs = [ MathDOM.fromString('a*%d + (b-%d)^2 / max(c, ln(x)) - 1.5' % (i, i),
+                                'infix_term')
+             for i in xrange(2000) ]
+    docs[0].serialize('pmathml') # compile stylesheet
+    _report('', 'time [s]', 'docs/s')
+    for output_format in ('pmathml', 'pmathml_native'):
+        XSLT_CACHE.clear()
+        t = _timed(lambda : [ doc.serialize(output_format) for doc in docs ])[0]
+        _report(output_format, '%.3f' % t, '%d' % (len(docs) / t))
+
+
+@benchmark
+def fingerprints():
+    "Throughput of the structural digests and the semantic fingerprints."
+    from mathml.termparser import term_parsers
+    from mathml.termhash import tree_digest
+    from mathml.termfingerprint import TermFingerprinter
+    parse = term_parsers['infix_term'].parse
+    trees = [ parse('a*%d + (b-%d)^2 / max(c, ln(x%d)) - 1.5' % (i, i, i % 10))
+              for i in xrange(200) ] * 50
+    _report('', 'time [s]', 'terms/s')
+    for name, function in (('tree_digest', tree_digest),
+                           ('fingerprint', TermFingerprinter().fingerprint)):
+        t = _timed(lambda : map(function, trees))[0]
+        _report(name, '%.3f' % t, '%d' % (len(trees) / t))
+
+
+@benchmark
+def term_templates():
+    "Throughput of TermTemplate compared to substituting and serializing a MathDOM."
+    from mathml.termtemplate import TermTemplate
+    template = TermTemplate('a*x^2 + b*x - c/(x+1)', ['a', 'b', 'c'])
+    bindings = [ {'a' : i, 'b' : -i, 'c' : i * 0.5} for i in xrange(1000) ]
+    _report('', 'substitute [s]', 'template [s]', 'speedup')
+    for output_format in ('mathml', 'pmathml', 'infix'):
+        slow = _timed(lambda : [ template.to_dom(values).serialize(output_format)
+                                 for values in bindings ])[0]
+        fast = _timed(lambda : [ template.serialize(values, output_format)
+                                 for values in bindings ])[0]
+        _report(output_format, '%.3f' % slow, '%.3f' % fast, '%.1f' % (slow / fast))
+
+
+@benchmark
+def binary_serialization():
+    "Size and speed of the binary AST encoding compared to MathML text."
+    from mathml.lmathdom import MathDOM
+    from mathml.termbinary import tree_to_binary, tree_from_binary
+    docs = [ MathDOM.fromString(
+                'case a > %d then 2*(x+1.50)^2 - 1/3 else 1E-3*(2-5i) + max(a, b, -%d) end'
+                % (i, i), 'infix_term')
+             for i in xrange(100) ] * 20
+    trees  = [ doc.to_tree() for doc in docs ]
+    mathml = [ doc.serialize() for doc in docs ]
+    binary = map(tree_to_binary, trees)
+
+    _report('', 'MathML', 'binary')
+    _report('bytes per document', *[ sum(map(len, data)) // len(docs)
+                                     for data in (mathml, binary) ])
+    _report('encode AST [s]',
+            '%.3f' % _timed(lambda : [ MathDOM.fromTree(tree).serialize()
+                                       for tree in trees ])[0],
+            '%.3f' % _timed(lambda : map(tree_to_binary, trees))[0])
+    _report('decode to AST [s]',
+            '%.3f' % _timed(lambda : [ MathDOM.fromString(data).to_tree()
+                                       for data in mathml ])[0],
+            '%.3f' % _timed(lambda : map(tree_from_binary, binary))[0])
+
+
+@benchmark
+def pickling():
+    "Pickle size and speed of MathDOMs and ASTs compared to a MathML round trip."
+    import cPickle
+    from mathml.lmathdom import MathDOM
+    docs = [ MathDOM.fromString(
+                'case a > %d then 2*(x+1.50)^2 - 1/3 else 1E-3*(2-5i) + max(a, b, -%d) end'
+                % (i, i), 'infix_term')
+             for i in xrange(300) ]
+    trees = [ doc.to_tree() for doc in docs ]
+
+    def mathml_round_trip():
+        data = [ doc.serialize() for doc in docs ]
+        return sum(map(len, data)), [ MathDOM.fromString(d) for d in data ]
+
+    def pickle_round_trip(objects):
+        data = cPickle.dumps(objects, 2)
+        return len(data), cPickle.loads(data)
+
+    _report('', 'time [s]', 'bytes per doc')
+    for name, function, args in (('MathML round trip', mathml_round_trip, ()),
+                                 ('pickled MathDOMs', pickle_round_trip, (docs,)),
+                                 ('pickled ASTs', pickle_round_trip, (trees,))):
+        t, (size, result) = _timed(function, *args)
+        _report(name, '%.3f' % t, size // len(docs))
+
+
+@benchmark
+def datatype_memory():
+    "Memory and construction time of the numeric datatypes."
+    from mathml.datatypes import Decimal, Complex, Rational, ENotation
+    count = 200000
+    constructors = (
+        ('Complex',   lambda i : Complex(Decimal(i), Decimal('-2.5'))),
+        ('Rational',  lambda i : Rational(i, 7)),
+        ('ENotation', lambda i : ENotation(u'1.5', i % 50 - 25)),
+        )
+
+    def build(constructor):
+        t, values = _timed(map, constructor, xrange(count))
+        return t
+
+    _report('', 'time [s]', 'bytes per value')
+    for name, constructor in constructors:
+        t, peak = _in_child(build, constructor)
+        _report(name, '%.3f' % t, peak * 1024 // count)
+
+
+@benchmark
+def numeric_modes():
+    "Parsing and serializing a term with many number literals in each numeric mode."
+    from mathml.termparser import InfixTermParser, build_parser
+    from mathml.termbuilder import tree_converters
+    term = ' + '.join( '%d.%02d*x%d - (%d.5-%di)' % (i, i % 100, i, i, i)
+                       for i in xrange(300) )
+    build = tree_converters['infix'].build
+    literals = [ ['%d.%02d' % (i, i % 100)] for i in xrange(100000) ]
+    complex_literals = [ ['%d.5' % i, '-%d' % i] for i in xrange(100000) ]
+
+    def convert(parse_action, tokens):
+        for t in tokens:
+            parse_action(None, None, t)
+
+    _report('', 'parse [s]', 'infix [s]', '100000 reals', '100000 complex')
+    for mode in ('decimal', 'lazy', 'float'):
+        term_parser = InfixTermParser(mode)
+        parser = build_parser(term_parser.p_arithmetic_exp())
+        parse_time, tree = _timed(parser.parse, term)
+        build_time, output = _timed(build, tree)
+        tokenizer = term_parser.tokenizer
+        real_time, _ = _timed(convert, tokenizer._parse_float, literals)
+        complex_time, _ = _timed(convert, tokenizer._parse_complex, complex_literals)
+        _report(mode, '%.3f' % parse_time, '%.3f' % build_time,
+                '%.3f' % real_time, '%.3f' % complex_time)
+
+
+@benchmark
+def literal_lists():
+    "Parsing huge number lists with the literal fast path and with the list grammar."
+    from mathml.termparser import (term_parsers, build_parser, ListParser,
+                                   InfixTermParser, LiteralListParser)
+    from mathml.termbuilder import tree_converters
+    p_list = ListParser(InfixTermParser().p_arithmetic_exp()).p_list()
+    grammar = build_parser(p_list)
+    float_parser = LiteralListParser(p_list, 'float')
+    build = tree_converters['infix'].build
+    count = 1000000
+    integers = ', '.join(map(str, xrange(-count//2, count//2)))
+    reals    = ', '.join( '%d.%02d' % (i, i % 100) for i in xrange(-count//2, count//2) )
+
+    def parse(parser, term):
+        t, tree = _timed(parser.parse, term)
+        return t, len(tree) - 1
+
+    _report('', 'parse [s]', 'infix [s]', 'bytes per item')
+    for name, parser, term in (
+        ('integers', term_parsers['infix_term_list'], integers),
+        ('reals', term_parsers['infix_term_list'], reals),
+        ('reals, float mode', float_parser, reals),
+        ('integers, grammar only', grammar, integers[:integers.index(', -%d,' % (count//2 - 20000))])):
+        (parse_time, items), peak = _in_child(parse, parser, term)
+        build_time, output = _timed(build, parser.parse(term))
+        _report('%s (%d)' % (name, items), '%.3f' % parse_time, '%.3f' % build_time,
+                peak * 1024 // items)
+
+
+@benchmark
+def parallel_lists():
+    "Parsing a huge list of sub-expressions with worker processes."
+    from multiprocessing import cpu_count
+    from mathml.termparser import term_parsers, ParallelListParser
+    term = ', '.join( 'max(%d, a*b) + case x > %d then 1.5 else 2 end' % (i, i)
+                      for i in xrange(500) )
+    t, expected = _timed(term_parsers.parse, term, 'infix_term_list')
+
+    _report('', 'time [s]')
+    _report('list grammar', '%.3f' % t)
+    for processes in sorted(set([1, 2, cpu_count()])):
+        parser = ParallelListParser('infix_term', processes)
+        t, tree = _timed(parser.parse, term)
+        assert tree == expected
+        _report('%d processes' % processes, '%.3f' % t)
+        t, tree = _timed(parser.parse, term)
+        _report('%d processes, started' % processes, '%.3f' % t)
+        parser.close()
+
+
+@benchmark
+def ast_python_parser():
+    "Parsing Python terms with pyparsing and with the ast module."
+    import mathml.utils.pyterm
+    from mathml.termparser import term_parsers
+    terms = [ 'a*x**2 + %d.5*b - sin(x/%d) + 1E-3' % (i, i+1) for i in xrange(500) ]
+    bool_terms = [ "x in xrange(%d, 10) and not y or a*b < %d.5" % (i, i)
+                   for i in xrange(500) ]
+
+    _report('', 'time [s]')
+    for name, items in (('python_term', terms), ('python_ast_term', terms),
+                        ('python_bool', bool_terms), ('python_ast_bool', bool_terms)):
+        parse = term_parsers[name].parse
+        t, trees = _timed(map, parse, items)
+        _report('%s (%d terms)' % (name, len(items)), '%.3f' % t)
+
+
+@benchmark
+def python_intervals():
+    "Evaluating interval membership in the Python output."
+    import mathml.utils.pyterm
+    from mathml.termparser import term_parsers
+    from mathml.termbuilder import tree_converters
+
+    values = range(0, 2000000, 20000)
+    _report('', 'xrange [s]', 'comparisons [s]')
+    for width in (100, 10000, 1000000):
+        tree = term_parsers.parse('x in [0, %d)' % width, 'infix_bool')
+        times = []
+        for output_format in ('python', 'python_interval_comparisons'):
+            code = compile(tree_converters[output_format].build(tree), '<term>', 'eval')
+            t, results = _timed(map, lambda x: eval(code, {'x' : x}), values)
+            times.append('%.4f' % t)
+        _report('width %d (%d records)' % (width, len(values)), *times)
+
+
+@benchmark
+def sql_parameters():
+    "Filtering a SQLite table with inline and with parameterized SQL."
+    import sqlite3
+    import mathml.utils.sqlterm
+    from mathml.utils.sqlterm import StatementCache
+    from mathml.termparser import term_parsers
+    from mathml.termbuilder import tree_converters
+    from mathml.termsubst import TreeSubstitution
+    builder = tree_converters['sql']
+
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE items (id INTEGER, weight REAL, price REAL)')
+    connection.executemany('INSERT INTO items VALUES (?, ?, ?)',
+                           [ (i, i % 17 * 0.5, i % 23) for i in xrange(20) ])
+    template = term_parsers.parse(' or '.join(
+        '(weight > a%d and price * 2 <= b%d + weight)' % (k, k) for k in xrange(8)),
+                                  'infix_bool')
+    trees = TreeSubstitution(template).substitute_many(
+        dict( item for k in xrange(8)
+              for item in (('a%d' % k, ('const:real', i % 97 + k + 0.5)), ('b%d' % k, i + k)) )
+        for i in xrange(2000) )
+
+    def build_inline():
+        return [ builder.build(tree) for tree in trees ]
+
+    def run_inline(predicates):
+        for sql in predicates:
+            connection.execute('SELECT count(*) FROM items WHERE ' + sql).fetchall()
+
+    def prepare(sql):
+        sql = 'SELECT count(*) FROM items WHERE ' + sql
+        def execute(params):
+            return connection.execute(sql, params).fetchall()
+        return execute
+    cache = StatementCache(prepare)
+
+    def build_parameterized():
+        return map(builder.build_parameterized, trees)
+
+    def run_parameterized(predicates):
+        for sql, params in predicates:
+            cache.get(sql)(params)
+
+    _report('', 'build [s]', 'execute [s]', 'executions/s')
+    for name, build, run in (('inline', build_inline, run_inline),
+                             ('parameterized', build_parameterized, run_parameterized)):
+        build_time, predicates = _timed(build)
+        t, result = _timed(run, predicates)
+        _report('%s (%d queries)' % (name, len(trees)), '%.3f' % build_time,
+                '%.3f' % t, '%.0f' % (len(trees) / t))
+    _report('cache misses / hits', '%d / %d' % (cache.misses, cache.hits))
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for function in BENCHMARKS:
+        if names and function.__name__ not in names:
+            continue
+        print "%s: %s" % (function.__name__, function.__doc__)
+        function()
+        print
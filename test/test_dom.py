@@ -115,5 +115,712 @@ class MathdomTestCase(unittest.TestCase):
                           '1 + 2 + 3')
 
 
+    @for_lmathdom
+    def test_lxpath_cache(self, lmathdom, doc):
+        doc = lmathdom.MathDOM.fromString('a+3*(4+b)', 'infix_term')
+        self.assertEquals(len(doc.xpath('//math:ci')), 2)
+        self.assert_(('//math:ci', None) in lmathdom._XPATH_CACHE)
+        self.assertEquals(len(doc.xpath('//m:cn', {'m' : lmathdom.MATHML_NAMESPACE_URI})), 2)
+        root = doc.getroot()
+        self.assertEquals([ e.name() for e in root.iteridentifiers() ],
+                          ['a', 'b'])
+        self.assertEquals(len(root.xpath('.//m:apply', {'m' : lmathdom.MATHML_NAMESPACE_URI})), 3)
+
+
+    @for_lmathdom
+    def test_llazy_iterators(self, lmathdom, doc):
+        doc = lmathdom.MathDOM.fromString('a+3*sin(4+b)-pi = true', 'infix_bool')
+        root = doc.getroot()
+        for name in ('iteridentifiernames', 'iterconstantnames',
+                     'iternumbervalues'):
+            method = getattr(root, name)
+            self.assertEquals(list(method()), list(method(lazy=True)))
+        self.assertEquals([ e.localName for e in root.iteroperators() ],
+                          [ e.localName for e in root.iteroperators(lazy=True) ])
+
+
+    @for_lmathdom
+    def test_lindex(self, lmathdom, doc):
+        doc = lmathdom.MathDOM.fromString('a+3*(4.5+a)*pi', 'infix_term')
+        index = doc.index()
+        self.assertEquals(len(index.identifiers('a')), 2)
+        self.assertEquals(index.identifiers('b'), [])
+        self.assertEquals(len(index.applies('plus')), 2)
+        self.assertEquals(len(index.numbers('integer')), 1)
+        self.assertEquals(len(index.numbers('real')), 1)
+        self.assertEquals(len(index.constants('pi')), 1)
+        self.assert_(doc.index() is index)
+
+        for apply_tag in index.applies('plus'):
+            apply_tag.set_operator(u'minus')
+        lmathdom.Identifier(index.applies('times')[0], 'b')
+        index = doc.index()
+        self.assertEquals(index.applies('plus'), [])
+        self.assertEquals(len(index.applies('minus')), 2)
+        self.assertEquals(len(index.identifiers('b')), 1)
+
+        other = lmathdom.MathDOM.fromString('x+y', 'infix_term')
+        other.getroot()[0].set_operator(u'times')
+        other.substitute_many([{'x' : 1}])
+        doc.substitute_many([{'a' : 1}])
+        self.assert_(doc.index() is index)
+
+
+    @for_lmathdom
+    def test_lembedded_modifications(self, lmathdom, doc):
+        doc = lmathdom.MathDOM.fromString(
+            '<html><body><math xmlns="http://www.w3.org/1998/Math/MathML">'
+            '<apply><plus/><ci>a</ci><apply><log/><logbase><cn>2</cn></logbase>'
+            '<cn>8</cn></apply></apply></math></body></html>')
+        self.assertEquals(len(doc.index().applies('plus')), 1)
+        self.assertEquals(list(doc.iternumbervalues()), [2, 8])
+
+        doc.xpath('//math:apply')[0].set_operator(u'minus')
+        doc.xpath('//math:log')[0].logbase = '10'
+        self.assertEquals(doc.index().applies('plus'), [])
+        self.assertEquals(len(doc.index().applies('minus')), 1)
+        self.assertEquals(len(doc.value_cache), 1)
+
+        doc.substitute({'a' : 1})
+        self.assertEquals(doc.index().identifiers('a'), [])
+        self.assertEquals(list(doc.iternumbervalues()), [1, 8])
+
+
+    @for_lmathdom
+    def test_lvalue_cache(self, lmathdom, doc):
+        doc = lmathdom.MathDOM.fromString('1.5+3*(4+5i)', 'infix_term')
+        cache = doc.value_cache
+        self.assertEquals(doc.serialize('infix'), doc.serialize('infix'))
+        self.assertEquals(cache.stats(), (3, 3, 3))
+
+        cn = doc.xpath('//math:cn')[0]
+        cn.set_value(2)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(list(doc.iternumbervalues())[0], 2)
+        self.assertEquals(cache.stats(), (5, 4, 3))
+        self.assertEquals(cache.typed_value(cn), ('integer', 2))
+        self.assertEquals(len(doc.index(rebuild=True).numbers('integer')), 2)
+        self.assertEquals(cache.stats(), (9, 4, 3))
+
+        doc = lmathdom.MathDOM.fromString(
+            '<math xmlns="http://www.w3.org/1998/Math/MathML"><apply><log/>'
+            '<logbase><cn>2</cn></logbase><cn>8</cn></apply></math>')
+        cache = doc.value_cache
+        self.assertEquals(list(doc.iternumbervalues()), [2, 8])
+        doc.xpath('//math:log')[0].logbase = '10'
+        self.assertEquals(len(cache), 1)
+        self.assertEquals(list(doc.iternumbervalues()), [8])
+
+
+    @for_lmathdom
+    def test_lvalidate_many(self, lmathdom, doc):
+        docs = [ lmathdom.MathDOM.fromString(term, 'infix_term')
+                 for term in ('a+1', '2*b') ]
+        lmathdom.Apply(doc, 'unknown', doc.createIdentifier('a'))
+        docs.append(doc)
+        for strict in (False, True):
+            error_logs = lmathdom.MathDOM.validate_many(docs, strict)
+            self.assertEquals(map(len, error_logs[:2]), [0, 0])
+            self.assert_(len(error_logs[2]) > 0)
+
+    @for_lmathdom
+    def test_lvalidate_structure(self, lmathdom, doc):
+        for term, term_type in (('a+3*(4.5+b)^2-1-c', 'infix_term'),
+                                ('case a > 1 then 2 else 1/3/c end', 'infix_term'),
+                                ('sin(a) = 1E5 and not x in [1,2)', 'infix_bool')):
+            doc = lmathdom.MathDOM.fromString(term, term_type)
+            self.assert_(doc.validate(), term)
+            self.assert_(doc.validate(strict=True), term)
+
+        doc = lmathdom.MathDOM.fromString('1+sin(a,2)+b', 'infix_term')
+        cn = doc.xpath('//math:cn')[0]
+        cn.text = 'x'
+        validator = lmathdom.StructureValidator()
+        self.failIf(validator.validate(doc))
+        self.assertEquals(validator.error_log, [
+                (u'/math/apply/cn', u"invalid integer value 'x'"),
+                (u'/math/apply/apply', u'sin takes 1 operand, got 2')])
+
+    @for_lmathdom
+    def test_lvalidate_test_terms(self, lmathdom, doc):
+        import mathml.utils.pyterm
+        from mathml.termparser import ParseException
+        from test import TERMS
+
+        doc = lmathdom.MathDOM.fromString('log(2, x)', 'infix_term')
+        self.assert_(doc.validate(), 'log(2, x)')
+
+        for term_type, terms in TERMS.iteritems():
+            for term, result in terms.iteritems():
+                if result is ParseException:
+                    continue
+                doc = lmathdom.MathDOM.fromString(term, term_type)
+                self.assert_(doc.validate(), (term_type, term))
+
+
+    @for_lmathdom
+    def test_lxslt_cache(self, lmathdom, doc):
+        cache = lmathdom.XSLT_CACHE
+        cache.clear()
+        doc = lmathdom.MathDOM.fromString('a+3*(4+b)', 'infix_term')
+        result = doc.serialize('pmathml')
+        pmathml = doc.to_pmathml()
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        pmathml.getroot().clear()
+        self.assertEquals(doc.serialize('pmathml'), result)
+
+        doc.xpath('//math:ci')[0].text = 'c'
+        self.assertNotEquals(doc.serialize('pmathml'), result)
+        self.assertEquals((cache.hits, cache.misses), (2, 2))
+
+        from lxml.etree import XSLT
+        StringParameter = lmathdom.StringParameter
+        build_key, root = cache.build_key, doc.getroot()
+        self.assertEquals(build_key(root, 'pmathml', {'p' : StringParameter(u'x\xe4')}),
+                          build_key(root, 'pmathml', {'p' : StringParameter(u'x\xe4')}))
+        self.assertNotEquals(build_key(root, 'pmathml', {'p' : StringParameter(u'x')}),
+                             build_key(root, 'pmathml', {'p' : StringParameter(u'y')}))
+        self.assertNotEquals(build_key(root, 'pmathml', {'p' : StringParameter(u'x')}),
+                             build_key(root, 'pmathml', {'p' : u'x'}))
+        self.assertEquals(build_key(root, 'pmathml', {'p' : XSLT.strparam(u'x')}), None)
+
+        result = doc.serialize('pmathml', p=XSLT.strparam(u'x'))
+        self.assertEquals((cache.hits, cache.misses), (2, 2))
+        self.assertEquals(doc.serialize('pmathml', p=StringParameter(u'x')), result)
+        self.assertEquals(doc.serialize('pmathml', p=StringParameter(u'x')), result)
+        self.assertEquals((cache.hits, cache.misses), (3, 3))
+
+
+    @for_lmathdom
+    def test_lto_pmathml_many(self, lmathdom, doc):
+        from lxml import etree
+        docs = [ lmathdom.MathDOM.fromString('a+%d*b' % i, 'infix_term')
+                 for i in range(10) ]
+        docs.insert(3, None)
+        results = lmathdom.MathDOM.to_pmathml_many(docs, threads=3)
+        self.assertEquals(len(results), 11)
+        self.assert_(isinstance(results[3][1], AttributeError))
+        del docs[3], results[3]
+        for doc, (result, error) in zip(docs, results):
+            self.assertEquals(error, None)
+            self.assertEquals(etree.tostring(result),
+                              etree.tostring(doc.to_pmathml()))
+
+
+    @for_lmathdom
+    def test_lpmathml_native(self, lmathdom, doc):
+        from mathml.presentation import to_presentation
+        terms = [ ('a+3*(4-b)', 'infix_term'), ('-a^2 - (-2)', 'infix_term'),
+                  ('(a+b)*(c-d)*e / (1-2i)', 'infix_term'),
+                  ('max(1.5, abs(-x), ln(a+b)) % exp(-a)', 'infix_term'),
+                  ('case a>1 then 2/3 else 1E-3 end', 'infix_term'),
+                  ('a <> b and (c < 1 or not d) or true', 'infix_bool'),
+                  ('x in [1,2) or x notin (pi, 4]', 'infix_bool') ]
+        for term, input_type in terms:
+            doc = lmathdom.MathDOM.fromString(term, input_type)
+            self.assertNotEquals(to_presentation(doc), None)
+            self.assertEquals(doc.serialize('pmathml_native'),
+                              doc.serialize('pmathml'))
+
+        # n-ary minus is not supported and falls back to the XSLT
+        doc = lmathdom.MathDOM.fromString('a-b-c', 'infix_term')
+        self.assertEquals(to_presentation(doc), None)
+        self.assertEquals(doc.serialize('pmathml_native'),
+                          doc.serialize('pmathml'))
+
+
+    @for_lmathdom
+    def test_lxslt_profile(self, lmathdom, doc):
+        docs = [ lmathdom.MathDOM.fromString('a+%d*b' % i, 'infix_term')
+                 for i in range(3) ]
+        result = docs[0].serialize('pmathml')
+        profile = lmathdom.XSLTProfile()
+        for i in range(2):
+            self.assertEquals(docs[0].serialize('pmathml', profile=profile), result)
+        results = lmathdom.xsltify_many(docs[1:], 'pmathml', 2, _profile=profile)
+        self.assertEquals([ error for result, error in results ], [None, None])
+        self.assertEquals(profile.runs, 4)
+
+        templates = dict( ((match, name), calls) for
+                          stylesheet, match, name, mode, calls, seconds
+                          in profile.templates() )
+        self.assertEquals(templates[('m:apply[*[1][self::m:plus]]', '')], 4)
+        self.assertEquals(templates[('m:ci', '')], 8)
+        self.assert_('m:apply[*[1][self::m:times]]' in profile.report())
+
+        lmathdom.XSLT_PROFILE.clear()
+        docs[0].xsltify('pmathml', _profile=True)
+        self.assertEquals(lmathdom.XSLT_PROFILE.runs, 1)
+
+
+    @for_lmathdom
+    def test_lcorpus_index(self, lmathdom, doc):
+        import os, tempfile, shutil
+        from mathml.corpus import CorpusIndex, identifier, operator, constant, number
+        terms = ['a.b + sin(x)', 'a.b * 1/3', 'sin(x) / 2.5', 'pi * r^2']
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'corpus.db')
+            index = CorpusIndex(path)
+            index.add_many( (i, lmathdom.MathDOM.fromString(term, 'infix_term'))
+                            for i, term in enumerate(terms) )
+            self.assertEquals(len(index), 4)
+            self.assert_((u'operator', u'sin') in index.features(0))
+            index.close()
+
+            index = CorpusIndex(path)
+            self.assertEquals(index.query(identifier('a.b') & operator('sin')), [0])
+            self.assertEquals(index.query(constant('pi') | number('real')), [2, 3])
+            self.assertEquals(index.count(operator('divide') | operator('times')), 3)
+            self.assertEquals(index.query(identifier('unknown')), [])
+
+            index.remove(2)
+            index.add('new', lmathdom.MathDOM.fromString('a.b^2', 'infix_term'))
+            self.failIf(2 in index)
+            self.assertEquals(index.query(identifier('a.b') & operator('power')), [u'new'])
+            self.assertEquals(index.query(number('real')), [])
+            index.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+    @for_lmathdom
+    def test_ldigest(self, lmathdom, doc):
+        from mathml.termparser import term_parsers
+        from mathml.termhash import tree_digest
+        term = '2*(a+1.50) - 3/4 + 1E3*(2-3i) = sin(pi)'
+        doc = lmathdom.MathDOM.fromString(term, 'infix_bool')
+        ast = term_parsers['infix_bool'].parse(term)
+        digest = doc.digest()
+        self.assertEquals(len(digest), 20)
+        self.assertEquals(digest, tree_digest(ast))
+        self.assertEquals(digest, doc.getroot()[0].digest())
+
+        mathml = lmathdom.MathDOM.fromString(doc.serialize('mathml'))
+        self.assertEquals(mathml.digest(), digest)
+
+        swapped = lmathdom.MathDOM.fromString(
+            'sin(pi) = 1E3*(2-3i) + (1.5+a)*2 - 3/4', 'infix_bool')
+        self.assertNotEquals(swapped.digest(), digest)
+        self.assertEquals(swapped.digest(True), doc.digest(True))
+        self.assertNotEquals(doc.digest(True), digest)
+
+        plus = doc.xpath('//math:apply[math:plus][math:ci]')[0]
+        self.assertEquals(plus.digest(True),
+                          tree_digest(term_parsers['infix_term'].parse('1.5+a'), True))
+
+
+    @for_lmathdom
+    def test_lfingerprint(self, lmathdom, doc):
+        from mathml.termparser import term_parsers
+        from mathml.termfingerprint import TermFingerprinter, \
+             fingerprint, near_duplicates
+        parse = term_parsers['infix_bool'].parse
+        same = ['2*(a+b) = sin(x)/3', 'sin(x)*(1/3) = 2*a + b*2',
+                'sin(x)/3 = a*2 + b + 1E0*b']
+        other = ['2*(a+b) = sin(-x)/3', '2*(a+b) > sin(x)/3',
+                 '2*(a+b) = cos(x)/3', '2*a+b = sin(x)/3']
+        docs = [ lmathdom.MathDOM.fromString(term, 'infix_bool')
+                 for term in same + other ]
+        fingerprints = map(fingerprint, docs)
+        self.assertEquals(len(fingerprints[0]), 4*8)
+        self.assertEquals(fingerprints[0], fingerprint(parse(same[0])))
+        self.assertEquals(len(set(fingerprints[:len(same)])), 1)
+        self.assertEquals(len(set(fingerprints)), len(other)+1)
+
+        fingerprinter = TermFingerprinter(points=2, seed='test')
+        self.assertEquals(len(fingerprinter.fingerprint(docs[0])), 2*8)
+        self.assertNotEquals(fingerprinter.fingerprint(docs[0]), fingerprints[0][:16])
+        self.assertEquals(near_duplicates(enumerate(docs), fingerprinter),
+                          [ range(len(same)) ])
+        self.assertRaises(ValueError, TermFingerprinter, 9)
+
+        fingerprinter = TermFingerprinter(cache_size=2)
+        self.assertEquals(map(fingerprinter.fingerprint, docs), fingerprints)
+        self.assertEquals(len(fingerprinter._name_values), 2)
+
+        parse = term_parsers['infix_term'].parse
+        self.assertNotEquals(fingerprint(parse('3+2i')), fingerprint(parse('3+2*i')))
+        self.assertEquals(fingerprint(parse('3+2i')), fingerprint(parse('2i+3')))
+
+
+    @for_lmathdom
+    def test_lsubstitute(self, lmathdom, doc):
+        from mathml.termparser import term_parsers
+        from mathml.termsubst import substitute_tree, TreeSubstitution
+        from mathml.datatypes import Rational
+        parse = term_parsers['infix_term'].parse
+        term = 'a*x^2 + b*x + c'
+        template = lmathdom.MathDOM.fromString(term, 'infix_term')
+        mappings = [ {'a' : 2, 'x' : 'y'},
+                     {'b' : Rational(1,3), 'x' : parse('sin(t)'), 'c' : 1.5},
+                     {'x' : lmathdom.MathDOM.fromString('a-1', 'infix_term'),
+                      'c' : parse('x')} ]
+        results = [ '2 * y ^ 2 + b * y + c',
+                    'a * sin ( t ) ^ 2 + (1/3) * sin ( t ) + 1.5',
+                    'a * ( a - 1 ) ^ 2 + b * ( a - 1 ) + x' ]
+
+        docs = template.substitute_many(mappings)
+        self.assertEquals(template.serialize('infix'), 'a * x ^ 2 + b * x + c')
+        self.assertEquals([ d.serialize('infix') for d in docs ], results)
+        self.assertEquals([ d.validate() for d in docs ], [True] * len(docs))
+
+        tree = parse(term)
+        self.assertEquals(substitute_tree(tree, {'x' : parse('sin(t)'), 'c' : 1.5}),
+                          parse('a*sin(t)^2 + b*sin(t) + 1.5'))
+        substitution = TreeSubstitution(tree, ['x'])
+        self.assertEquals(substitution.substitute({'a' : 1}), tree)
+        self.assertEquals(substitution.substitute({'x' : 'z'}),
+                          parse('a*z^2 + b*z + c'))
+
+        for mapping, result in zip(mappings, results):
+            doc = lmathdom.MathDOM.fromString(term, 'infix_term')
+            doc.index()
+            doc.substitute(mapping)
+            self.assertEquals(doc.serialize('infix'), result)
+            self.assertEquals(doc.index().identifiers('x'),
+                              doc.xpath('//math:ci[. = "x"]'))
+
+        doc = lmathdom.MathDOM.fromString('x', 'infix_term')
+        doc.substitute({'x' : True})
+        self.assertEquals(doc.serialize('infix'), 'true')
+
+
+    @for_lmathdom
+    def test_ltemplate(self, lmathdom, doc):
+        from mathml.termtemplate import TermTemplate
+        from mathml.datatypes import Rational, Complex, ENotation
+        template = TermTemplate('a*x^2 - b*(x+c) + max(a, -c)', ['a', 'b', 'c', 'd'])
+        bindings = [ {'a' : 1, 'b' : -2, 'c' : 0.5},
+                     {'a' : Rational(-1,3), 'b' : Complex('1', '-2'), 'c' : 'pi'},
+                     {'a' : ENotation('1.5', -3), 'b' : True, 'c' : 'y<z'},
+                     {'a' : 1, 'b' : ('+', ('name', 'x'), ('const:integer', 1)), 'c' : 2},
+                     {'a' : 1, 'b' : 2} ]
+        for values in bindings:
+            doc = template.to_dom(values)
+            for output_format in ('mathml', 'pmathml', 'infix', 'python'):
+                self.assertEquals(template.serialize(values, output_format),
+                                  doc.serialize(output_format))
+        self.assertEquals(template.serialize(bindings[0], 'infix'),
+                          '1 * x ^ 2 - -2 * ( x + 0.5 ) + max ( 1, - 0.5 )')
+        self.assertEquals(template.serialize(bindings[0], 'sql'),
+                          template.to_dom(bindings[0]).serialize('sql'))
+        self.assert_(template.to_dom(bindings[2]).validate())
+
+
+    @for_lmathdom
+    def test_lbinary(self, lmathdom, doc):
+        from mathml.termparser import term_parsers
+        from mathml.termbinary import tree_to_binary, tree_from_binary, \
+             BinaryFormatError
+        for term, term_type in (('a*x^2 + 1.50*a - 1/3 + 1E-3*(2-5i)', 'infix_term'),
+                                ('case a > 1 then 2*(-x)^1000 else -123456789123456789 end',
+                                 'infix_term'),
+                                ('sin(a) <> 1E5 and not x in [1,2) or b',
+                                 'infix_bool'),
+                                ('max(a.b, 0.000, -0.5) % 7', 'infix_term')):
+            tree = term_parsers[term_type].parse(term)
+            data = tree_to_binary(tree)
+            self.assertEquals(tree_from_binary(data), tree)
+            message = memoryview('header' + data + 'trailer')
+            self.assertEquals(tree_from_binary(message[6:6+len(data)]), tree)
+
+            doc = lmathdom.MathDOM.fromString(term, term_type)
+            self.assert_(len(data) * 4 < len(doc.serialize()))
+            tree_data = tree_to_binary(doc.to_tree())
+            self.assertEquals(lmathdom.MathDOM.fromTree(tree_from_binary(tree_data)).serialize(),
+                              doc.serialize())
+            self.assertEquals(lmathdom.MathDOM.fromTree(tree).serialize(),
+                              doc.serialize())
+
+        tree = term_parsers['infix_bool'].parse(u'"\xe4bc" = b')
+        self.assertEquals(tree_from_binary(tree_to_binary(tree)), tree)
+        self.assertRaises(BinaryFormatError, tree_from_binary, 'abc')
+        self.assertRaises(BinaryFormatError, tree_from_binary, data[:-1])
+        self.assertRaises(BinaryFormatError, tree_from_binary, data + 'x')
+
+
+    @for_lmathdom
+    def test_lpickle(self, lmathdom, doc):
+        import pickle, cPickle, copy
+        from mathml.termparser import term_parsers
+        from mathml.datatypes import Complex, Rational, ENotation
+        values = [ Complex('1.50', '-2'), Rational(-1, 3), ENotation('1.5', -3) ]
+        for value in values:
+            for module in (pickle, cPickle):
+                for protocol in (0, 2):
+                    copied = module.loads(module.dumps(value, protocol))
+                    self.assertEquals(type(copied), type(value))
+                    self.assertEquals(tuple(copied), tuple(value))
+            self.assertEquals(tuple(copy.copy(value)), tuple(value))
+            self.assertEquals(tuple(copy.deepcopy(value)), tuple(value))
+
+        term = 'case a > 1 then 1.50*(1/3) else 1E-3*(2-5i) end'
+        tree = term_parsers['infix_term'].parse(term)
+        self.assertEquals(cPickle.loads(cPickle.dumps(tree, 2)), tree)
+
+        doc = lmathdom.MathDOM.fromString(term, 'infix_term')
+        data = cPickle.dumps(doc, 2)
+        copied = cPickle.loads(data)
+        self.assert_(isinstance(copied, lmathdom.MathDOM))
+        self.assertEquals(copied.serialize(), doc.serialize())
+        self.assertEquals(copied.serialize('infix'), doc.serialize('infix'))
+
+
+    @for_lmathdom
+    def test_ldatatype_slots(self, lmathdom, doc):
+        from mathml.datatypes import Decimal, Complex, Rational, ENotation
+        values = [ Complex(Decimal('1.50'), Decimal('-2')), Rational(-1, 3),
+                   ENotation('1.5', -3) ]
+        for value in values:
+            self.failIf(hasattr(value, '__dict__'))
+
+        complex_value, rational, enotation = values
+        self.assertEquals(tuple(complex_value), (u'1.50', u'-2'))
+        self.assertEquals((complex_value.real_str, complex_value.imag_str), (u'1.50', u'-2'))
+        self.assertEquals(complex_value, 1.5-2j)
+
+        self.assertEquals(tuple(rational), (u'-1', u'3'))
+        self.assertEquals((rational.num_str, rational.denom_str), (u'-1', u'3'))
+        self.assertEquals(rational, Decimal(-1) / 3)
+        self.assertEquals(hash(rational), hash(Decimal(-1) / 3))
+        self.assertEquals(rational * 3, Decimal(-1) / 3 * 3)
+
+        self.assertEquals(tuple(enotation), (u'1.5', u'-3'))
+        self.assertEquals((enotation.num_str, enotation.exponent_str), (u'1.5', u'-3'))
+        self.assertEquals(enotation, Decimal('0.0015'))
+        self.assertEquals(str(enotation), '1.5E-3')
+
+        from decimal import DivisionByZero, InvalidOperation, localcontext
+        from mathml.datatypes import LiteralDecimal
+        self.assertRaises(DivisionByZero, Rational, 1, 0)
+        self.assertRaises(InvalidOperation, ENotation, 'abc', 2)
+        self.assertRaises(InvalidOperation, LiteralDecimal, 'abc')
+        with localcontext() as context:
+            context.prec = 5
+            rational = Rational(1, 3)
+        self.assertEquals(rational, Decimal('0.33333'))
+
+
+    @for_lmathdom
+    def test_lnumeric_modes(self, lmathdom, doc):
+        from mathml.termparser import term_parsers, InfixTermParser
+        from mathml.termbuilder import tree_converters
+        from mathml.datatypes import Decimal, Complex, LiteralDecimal
+        term = 'case a > .50 then 1.50*x + (2-3i) + 1E-3 else 0.1234567890123456 end'
+        build = tree_converters['infix'].build
+        expected = Decimal('0.50'), Decimal('1.50'), 2-3j, Decimal('0.1234567890123456')
+        outputs = {}
+        for mode, real_type, complex_type in (('decimal', Decimal, Complex),
+                                              ('lazy', LiteralDecimal, Complex),
+                                              ('float', float, complex)):
+            input_type = 'infix_term:%s' % mode
+            term_parsers[input_type] = InfixTermParser(mode).p_arithmetic_exp()
+            try:
+                tree = term_parsers.parse(term, input_type)
+                values = (tree[1][2][1], tree[2][1][1][1], tree[2][2][1], tree[3][1])
+                self.assertEquals(map(type, values)[1:3], [real_type, complex_type])
+                self.assertEquals(map(complex, values), map(complex, expected))
+
+                outputs[mode] = output = build(tree)
+                self.assertEquals(term_parsers.parse(output, input_type), tree)
+                doc = lmathdom.MathDOM.fromString(term, input_type)
+                self.assertEquals(doc.serialize('infix'), build(doc.to_tree()))
+            finally:
+                del term_parsers[input_type]
+
+        self.assertEquals(outputs['lazy'],
+            u'CASE WHEN a > .50 THEN 1.50 * x + (2-3i) + 1E-3 ELSE 0.1234567890123456 END')
+        self.assertEquals(outputs['float'],
+            u'CASE WHEN a > 0.5 THEN 1.5 * x + (2.0-3.0i) + 1E-3 ELSE 0.1234567890123456 END')
+        self.assertRaises(ValueError, InfixTermParser, 'binary')
+
+
+    @for_lmathdom
+    def test_lliteral_list(self, lmathdom, doc):
+        from mathml.termparser import (term_parsers, build_parser, ListParser,
+                                       InfixTermParser, LiteralList)
+        from mathml.termbuilder import tree_converters
+        import cPickle
+        grammar = build_parser(ListParser(InfixTermParser().p_arithmetic_exp()).p_list())
+        for term in ('1, -2,+3 ,4', '1.50, .5, -3.', '99999999999999999999, 1'):
+            tree = term_parsers.parse(term, 'infix_term_list')
+            self.assertEquals(type(tree), LiteralList)
+            self.assert_(isinstance(tree, tuple))
+            expected = grammar.parse(term)
+            self.assertEquals(tree, expected)
+            self.assertEquals(expected, tree)
+            self.assertEquals(tuple(tree), expected)
+            self.assertEquals(tree[1:3], expected[1:3])
+            self.assertEquals(tree[-1], expected[-1])
+            self.assertEquals(tree + ((u'name', u'x'),), expected + ((u'name', u'x'),))
+            self.assertEquals(hash(tree), hash(expected))
+            self.assertEquals(cPickle.loads(cPickle.dumps(tree, 2)), tree)
+            self.assertEquals(tree_converters['infix'].build(tree),
+                              tree_converters['infix'].build(expected))
+            self.assertEquals(lmathdom.MathDOM.fromString(term, 'infix_term_list').serialize(),
+                              lmathdom.MathDOM.fromTree(expected).serialize())
+
+        tree = term_parsers.parse('1, 2.5, a', 'infix_term_list')
+        self.assertEquals(type(tree), tuple)
+        self.assertEquals(tree_converters['infix'].build(tree), '(1,2.5,a)')
+
+        from mathml.termbuilder import InfixTermBuilder
+        class HexTermBuilder(InfixTermBuilder):
+            DIRECT_LITERAL_LISTS = False
+            def _handle_const_integer(self, operator, operands, status):
+                return [ hex(operands[0]) ]
+        tree = term_parsers.parse('10, 11', 'infix_term_list')
+        self.assertEquals(HexTermBuilder().build(tree), '(0xa,0xb)')
+
+
+    @for_lmathdom
+    def test_lparallel_list(self, lmathdom, doc):
+        from mathml.termparser import (term_parsers, ParallelListParser,
+                                       split_list_term, ParseException)
+        term = "max(1, 2), case a in [1, 2) then 'x,y' else 3 end, [1,2], sin(x)"
+        self.assertEquals(split_list_term(term),
+                          [(0, 'max(1, 2)'), (10, " case a in [1, 2) then 'x,y' else 3 end"),
+                           (50, ' [1,2]'), (57, ' sin(x)')])
+        self.assertEquals(split_list_term('max(1, 2'), None)
+        self.assertEquals(split_list_term('case a > 1 then 1 else 2'), None)
+
+        term = ', '.join( 'max(%d, a*b) + case x > %d then 1 else 2 end' % (i, i)
+                          for i in range(30) )
+        bad_term = term[:400] + ' + * ' + term[400:]
+        expected = term_parsers.parse(term, 'infix_term_list')
+        try:
+            term_parsers.parse(bad_term, 'infix_term_list')
+        except ParseException, e:
+            expected_loc = e.loc
+        from multiprocessing import Pool
+        pool = Pool(2)
+        try:
+            for parser in (ParallelListParser('infix_term', 1),
+                           ParallelListParser('infix_term', 2),
+                           ParallelListParser('infix_term', pool=pool)):
+                for i in range(2):
+                    self.assertEquals(parser.parse(term), expected)
+                try:
+                    parser.parse(bad_term)
+                    self.fail("ParseException expected")
+                except ParseException, e:
+                    self.assertEquals(e.loc, expected_loc)
+                parser.close()
+        finally:
+            pool.close()
+            pool.join()
+
+
+    @for_lmathdom
+    def test_last_python_parser(self, lmathdom, doc):
+        import mathml.utils.pyterm
+        from mathml.termparser import term_parsers, ParseException
+        for term in ('a*x**2 + 1.50*b + 3', 'sin(x) + math.pi', '1.5+2.5j - 1E-3',
+                     'x % (a-b-c)'):
+            self.assertEquals(term_parsers.parse(term, 'python_ast_term'),
+                              term_parsers.parse(term, 'python_term'))
+        for term in ("x in range(5) and not y", "not (x in range(5))",
+                     "x not in xrange(a, b+1)"):
+            self.assertEquals(term_parsers.parse(term, 'python_ast_bool'),
+                              term_parsers.parse(term, 'python_bool'))
+        self.assertEquals(term_parsers.parse("a != 1 or name == 'abc'", 'python_ast_bool'),
+                          ('or', ('!=', ('name', 'a'), ('const:integer', 1)),
+                                 ('=', ('name', 'name'), ('const:string', 'abc'))))
+
+        self.assertEquals(term_parsers.parse('0 <= x < 10', 'python_ast_bool'),
+                          term_parsers.parse('0 <= x and x < 10', 'python_bool'))
+        self.assertEquals(term_parsers.parse('a if x > 1 else b', 'python_ast_term'),
+                          term_parsers.parse('case x > 1 then a else b end', 'infix_term'))
+
+        self.assertEquals(term_parsers.parse(u'x == "\xe4"', 'python_ast_bool'),
+                          (u'=', ('name', 'x'), ('const:string', u'\xe4')))
+
+        for term, input_type, loc in (('x +* 2',      'python_ast_term', 3),
+                                      ('  x + {1:2}', 'python_ast_term', 6),
+                                      ('f(x, y=1)',   'python_ast_term', 0),
+                                      ('x in [1, 2]', 'python_ast_bool', 5),
+                                      (u'x == "\xe4\xe4" and {1:2}', 'python_ast_bool', 14),
+                                      (u'"\xe4" +* 2', 'python_ast_term', 5)):
+            try:
+                term_parsers.parse(term, input_type)
+                self.fail("ParseException expected")
+            except ParseException, e:
+                self.assertEquals(e.loc, loc)
+
+
+    @for_lmathdom
+    def test_lpython_interval_comparisons(self, lmathdom, doc):
+        import mathml.utils.pyterm
+        from mathml.termparser import term_parsers
+        from mathml.termbuilder import tree_converters
+        build = tree_converters['python_interval_comparisons'].build
+        self.assertEquals(build(term_parsers.parse('x in [a, b+1)', 'infix_bool')),
+                          'a <= x < b + 1')
+        self.assertEquals(build(term_parsers.parse('x notin (1, 2.5]', 'infix_bool')),
+                          'not ( 1 < x <= 2.5 )')
+
+        one, x = ('const:integer', 1), ('name', 'x')
+        tree = ('=', ('in', x, ('interval:closed', one, one)), ('const:bool', True))
+        self.assertEquals(build(tree), '( 1 <= x <= 1 ) == True')
+
+        tests = { 'x in [1.5, 10^18]'   : lambda x: 1.5 <= x <= 10**18,
+                  'x in (1.5, 10^18)'   : lambda x: 1.5 <  x <  10**18,
+                  'x in [1.5, 10^18)'   : lambda x: 1.5 <= x <  10**18,
+                  'x notin (1.5, 10^18]': lambda x: not 1.5 < x <= 10**18 }
+        for term, expected in tests.iteritems():
+            pyterm = build(term_parsers.parse(term, 'infix_bool'))
+            for x in (0, 1.5, 2, 10**18, 10**18+1):
+                self.assertEquals(eval(pyterm), expected(x))
+
+        doc = lmathdom.MathDOM.fromString('x in [1,2) or x in (3,4]', 'infix_bool')
+        self.assertEquals(doc.serialize('python_interval_comparisons'),
+                          '1 <= x < 2 or 3 < x <= 4')
+
+
+    @for_lmathdom
+    def test_lsql_parameters(self, lmathdom, doc):
+        import sqlite3
+        from mathml.utils.sqlterm import StatementCache
+        from mathml.termparser import term_parsers
+        from mathml.termbuilder import tree_converters
+        from mathml.datatypes import Decimal
+        builder = tree_converters['sql']
+
+        tree = term_parsers.parse("weight > 1.50 and price <= 2E1 or name = 'abc'", 'infix_bool')
+        self.assertEquals(builder.build_parameterized(tree, {'weight' : 'items.weight'}),
+                          ('items.weight > ? and price <= ? or name = ?',
+                           [1.5, 20.0, 'abc']))
+        sql, params = builder.build_parameterized(tree, exact=True)
+        self.assertEquals(params, [Decimal('1.50'), Decimal('2E1'), 'abc'])
+        self.assertEquals(map(type, params)[:2], [Decimal, Decimal])
+
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE items (id INTEGER, weight REAL, price REAL)')
+        connection.executemany('INSERT INTO items VALUES (?, ?, ?)',
+                               [ (i, i % 17 * 0.5, i % 23) for i in range(200) ])
+        def prepare(sql):
+            sql = 'SELECT id FROM items WHERE ' + sql + ' ORDER BY id'
+            def execute(params):
+                return connection.execute(sql, params).fetchall()
+            return execute
+
+        cache = StatementCache(prepare)
+        for i in range(20):
+            tree = term_parsers.parse('w > %d.5 and price * 2 <= %d' % (i % 7, i + 10), 'infix_bool')
+            sql, params = builder.build_parameterized(tree, {'w' : 'weight'})
+            expected = connection.execute(
+                'SELECT id FROM items WHERE ' + builder.build(tree).replace('w >', 'weight >') +
+                ' ORDER BY id').fetchall()
+            self.assertEquals(cache.get(sql)(params), expected)
+        self.assertEquals((len(cache), cache.misses, cache.hits), (1, 1, 19))
+
+        cache = StatementCache(prepare, maxsize=1)
+        cache.get('weight > ?')
+        cache.get('price > ?')
+        cache.get('weight > ?')
+        self.assertEquals((len(cache), cache.misses), (1, 3))
+
+
 if __name__ == '__main__':
     unittest.main()